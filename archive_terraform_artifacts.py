@@ -1,39 +1,143 @@
 #!/usr/bin/env python3
 '''
-This script copies the terraform output files to a git repo for commit.
+This script archives the terraform output files to a git repo for commit. Files are stored once per
+distinct content, gzipped and named by their sha256, and each tenant gets a manifest of what its files are.
 '''
 
+import gzip
+import hashlib
+import json
 import os
 import shutil
 import logging
 
-from cim_functions import get_args, inventory_lookup
+from tf_cache import plan_cache_file, plan_was_applied
+
+# What gets archived from each terraform working directory: the rendered config, the saved plan and a
+# snapshot of the state.
+archived_files = ['customer.tf', 'variables.tf', 'tfplan', 'terraform.tfstate']
+
+# Copied next to the manifest as well, as they always have been, for anything reading them from there.
+plain_copies = ['customer.tf', 'variables.tf']
+
+blob_dir_name = 'blobs'
+manifest_name = 'manifest.json'
+
+
+def file_hash(path):
+    ''' sha256 of a file '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file_handle:
+        for chunk in iter(lambda: file_handle.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_blob(archive_dir, path, sha256):
+    ''' Put a file into the blob store unless its content is already there. Returns True if it was added. '''
+    blob_path = os.path.join(archive_dir, blob_dir_name, sha256[:2], sha256 + '.gz')
+    if os.path.exists(blob_path):
+        return False
+
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    # No name or timestamp in the gzip header, so the same content always makes the same blob.
+    with open(path, 'rb') as source_handle, open(blob_path + '.tmp', 'wb') as blob_handle:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=blob_handle, mtime=0) as gzip_handle:
+            shutil.copyfileobj(source_handle, gzip_handle)
+    os.replace(blob_path + '.tmp', blob_path)
+    return True
+
+
+def plan_has_changes(working_dir):
+    ''' False if infra_service.py recorded that the saved plan changes nothing. Such a plan isn't worth keeping.
+    A plan that was applied always is: the plan cache says "no changes" after an apply, but that describes the
+    state the apply left behind, not the plan. '''
+    if plan_was_applied(working_dir, 'tfplan'):
+        return True
+
+    cache_path = os.path.join(working_dir, plan_cache_file)
+    if not os.path.exists(cache_path):
+        return True
+    with open(cache_path, 'r') as cache_handle:
+        try:
+            return not json.load(cache_handle).get('no_changes', False)
+        except ValueError:
+            return True
+
+
+def collect_artifacts(modules_dir):
+    ''' Map of manifest name to path for everything worth archiving, including each layer of a layered stack '''
+    working_dirs = {'': modules_dir}
+    for name in sorted(os.listdir(modules_dir)):
+        if os.path.isfile(os.path.join(modules_dir, name, 'customer.tf')):
+            working_dirs[name + '/'] = os.path.join(modules_dir, name)
+
+    artifacts = {}
+    for prefix, working_dir in working_dirs.items():
+        for file_name in archived_files:
+            path = os.path.join(working_dir, file_name)
+            if not os.path.isfile(path):
+                continue
+            if file_name == 'tfplan' and not plan_has_changes(working_dir):
+                continue
+            artifacts[prefix + file_name] = path
+    return artifacts
+
+
+def archive(modules_dir, archive_dir, tenant):
+    ''' Archive a tenant's terraform files. Returns True if the tenant's manifest changed. '''
+    tenant_dir = os.path.join(archive_dir, tenant)
+    os.makedirs(tenant_dir, exist_ok=True)
+
+    manifest_path = os.path.join(tenant_dir, manifest_name)
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as manifest_handle:
+            previous = json.load(manifest_handle)
+
+    manifest = {"files": {}}
+    added = 0
+    for name, path in sorted(collect_artifacts(modules_dir).items()):
+        sha256 = file_hash(path)
+        manifest['files'][name] = {"sha256": sha256, "size": os.path.getsize(path)}
+        if store_blob(archive_dir, path, sha256):
+            added += 1
+
+        if name in plain_copies and previous.get('files', {}).get(name, {}).get('sha256') != sha256:
+            shutil.copy(path, tenant_dir)
+
+    if not manifest['files']:
+        raise FileNotFoundError(f"No terraform files found in {modules_dir}")
+
+    logging.info("%d files archived for %s, %d of them new content", len(manifest['files']), tenant, added)
+
+    if manifest == previous:
+        logging.info("Nothing changed since the last archive of %s", tenant)
+        return False
+
+    with open(manifest_path + '.tmp', 'w') as manifest_handle:
+        json.dump(manifest, manifest_handle, indent=2, sort_keys=True)
+        manifest_handle.write('\n')
+    os.replace(manifest_path + '.tmp', manifest_path)
+    logging.info("Updated %s", manifest_path)
+    return True
+
 
 def main():
 
     ''' main body of the script '''
+    # Only the command line needs the inventory, which isn't importable everywhere archive() is used.
+    from cim_functions import get_args, inventory_lookup
+
     logging.basicConfig(level=logging.DEBUG)
 
     args = get_args()
     inventory_data = inventory_lookup(args.customer_env, args.localfile)
 
-    src_tfvars_path = os.path.join('modules', 'variables.tf')
-    src_tf_path = os.path.join('modules', 'customer.tf')
-    dst_tf_path = os.path.join(os.environ['CAMP_TERRAFORM_DATA'], inventory_data['tenant_cluster_name'])
-
     try:
-        os.makedirs(dst_tf_path, mode=0o777)
-    except OSError as error:
-        logging.info("TF Path %s already exists -- proceeding anyways (error=%s)", dst_tf_path, error)
-
-    try:
-        shutil.copy(src_tf_path, dst_tf_path)
-        shutil.copy(src_tfvars_path, dst_tf_path)
-
-        logging.info("Copied %s and %s to %s", src_tf_path, src_tfvars_path, dst_tf_path)
-
-    except:
-        logging.error('ERROR: Unable to copy terraform files to %s', dst_tf_path)
+        archive('modules', os.environ['CAMP_TERRAFORM_DATA'], inventory_data['tenant_cluster_name'])
+    except (OSError, ValueError) as error:
+        logging.error('ERROR: Unable to archive terraform files to %s: %s', os.environ['CAMP_TERRAFORM_DATA'], error)
         exit(1)
 
 
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+'''
+Stand-in for a campaign instance's logon pages, for checking login_check.py without a real instance.
+
+GET /xtk/logon.jssp answers with a login form like the real one. Posting it with the right credentials
+lands on the page the real instance shows after logging in, and with the wrong ones on the login form again.
+--after-login makes a successful login land somewhere else instead: an error page (HTTP 500), or a page
+that is neither the welcome page nor a login form.
+'''
+
+import argparse
+import html
+import http.server
+import logging
+import threading
+import urllib.parse
+
+logon_path = '/xtk/logon.jssp'
+login_post_path = '/nl/jsp/logon.jsp'
+
+after_login_pages = ['welcome', 'error', 'elsewhere']
+
+logon_page = '''<html><body>
+<form action="{action}" method="post">
+  <input type="hidden" name="target" value="/view/home">
+  <input type="text" id="username" name="login" value="{login}">
+  <input type="password" id="password" name="password" value="">
+  <input type="submit" value="Log in">
+</form>
+</body></html>
+'''
+
+welcome_page = '<html><body><p>Your instance has been upgraded to repo 9032.</p></body></html>\n'
+error_page = '<html><body><h1>500 Internal Server Error</h1></body></html>\n'
+elsewhere_page = '<html><body><p>Maintenance page. Nothing to see here.</p></body></html>\n'
+
+
+class FakeCampaignHandler(http.server.BaseHTTPRequestHandler):
+    ''' The logon pages of one fake instance. Credentials and behaviour come from the server. '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("%s %s", self.address_string(), format % args)
+
+    def send_page(self, status, page):
+        data = page.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if urllib.parse.urlsplit(self.path).path != logon_path:
+            self.send_page(404, '<html><body>Not found</body></html>\n')
+            return
+        self.send_page(200, logon_page.format(action=login_post_path, login=''))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        if urllib.parse.urlsplit(self.path).path != login_post_path:
+            self.send_page(404, '<html><body>Not found</body></html>\n')
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        fields = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+        login = fields.get('login', [''])[0]
+        password = fields.get('password', [''])[0]
+
+        if (login, password) != (self.server.username, self.server.password):
+            self.send_page(200, logon_page.format(action=login_post_path, login=html.escape(login)))
+        elif self.server.after_login == 'error':
+            self.send_page(500, error_page)
+        elif self.server.after_login == 'elsewhere':
+            self.send_page(200, elsewhere_page)
+        else:
+            self.send_page(200, welcome_page)
+
+
+class FakeCampaign(http.server.ThreadingHTTPServer):
+    ''' A fake instance on a local port. Use as a context manager to serve it from a thread. '''
+
+    daemon_threads = True
+
+    def __init__(self, username, password, after_login='welcome', address=('127.0.0.1', 0)):
+        if after_login not in after_login_pages:
+            raise ValueError(f"Unknown after_login {after_login}, expected one of {', '.join(after_login_pages)}")
+        super().__init__(address, FakeCampaignHandler)
+        self.username = username
+        self.password = password
+        self.after_login = after_login
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def get_args():
+    ''' process commandline arguments '''
+    parser = argparse.ArgumentParser(description='Serve the logon pages of a fake campaign instance')
+    parser.add_argument('--listen', dest='listen', action='store', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', dest='port', action='store', type=int, default=8086,
+                        help='Port to listen on')
+    parser.add_argument('--username', dest='username', action='store', default='admin',
+                        help='Login that is accepted')
+    parser.add_argument('--password', dest='password', action='store', default='admin',
+                        help='Password that is accepted')
+    parser.add_argument('--after-login', dest='after_login', action='store', choices=after_login_pages, default='welcome',
+                        help='What a successful login lands on')
+    return parser.parse_args()
+
+
+def main():
+    ''' main body of the script '''
+    logging.basicConfig(level=logging.INFO)
+    args = get_args()
+    server = FakeCampaign(args.username, args.password, args.after_login, (args.listen, args.port))
+    print(f"Fake campaign instance on {server.url}{logon_path}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+'''
+Stand-in for the terraform binary, for benchmarking infra_service.py without touching Azure.
+
+It understands the commands infra_service.py runs (init, plan, apply, destroy, refresh, state list/pull/mv)
+and prints what terraform 0.12 would, against a JSON state file in the working directory. The resources
+are the ones declared in the *.tf files there, or FAKE_TF_RESOURCES synthetic ones if there are none.
+
+Environment:
+  FAKE_TF_RESOURCES       synthetic resource count when the config declares none (default 50)
+  FAKE_TF_DELAY           seconds spent on each resource in apply/destroy/refresh (default 0)
+  FAKE_TF_INIT_DELAY      seconds init takes (default 0)
+  FAKE_TF_PLAN_LINES      attribute lines printed per planned resource (default 12)
+  FAKE_TF_REPLACE         comma separated addresses that plans replace when they are already in the state
+  FAKE_TF_ERROR           error_catalog.yml entry to fail apply/destroy with (default none)
+  FAKE_TF_ERROR_ATTEMPTS  how many apply/destroy runs fail before they start succeeding (default 1)
+  FAKE_TF_ERROR_AFTER     fraction of the resources done before the failure (default 0.5)
+'''
+
+import glob
+import json
+import os
+import re
+import sys
+import time
+import uuid
+
+state_file = 'terraform.tfstate'
+attempts_file = '.fake_terraform_attempts'
+
+resource_types = ['azurerm_network_security_rule', 'azurerm_public_ip', 'azurerm_network_interface',
+                  'azurerm_virtual_machine', 'azurerm_managed_disk', 'azurerm_postgresql_server',
+                  'azurerm_postgresql_firewall_rule', 'azurerm_virtual_network_peering', 'aws_route53_record']
+
+# Seconds terraform would report for one resource of a type, for realistic "complete after" lines.
+reported_seconds = {'azurerm_virtual_machine': 260, 'azurerm_postgresql_server': 540,
+                    'azurerm_virtual_network_peering': 45, 'azurerm_managed_disk': 12}
+
+# One line of output per error_catalog.yml entry, which the entry's pattern matches.
+error_lines = {
+    "retryable_error": 'Error: Code="RetryableError" Message="A retryable error occurred."',
+    "context_deadline_exceeded": 'Error: waiting for creation: context deadline exceeded',
+    "plugin_requirements": 'Error: error satisfying plugin requirements',
+    "vm_core_quota": 'Error: Operation results in exceeding approved Total Regional Cores quota.',
+    "unknown_resource": 'Error: unknown resource type: azurerm_bench',
+    "generic_error": 'Error: something went wrong that nobody has seen before'
+}
+
+resource_regexp = re.compile(r'^\s*resource\s+"([^"]+)"\s+"([^"]+)"')
+
+
+def env_number(name, default):
+    return float(os.environ.get(name, default))
+
+
+def parse_arguments(argv):
+    ''' Split terraform style arguments into the command, its options and the rest '''
+    command = []
+    options = {}
+    positional = []
+    for arg in argv:
+        if arg.startswith('-'):
+            key, _, value = arg.lstrip('-').partition('=')
+            options.setdefault(key, []).append(value)
+        elif not options and len(command) < 2 and (not command or command[0] == 'state'):
+            command.append(arg)
+        else:
+            positional.append(arg)
+    return command, options, positional
+
+
+def config_resources():
+    ''' Addresses declared by the config, or synthetic ones '''
+    addresses = []
+    for config_path in sorted(glob.glob('*.tf')):
+        with open(config_path, 'r') as config_handle:
+            for line in config_handle:
+                match = resource_regexp.match(line)
+                if match:
+                    addresses.append(f"{match.group(1)}.{match.group(2)}")
+    if addresses:
+        return addresses
+    count = int(env_number('FAKE_TF_RESOURCES', 50))
+    return [f"{resource_types[index % len(resource_types)]}.bench{index}" for index in range(count)]
+
+
+def load_state(state_path=state_file):
+    if not os.path.exists(state_path):
+        return {"version": 4, "lineage": str(uuid.uuid4()), "serial": 0, "resources": []}
+    with open(state_path, 'r') as state_handle:
+        return json.load(state_handle)
+
+
+def save_state(state, state_path=state_file):
+    state['serial'] += 1
+    with open(state_path + '.tmp', 'w') as state_handle:
+        json.dump(state, state_handle)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def refresh_lines(state):
+    for address in state['resources']:
+        print(f"{address}: Refreshing state... [id=/subscriptions/bench/{address}]", flush=True)
+        time.sleep(env_number('FAKE_TF_DELAY', 0) / 10)
+
+
+def changes(state, destroy, targets):
+    ''' (address, action) for everything a plan would do '''
+    in_state = set(state['resources'])
+    if destroy:
+        planned = [(address, 'destroy') for address in state['resources']]
+    else:
+        replace = set(os.environ.get('FAKE_TF_REPLACE', '').split(','))
+        planned = [(address, 'replace' if address in replace else 'create') for address in config_resources()
+                   if address not in in_state or address in replace]
+    if targets:
+        planned = [(address, action) for address, action in planned
+                   if any(address == target or address.startswith(target + '[') for target in targets)]
+    return planned
+
+
+def print_plan(planned):
+    plan_lines = int(env_number('FAKE_TF_PLAN_LINES', 12))
+    wording = {"create": "will be created", "destroy": "will be destroyed", "replace": "must be replaced"}
+    symbol = {"create": "+", "destroy": "-", "replace": "-/+"}
+    for address, action in planned:
+        resource_type, name = address.split('.', 1)
+        print(f"  # {address} {wording[action]}", flush=False)
+        print(f'  {symbol[action]} resource "{resource_type}" "{name}" {{')
+        for index in range(plan_lines):
+            print(f'      {symbol[action]} attribute_{index:<20} = "value-{index}-{name}"')
+        print('    }')
+        print('')
+    added = sum(1 for _, action in planned if action in ['create', 'replace'])
+    destroyed = sum(1 for _, action in planned if action in ['destroy', 'replace'])
+    print(f"Plan: {added} to add, 0 to change, {destroyed} to destroy.", flush=True)
+
+
+def next_attempt():
+    ''' Count apply/destroy runs in this working directory, for FAKE_TF_ERROR_ATTEMPTS '''
+    attempt = 1
+    if os.path.exists(attempts_file):
+        with open(attempts_file, 'r') as attempts_handle:
+            attempt = int(attempts_handle.read() or 0) + 1
+    with open(attempts_file, 'w') as attempts_handle:
+        attempts_handle.write(str(attempt))
+    return attempt
+
+
+def carry_out(state, planned):
+    ''' Apply or destroy, failing part way if asked to. Returns the exit code. '''
+    error = os.environ.get('FAKE_TF_ERROR')
+    fail = error and next_attempt() <= int(env_number('FAKE_TF_ERROR_ATTEMPTS', 1))
+    fail_at = int(len(planned) * env_number('FAKE_TF_ERROR_AFTER', 0.5)) if fail else None
+    delay = env_number('FAKE_TF_DELAY', 0)
+
+    done = {"create": 0, "destroy": 0}
+    for index, (address, action) in enumerate(planned):
+        resource_type, name = address.split('.', 1)
+        if index == fail_at:
+            save_state(state)
+            print('', flush=True)
+            print(error_lines[error], flush=True)
+            print('', flush=True)
+            print(f'  on customer.tf line {100 + index}, in resource "{resource_type}" "{name}":', flush=True)
+            print(f'{100 + index}: resource "{resource_type}" "{name}" {{', flush=True)
+            return 1
+
+        seconds = reported_seconds.get(resource_type, 3)
+        if action == 'replace':
+            print(f"{address}: Destroying... [id=/subscriptions/bench/{address}]", flush=True)
+            print(f"{address}: Destruction complete after {seconds}s", flush=True)
+            state['resources'].remove(address)
+            action = 'create'
+        if action == 'create':
+            print(f"{address}: Creating...", flush=True)
+            time.sleep(delay)
+            state['resources'].append(address)
+            print(f"{address}: Creation complete after {seconds // 60}m{seconds % 60}s [id=/subscriptions/bench/{address}]", flush=True)
+        else:
+            print(f"{address}: Destroying... [id=/subscriptions/bench/{address}]", flush=True)
+            time.sleep(delay)
+            state['resources'].remove(address)
+            print(f"{address}: Destruction complete after {seconds}s", flush=True)
+        done[action] += 1
+
+    save_state(state)
+    print('', flush=True)
+    if done['destroy'] and not done['create']:
+        print(f"Destroy complete! Resources: {done['destroy']} destroyed.", flush=True)
+    else:
+        print(f"Apply complete! Resources: {done['create']} added, 0 changed, {done['destroy']} destroyed.", flush=True)
+    return 0
+
+
+def main():
+    command, options, positional = parse_arguments(sys.argv[1:])
+    name = ' '.join(command)
+    targets = options.get('target')
+    destroy = options.get('destroy', ['false'])[-1] in ['', 'true']
+
+    if name == 'init':
+        time.sleep(env_number('FAKE_TF_INIT_DELAY', 0))
+        os.makedirs('.terraform', exist_ok=True)
+        print("Terraform has been successfully initialized!")
+        return 0
+
+    state_path = options.get('state', [state_file])[-1]
+    state = load_state(state_path)
+
+    if name == 'state list':
+        print('\n'.join(state['resources']))
+        return 0
+
+    if name == 'state mv':
+        if len(positional) != 2:
+            print("Error: Exactly two arguments expected.", flush=True)
+            return 1
+        source, destination = positional
+        if source not in state['resources']:
+            print(f"Error: Invalid source address: {source}", flush=True)
+            return 1
+        out_path = options.get('state-out', [state_path])[-1]
+        out_state = state if out_path == state_path else load_state(out_path)
+        if destination in out_state['resources']:
+            print(f"Error: Invalid target address: {destination} already exists", flush=True)
+            return 1
+        state['resources'].remove(source)
+        out_state['resources'].append(destination)
+        save_state(state, state_path)
+        if out_state is not state:
+            save_state(out_state, out_path)
+        print(f'Move "{source}" to "{destination}"')
+        print("Successfully moved 1 object(s).")
+        return 0
+
+    if name == 'state pull':
+        if os.path.exists(state_file):
+            print(json.dumps(state))
+        return 0
+
+    if name == 'show':
+        # Only what infra_service reads: show -json of a saved plan.
+        if 'json' not in options or not positional:
+            print("Error: fake terraform only shows saved plans as JSON", flush=True)
+            return 1
+        with open(positional[0], 'r') as plan_handle:
+            saved = json.load(plan_handle)
+        actions = {"create": ["create"], "destroy": ["delete"], "replace": ["delete", "create"]}
+        resource_changes = []
+        for address, action in saved['planned']:
+            resource_type, name = address.split('.', 1)
+            resource_changes.append({"address": address, "mode": "managed", "type": resource_type, "name": name,
+                                     "change": {"actions": actions[action],
+                                                "before": None if action == 'create' else {"name": name},
+                                                "after": None if action == 'destroy' else {"name": name},
+                                                "after_unknown": {} if action == 'destroy' else {"id": True}}})
+        print(json.dumps({"format_version": "0.1", "resource_changes": resource_changes}))
+        return 0
+
+    if name == 'refresh':
+        for address in state['resources']:
+            if not targets or address in targets:
+                print(f"{address}: Refreshing state... [id=/subscriptions/bench/{address}]", flush=True)
+                time.sleep(env_number('FAKE_TF_DELAY', 0) / 10)
+        save_state(state)
+        return 0
+
+    if name == 'plan':
+        if options.get('refresh', ['true'])[-1] != 'false':
+            refresh_lines(state)
+        planned = changes(state, destroy, targets)
+        # Like terraform, -out writes a plan file whether or not there is anything to do.
+        if 'out' in options:
+            with open(options['out'][-1], 'w') as plan_handle:
+                json.dump({"serial": state['serial'], "planned": planned}, plan_handle)
+        if not planned:
+            print("No changes. Infrastructure is up-to-date.")
+            return 0
+        print_plan(planned)
+        return 2 if 'detailed-exitcode' in options else 0
+
+    if name == 'apply' and positional and os.path.isfile(positional[0]):
+        with open(positional[0], 'r') as plan_handle:
+            saved = json.load(plan_handle)
+        if saved['serial'] != state['serial']:
+            print("Error: Saved plan is stale", flush=True)
+            return 1
+        return carry_out(state, [tuple(change) for change in saved['planned']])
+
+    if name in ['apply', 'destroy']:
+        refresh_lines(state)
+        return carry_out(state, changes(state, name == 'destroy' or destroy, targets))
+
+    print(f"Error: fake terraform does not know '{name}'", flush=True)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+'''
+Stand-in for the Vault secrets API, for checking vault_cache.py without a real Vault.
+
+GET /v1/<path> answers with the secret at that path the way the KV version 1 engine does, with the lease
+duration it was given, or 404 if there is none. A request without the right X-Vault-Token gets 403.
+Every read is counted per path, so that tests can tell what the cache actually asked for.
+'''
+
+import argparse
+import collections
+import http.server
+import json
+import logging
+import threading
+import time
+import urllib.parse
+import uuid
+
+
+class FakeVaultHandler(http.server.BaseHTTPRequestHandler):
+    ''' The secrets API of one fake Vault. Secrets, token and behaviour come from the server. '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("%s %s", self.address_string(), format % args)
+
+    def send_json(self, status, body):
+        data = (json.dumps(body) + '\n').encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.headers.get('X-Vault-Token') != self.server.token:
+            self.send_json(403, {"errors": ["permission denied"]})
+            return
+
+        path = urllib.parse.urlsplit(self.path).path
+        if not path.startswith('/v1/'):
+            self.send_json(404, {"errors": []})
+            return
+        path = path[len('/v1/'):]
+
+        with self.server.lock:
+            self.server.reads[path] += 1
+        time.sleep(self.server.delay)
+
+        if path not in self.server.secrets:
+            self.send_json(404, {"errors": []})
+            return
+        self.send_json(200, {"request_id": str(uuid.uuid4()), "lease_id": "", "renewable": False,
+                             "lease_duration": self.server.lease_duration, "data": self.server.secrets[path],
+                             "wrap_info": None, "warnings": None, "auth": None})
+
+
+class FakeVault(http.server.ThreadingHTTPServer):
+    ''' A fake Vault on a local port. Use as a context manager to serve it from a thread. '''
+
+    daemon_threads = True
+
+    def __init__(self, secrets, token='test-token', lease_duration=0, delay=0, address=('127.0.0.1', 0)):
+        super().__init__(address, FakeVaultHandler)
+        self.secrets = secrets
+        self.token = token
+        self.lease_duration = lease_duration
+        self.delay = delay
+        self.reads = collections.Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def get_args():
+    ''' process commandline arguments '''
+    parser = argparse.ArgumentParser(description='Serve secrets like a Vault KV engine, for trying vault_cache.py')
+    parser.add_argument('--listen', dest='listen', action='store', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', dest='port', action='store', type=int, default=8200,
+                        help='Port to listen on')
+    parser.add_argument('--token', dest='token', action='store', default='test-token',
+                        help='Token that is accepted')
+    parser.add_argument('--secret', dest='secrets', action='append', default=[], metavar='PATH=JSON',
+                        help='A secret to serve, e.g. secret/acme=\'{"admin": "pass"}\'. Repeat for more')
+    parser.add_argument('--lease-duration', dest='lease_duration', action='store', type=int, default=0,
+                        help='Lease duration in seconds reported for every secret')
+    parser.add_argument('--delay', dest='delay', action='store', type=float, default=0,
+                        help='Seconds each read takes')
+    return parser.parse_args()
+
+
+def main():
+    ''' main body of the script '''
+    logging.basicConfig(level=logging.INFO)
+    args = get_args()
+    secrets = {}
+    for secret in args.secrets:
+        path, _, data = secret.partition('=')
+        secrets[path] = json.loads(data)
+    server = FakeVault(secrets, args.token, args.lease_duration, args.delay, (args.listen, args.port))
+    print(f"Fake Vault on {server.url} (VAULT_ADDR={server.url} VAULT_TOKEN={args.token})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
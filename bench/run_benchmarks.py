@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for infra_service.py and the scripts around it, run entirely locally: terraform is
+bench/fake_terraform.py, and the logs, tenants and inventory are generated from fixed seeds.
+
+Results are written to bench/results/<commit>.json so that runs on different commits can be compared
+with --compare. These are measurements, not tests; nothing here passes or fails.
+
+  bench/run_benchmarks.py                                   # everything, results for the current commit
+  bench/run_benchmarks.py --scenarios tf_apply --compare bench/results/<older commit>.json
+  bench/run_benchmarks.py --compare <old>.json <new>.json   # compare two earlier runs
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+
+import infra_service  # pylint: disable=wrong-import-position
+import inventory_store  # pylint: disable=wrong-import-position
+import render_config  # pylint: disable=wrong-import-position
+from log_capture import SegmentedLogCapture  # pylint: disable=wrong-import-position
+
+# pylint: disable=line-too-long
+
+results_dir = os.path.join(bench_dir, 'results')
+fake_terraform_path = os.path.join(bench_dir, 'fake_terraform.py')
+
+scenario_names = ['log_review', 'tf_apply', 'render', 'inventory']
+
+# tf_apply runs: name, extra infra_service arguments, fake terraform environment, whether the working
+# directory is applied once beforehand so that there is nothing left to do.
+apply_runs = [
+    ("create", [], {}, False),
+    ("retry", [], {"FAKE_TF_ERROR": "retryable_error"}, False),
+    ("fatal", [], {"FAKE_TF_ERROR": "vm_core_quota", "FAKE_TF_ERROR_ATTEMPTS": "99"}, False),
+    ("no_changes_cached", [], {}, True),
+    ("no_changes_full_refresh", ['--no-plan-cache'], {}, True),
+    ("no_changes_ttl_refresh", ['--no-plan-cache', '--refresh', 'ttl'], {}, True)
+]
+
+# Lines the synthetic logs end on: a success, and an error that makes log_review print the detailed output.
+log_endings = {
+    "success": "Apply complete! Resources: 1200 added, 0 changed, 0 destroyed.",
+    "error": 'Error: Code="RetryableError" Message="A retryable error occurred."'
+}
+
+resource_types = ['azurerm_network_security_rule', 'azurerm_public_ip', 'azurerm_network_interface',
+                  'azurerm_virtual_machine', 'azurerm_managed_disk', 'azurerm_postgresql_server',
+                  'aws_route53_record']
+
+
+def get_args():
+    ''' process commandline arguments '''
+    parser = argparse.ArgumentParser(
+        description='Benchmark infra_service.py, template rendering and inventory lookups against local stand-ins')
+    parser.add_argument('--scenarios', dest='scenarios', action='store', nargs='+', choices=scenario_names,
+                        default=scenario_names, help='What to benchmark')
+    parser.add_argument('--repeat', dest='repeat', action='store', type=int, default=5,
+                        help='How many times each measurement is taken; the median is reported')
+    parser.add_argument('--seed', dest='seed', action='store', type=int, default=1,
+                        help='Seed for the generated logs, tenants and inventory')
+    parser.add_argument('--log-mb', dest='log_mb', action='store', type=float, default=8,
+                        help='Size of each synthetic terraform log')
+    parser.add_argument('--resources', dest='resources', action='store', type=int, default=60,
+                        help='Resources in the config the fake terraform applies')
+    parser.add_argument('--terraform-delay', dest='terraform_delay', action='store', type=float, default=0.01,
+                        help='Seconds the fake terraform spends creating or destroying each resource (refreshing takes a tenth of that)')
+    parser.add_argument('--tenants', dest='tenants', action='store', type=int, default=200,
+                        help='Synthetic tenants to render and look up')
+    parser.add_argument('--output', dest='output', action='store', default=None,
+                        help='Where to write the results (default bench/results/<commit>.json)')
+    parser.add_argument('--compare', dest='compare', action='store', nargs='+', default=None,
+                        help='Compare against this results file. Given two files, compare them without running anything')
+    return parser.parse_args()
+
+
+def git_revision():
+    ''' Current commit and whether the tree has uncommitted changes '''
+    def git(*git_args):
+        return subprocess.run(['git', '-C', repo_dir] + list(git_args), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=False).stdout.strip()
+    commit = git('rev-parse', '--short=12', 'HEAD') or 'unknown'
+    dirty = bool(git('status', '--porcelain', '--untracked-files=no'))
+    return commit, dirty
+
+
+def median_seconds(function, repeat):
+    ''' Median wall time of function over repeat calls, and the last result '''
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def synthetic_log(rng, size_bytes, ending):
+    ''' Lines of terraform output adding up to about size_bytes, the way a large apply produces them '''
+    lines = []
+    total = 0
+    index = 0
+    while total < size_bytes:
+        address = f"{rng.choice(resource_types)}.r{index}"
+        choice = rng.random()
+        if choice < 0.4:
+            line = f"{address}: Refreshing state... [id=/subscriptions/{rng.getrandbits(64):x}/{address}]"
+        elif choice < 0.8:
+            line = f'      + attribute_{rng.randrange(40):<18} = "{rng.getrandbits(128):x}"'
+        elif choice < 0.9:
+            line = f"{address}: Still creating... [{rng.randrange(1, 60)}m{rng.randrange(60)}s elapsed]"
+        else:
+            line = f"{address}: Creation complete after {rng.randrange(1, 600)}s [id=/subscriptions/{rng.getrandbits(64):x}/{address}]"
+        lines.append(line)
+        total += len(line) + 1
+        index += 1
+    lines.append('')
+    lines.append(log_endings[ending])
+    return lines
+
+
+def bench_log_review(args, work_dir):
+    ''' Feed multi-megabyte logs through the capture handler and time log_review on them '''
+    rng = random.Random(args.seed)
+    results = {}
+    for ending in log_endings:
+        lines = synthetic_log(rng, int(args.log_mb * 1024 * 1024), ending)
+        size_mb = sum(len(line) + 1 for line in lines) / (1024 * 1024)
+
+        logger = logging.getLogger(f"bench.log_review.{ending}")
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+
+        captures = []
+
+        def capture():
+            log_capture = SegmentedLogCapture(spill_dir=work_dir)
+            captures.append(log_capture)
+            logger.addHandler(log_capture)
+            log_capture.start_segment('apply')
+            for line in lines:
+                logger.debug(line)
+            logger.removeHandler(log_capture)
+            return log_capture
+
+        capture_seconds, log_capture = median_seconds(capture, args.repeat)
+
+        # log_review prints for the operator; that is not what is being measured.
+        with contextlib.redirect_stdout(io.StringIO()):
+            review_seconds, exit_code = median_seconds(lambda: infra_service.log_review(log_capture), args.repeat)
+        for log_capture in captures:
+            log_capture.close()
+
+        results[ending] = {
+            "lines": len(lines),
+            "megabytes": round(size_mb, 2),
+            "capture_seconds": round(capture_seconds, 4),
+            "capture_lines_per_second": round(len(lines) / capture_seconds),
+            "capture_megabytes_per_second": round(size_mb / capture_seconds, 2),
+            "review_seconds": round(review_seconds, 6),
+            "exit_code": exit_code
+        }
+    return results
+
+
+def fake_terraform_wrapper(work_dir):
+    ''' Executable that runs the fake terraform with this interpreter '''
+    wrapper_path = os.path.join(work_dir, 'terraform')
+    with open(wrapper_path, 'w') as wrapper_handle:
+        wrapper_handle.write(f'#!/bin/sh\nexec "{sys.executable}" "{fake_terraform_path}" "$@"\n')
+    os.chmod(wrapper_path, 0o755)
+    return wrapper_path
+
+
+def write_fake_config(working_dir, resources):
+    ''' A customer.tf with the given number of resources, for the fake terraform to apply '''
+    os.makedirs(working_dir, exist_ok=True)
+    with open(os.path.join(working_dir, 'customer.tf'), 'w') as config_handle:
+        config_handle.write('provider "azurerm" {\n  subscription_id = "bench"\n}\n\n')
+        for index in range(resources):
+            config_handle.write(f'resource "{resource_types[index % len(resource_types)]}" "bench{index}" {{\n}}\n\n')
+
+
+def run_infra_service(working_dir, argv, environment):
+    ''' One infra_service run on a working directory, as Jenkins would start it. Returns the exit code and
+    the seconds spent in each phase. '''
+    metrics_path = os.path.join(working_dir, 'bench_metrics.jsonl')
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+
+    saved_argv, saved_environ = sys.argv, dict(os.environ)
+    sys.argv = ['infra_service.py', '--apply', '--retry-backoff', '0', '--metrics-file', metrics_path] + argv
+    os.environ.update(environment)
+    try:
+        args = infra_service.get_args()
+        with contextlib.redirect_stdout(io.StringIO()):
+            exit_code = infra_service.run_workspace(args, working_dir, logger_name='bench.tf_apply', tenant='bench')
+    finally:
+        sys.argv = saved_argv
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
+    phases = {}
+    with open(metrics_path, 'r') as metrics_handle:
+        for line in metrics_handle:
+            record = json.loads(line)
+            if record['type'] == 'span':
+                phases[record['name']] = phases.get(record['name'], 0) + record['seconds']
+    return exit_code, phases
+
+
+def bench_tf_apply(args, work_dir):
+    ''' infra_service end to end (init, plan, apply, retries) against the fake terraform '''
+    # Terraform's output is captured by infra_service; only the benchmark's own output goes to the console.
+    logging.getLogger('bench.tf_apply').propagate = False
+    logging.getLogger('python_terraform').setLevel(logging.ERROR)
+    saved_bin_path = infra_service.terraform_bin_path
+    infra_service.terraform_bin_path = fake_terraform_wrapper(work_dir)
+    # Keep the plugin cache and spill files of these runs out of the user's home directory.
+    environment = {"TF_PLUGIN_CACHE_DIR": os.path.join(work_dir, 'plugin-cache'), "INFRA_LOG_SPILL_DIR": work_dir,
+                   "FAKE_TF_DELAY": str(args.terraform_delay)}
+    os.makedirs(environment['TF_PLUGIN_CACHE_DIR'])
+
+    results = {}
+    try:
+        for name, argv, fake_environment, prepare in apply_runs:
+            timings = []
+            phase_timings = {}
+            exit_code = None
+            for attempt in range(args.repeat):
+                working_dir = os.path.join(work_dir, f"apply-{name}-{attempt}")
+                write_fake_config(working_dir, args.resources)
+                if prepare:
+                    run_infra_service(working_dir, [], environment)
+
+                start = time.perf_counter()
+                exit_code, phases = run_infra_service(working_dir, argv, dict(environment, **fake_environment))
+                timings.append(time.perf_counter() - start)
+                for phase, seconds in phases.items():
+                    phase_timings.setdefault(phase, []).append(seconds)
+
+            results[name] = {
+                "seconds": round(statistics.median(timings), 4),
+                "exit_code": exit_code,
+                "phase_seconds": {phase: round(statistics.median(seconds), 4) for phase, seconds in sorted(phase_timings.items())}
+            }
+    finally:
+        infra_service.terraform_bin_path = saved_bin_path
+    return results
+
+
+def synthetic_ips(rng, count):
+    ''' Map of name to IP address, the shape of the *_allow lists in the vars files '''
+    return {f"host{index}": f"{rng.randrange(1, 223)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+            for index in range(count)}
+
+
+def synthetic_vars(rng, index):
+    ''' Vars for one made up tenant, with everything azuretf.jinja reads '''
+    tenant = f"bench{index:05d}"
+    environment = rng.choice(['prod', 'prod', 'dev', 'stage'])
+    return {
+        "customer": {
+            "tenant_id": tenant,
+            "name": tenant,
+            "fullname": f"Bench Tenant {index}",
+            "ecc_id": str(100000 + index),
+            "incoming_https_hosts": ["0.0.0.0/0"],
+            "cluster": {
+                "type": "mkt",
+                "environment": environment,
+                "env_number": rng.randrange(1, 5),
+                "number_of_instances": rng.choice([1, 2, 2, 3, 4, 6]),
+                "no_cloudfront": rng.random() < 0.2,
+                "db_version": rng.choice(["10", "11"]),
+                "db_username": "camp",
+                "db_sku": rng.choice(["GP_Gen5_4", "GP_Gen5_8", "MO_Gen5_16"]),
+                "db_disk_size": rng.choice([256, 512, 1024]),
+                "nlversion": "9032",
+                "subnet_id": f"/subscriptions/bench/subnets/{tenant}",
+                "instance_type": rng.choice(["Standard_D4s_v3", "Standard_D8s_v3", "Standard_E16s_v3"]),
+                "instance_disk_size": 256,
+                "extra_storage_disk_size": 128
+            }
+        },
+        "terraform": {
+            "AWS_DEFAULT_REGION": "us-west-2",
+            "azure_subscription_id": f"sub-{index % 7}",
+            "management_infra_sub_id": "sub-m",
+            "region": rng.choice(["westeurope", "northeurope", "eastus2", "westus2"]),
+            "provisioning_env": environment,
+            "vnet_space": f"10.{index // 256 % 256}.{index % 256}.0/24",
+            "management_infra_vnet_id": "/vnet/m",
+            "management_infra_vnet_resource_group": "mgmt-rg",
+            "management_infra_vnet_name": "mgmt-vnet",
+            "test_pipeline": 'False',
+            "vars": {"ssh_key": "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQ bench"}
+        },
+        "nagios_server_allow": synthetic_ips(rng, rng.randrange(1, 4)),
+        "inbound_ssh": synthetic_ips(rng, rng.randrange(1, 6)),
+        "postfix_azure_mx_allow": synthetic_ips(rng, rng.randrange(1, 5)),
+        "nagios_allow": synthetic_ips(rng, rng.randrange(1, 3)),
+        "qe_jenkins_allow": synthetic_ips(rng, rng.randrange(0, 12)),
+        "qe_ethos_allow": synthetic_ips(rng, rng.randrange(0, 4)),
+        "qe_ethos_db_allow": {"edb": "8.8.8.1-8.8.8.9"},
+        "qe_options": {"deploy_sink_qe": rng.choice(['true', 'false'])},
+        "sink_server_allow": synthetic_ips(rng, rng.randrange(0, 3)),
+        # Read by the inventory lookups, not by the template.
+        "product": rng.choice(['1', '2', '6', '7']),
+        "campaign_url": f"https://{tenant}.campaign.example.com"
+    }
+
+
+def write_synthetic_inventory(args, data_dir):
+    ''' One vars file per synthetic tenant under data_dir/vars, the layout of ANSIBLE_DATA_DIR. Returns the tenants. '''
+    rng = random.Random(args.seed)
+    vars_dir = os.path.join(data_dir, 'vars')
+    os.makedirs(vars_dir, exist_ok=True)
+    tenants = []
+    for index in range(args.tenants):
+        tenant_vars = synthetic_vars(rng, index)
+        tenant = tenant_vars['customer']['tenant_id']
+        with open(os.path.join(vars_dir, tenant + '.yml'), 'w') as vars_handle:
+            yaml.safe_dump(tenant_vars, vars_handle, default_flow_style=False)
+        tenants.append(tenant)
+    return tenants
+
+
+def bench_render(args, work_dir):
+    ''' azuretf.jinja rendered for every synthetic tenant: from nothing, again with the compiled template
+    cached, and again with nothing changed '''
+    data_dir = os.path.join(work_dir, 'render-data')
+    tenants = write_synthetic_inventory(args, data_dir)
+    vars_paths = [os.path.join(data_dir, 'vars', tenant + '.yml') for tenant in tenants]
+    output_dir = os.path.join(work_dir, 'render-out')
+    cache_dir = os.path.join(work_dir, 'render-cache')
+
+    profiles = render_config.load_profiles()
+
+    def render_all(environment, force):
+        rendered = 0
+        for vars_path in vars_paths:
+            with open(vars_path, 'r') as vars_handle:
+                context = render_config.with_pg_profile(yaml.load(vars_handle, Loader=render_config.yaml_loader), profiles)
+            tenant = os.path.splitext(os.path.basename(vars_path))[0]
+            output_path = os.path.join(output_dir, tenant, 'customer.tf')
+            rendered += render_config.render(environment, render_config.default_template, context, output_path, force)
+        return rendered
+
+    # Cold: a new process with an empty template cache and nothing rendered yet.
+    cold = []
+    for _ in range(args.repeat):
+        shutil.rmtree(output_dir, ignore_errors=True)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        start = time.perf_counter()
+        render_all(render_config.build_environment(cache_dir), False)
+        cold.append(time.perf_counter() - start)
+
+    # Warm: the compiled template comes from the bytecode cache, everything is rendered again anyway.
+    warm_seconds, _ = median_seconds(lambda: render_all(render_config.build_environment(cache_dir), True), args.repeat)
+    # Unchanged: the render manifest says every output is current.
+    unchanged_seconds, rendered = median_seconds(lambda: render_all(render_config.build_environment(cache_dir), False), args.repeat)
+
+    output_bytes = sum(os.path.getsize(os.path.join(output_dir, tenant, 'customer.tf')) for tenant in tenants)
+    return {
+        "tenants": len(tenants),
+        "output_megabytes": round(output_bytes / (1024 * 1024), 2),
+        "cold_seconds": round(statistics.median(cold), 4),
+        "cold_tenants_per_second": round(len(tenants) / statistics.median(cold), 1),
+        "warm_seconds": round(warm_seconds, 4),
+        "warm_tenants_per_second": round(len(tenants) / warm_seconds, 1),
+        "unchanged_seconds": round(unchanged_seconds, 4),
+        "unchanged_rendered": rendered
+    }
+
+
+def bench_inventory(args, work_dir):
+    ''' Tenant lookups through the inventory cache, against parsing the YAML every time as lookups used to '''
+    data_dir = os.path.join(work_dir, 'inventory-data')
+    tenants = write_synthetic_inventory(args, data_dir)
+    cache_path = os.path.join(work_dir, 'inventory.sqlite')
+
+    def parse_all():
+        for tenant in tenants:
+            with open(os.path.join(data_dir, 'vars', tenant + '.yml'), 'r') as vars_handle:
+                yaml.safe_load(vars_handle)
+
+    def get_all():
+        store = inventory_store.InventoryStore(data_dir, cache_path)
+        try:
+            for tenant in tenants:
+                store.get(tenant)
+        finally:
+            store.close()
+
+    def cold_get_all():
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        get_all()
+
+    def bulk_query():
+        store = inventory_store.InventoryStore(data_dir, cache_path)
+        try:
+            return len(store.tenants(products=['1', '2'], regions=['westeurope', 'eastus2']))
+        finally:
+            store.close()
+
+    raw_seconds, _ = median_seconds(parse_all, args.repeat)
+    cold_seconds, _ = median_seconds(cold_get_all, args.repeat)
+    warm_seconds, _ = median_seconds(get_all, args.repeat)
+    query_seconds, matched = median_seconds(bulk_query, args.repeat)
+
+    # inventory_lookup itself, as hvac.py calls it once per tenant, with the cache warm.
+    import hvac  # pylint: disable=import-outside-toplevel
+    saved_cache_dir, saved_environ = inventory_store.default_cache_dir, dict(os.environ)
+    inventory_store.default_cache_dir = os.path.join(work_dir, 'inventory-cache')
+    os.environ['ANSIBLE_DATA_DIR'] = data_dir
+    try:
+        lookup = lambda: [hvac.inventory_lookup(tenant) for tenant in tenants]  # noqa: E731
+        lookup()
+        lookup_seconds, _ = median_seconds(lookup, args.repeat)
+    finally:
+        inventory_store.default_cache_dir = saved_cache_dir
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
+    return {
+        "tenants": len(tenants),
+        "yaml_parse_seconds": round(raw_seconds, 4),
+        "cold_get_seconds": round(cold_seconds, 4),
+        "warm_get_seconds": round(warm_seconds, 4),
+        "warm_get_microseconds_per_tenant": round(warm_seconds / len(tenants) * 1e6, 1),
+        "bulk_query_seconds": round(query_seconds, 4),
+        "bulk_query_matches": matched,
+        "inventory_lookup_seconds": round(lookup_seconds, 4),
+        "inventory_lookup_microseconds_per_tenant": round(lookup_seconds / len(tenants) * 1e6, 1)
+    }
+
+
+def flatten(results, prefix=''):
+    ''' {"a": {"b": 1}} as {"a.b": 1} '''
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new):
+    ''' Print every measurement in both result sets side by side '''
+    print(f"{'':60} {old['commit'] + ('+' if old['dirty'] else ''):>14} {new['commit'] + ('+' if new['dirty'] else ''):>14}")
+    if old['parameters'] != new['parameters']:
+        print(f"Warning: the runs used different parameters: {old['parameters']} and {new['parameters']}")
+    old_flat, new_flat = flatten(old['results']), flatten(new['results'])
+    for name in sorted(set(old_flat) & set(new_flat)):
+        old_value, new_value = old_flat[name], new_flat[name]
+        change = ''
+        if (isinstance(old_value, (int, float)) and isinstance(new_value, (int, float)) and old_value
+                and not isinstance(old_value, bool) and not name.endswith('exit_code')):
+            change = f"{(new_value - old_value) / old_value:+.1%}"
+        print(f"{name:60} {old_value!s:>14} {new_value!s:>14} {change:>9}")
+
+
+def load_results(path):
+    with open(path, 'r') as results_handle:
+        return json.load(results_handle)
+
+
+def main():
+    ''' main body of the script '''
+    logging.basicConfig(level=logging.WARNING)
+    args = get_args()
+
+    if args.compare and len(args.compare) == 2:
+        compare(load_results(args.compare[0]), load_results(args.compare[1]))
+        return
+
+    commit, dirty = git_revision()
+    benchmarks = {"log_review": bench_log_review, "tf_apply": bench_tf_apply, "render": bench_render,
+                  "inventory": bench_inventory}
+
+    work_dir = tempfile.mkdtemp(prefix='infra_bench-')
+    results = {}
+    try:
+        for name in args.scenarios:
+            print(f"Running {name}...", flush=True)
+            start = time.time()
+            scenario_dir = os.path.join(work_dir, name)
+            os.makedirs(scenario_dir)
+            results[name] = benchmarks[name](args, scenario_dir)
+            print(f"{name} took {time.time() - start:.1f} seconds", flush=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "parameters": {"scenarios": args.scenarios, "repeat": args.repeat, "seed": args.seed, "log_mb": args.log_mb,
+                       "resources": args.resources, "terraform_delay": args.terraform_delay, "tenants": args.tenants},
+        "results": results
+    }
+
+    output = args.output or os.path.join(results_dir, f"{commit}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output + '.tmp', 'w') as output_handle:
+        json.dump(report, output_handle, indent=2, sort_keys=True)
+        output_handle.write('\n')
+    os.replace(output + '.tmp', output)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    print(f"Results written to {output}", flush=True)
+
+    if args.compare:
+        compare(load_results(args.compare[0]), report)
+
+
+if __name__ == "__main__":
+    main()
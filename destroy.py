@@ -1,14 +1,47 @@
 import argparse
+import fcntl
+import glob
 import json
 import os
+import random
 import subprocess
 import logging
-from cim_functions import inventory_lookup
+import time
+
+# Destroy requests on this agent are spooled here and handled together, so that concurrent pipelines
+# make one git round trip between them instead of racing each other to push.
+queue_dir = os.environ.get('DESTROY_QUEUE_DIR', os.path.expanduser('~/.cache/infra_service/destroy_queue'))
+
+# The metadata kept for each tenant in ANSIBLE_DATA_DIR.
+metadata_paths = [("vars", ".yml"), ("inventory", ".yml"), ("api_data", ".json")]
+
+push_attempts = 5
+push_backoff_seconds = 5
+
+git_identity = ["-c", "user.email=jnknsprd@or1010050155065.corp.adobe.com", "-c", "user.name=Your Obedient Servant"]
 
 
 def run():
-    target_env = parse()
-    destroy(target_env)
+    args = get_args()
+    if args.tenants or args.tenants_file:
+        target_envs = list(args.tenants or [])
+        if args.tenants_file:
+            with open(args.tenants_file) as tenants_handle:
+                target_envs += [line.strip() for line in tenants_handle if line.strip()]
+    else:
+        target_envs = [parse()]
+    destroy(target_envs)
+
+
+def get_args():
+    ''' process commandline arguments '''
+    parser = argparse.ArgumentParser(
+        description='Remove the metadata of destroyed environments from the inventory checkout')
+    parser.add_argument('--tenants', dest='tenants', action='store', nargs='+', default=None,
+                        help='Tenants to remove. Without this, or --tenants-file, the target comes from the blob environment variable')
+    parser.add_argument('--tenants-file', dest='tenants_file', action='store', default=None,
+                        help='File with one tenant to remove per line')
+    return parser.parse_args()
 
 
 def parse() -> dict:
@@ -36,9 +69,8 @@ def parse() -> dict:
     return target_env
 
 
-def destroy(target_env: dict):
-    ''' destroy metadata from the environment that was checked into git'''
-    # delete vars, inventory, and API data json
+def destroy(target_envs: list):
+    ''' destroy metadata from the environments that were checked into git'''
     try:
         data_dir = os.environ['ANSIBLE_DATA_DIR']
         job_name = os.environ['JOB_NAME']
@@ -46,27 +78,124 @@ def destroy(target_env: dict):
     except KeyError:
         logging.error("ANSIBLE_DATA_DIR environmental variable not found")
         exit(1)
+
+    request_path = spool_request(target_envs, f"{job_name} {build_number}")
+    result = process_queue(data_dir, request_path)
+
+    if result['success']:
+        logging.info(f"metadata for {len(target_envs)} tenants removed in {result['commit'] or 'no commit (nothing to remove)'}")
+    else:
+        logging.error(f"failed to delete files from git! {result['error']}")
+        exit(1)
+
+
+def spool_request(target_envs: list, requested_by: str) -> str:
+    ''' queue a destroy request for whoever handles the queue next '''
+    os.makedirs(queue_dir, exist_ok=True)
+    request_path = os.path.join(queue_dir, f"{time.time():.6f}-{os.getpid()}.request.json")
+    with open(request_path + '.tmp', 'w') as request_handle:
+        json.dump({"tenants": target_envs, "requested_by": requested_by}, request_handle)
+    os.replace(request_path + '.tmp', request_path)
+    return request_path
+
+
+def process_queue(data_dir: str, request_path: str) -> dict:
+    ''' handle every queued request, including ours, unless the last holder of the lock already did '''
+    result_path = request_path.replace('.request.json', '.result.json')
+
+    with open(os.path.join(queue_dir, '.leader.lock'), 'w') as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+
+        if os.path.exists(request_path):
+            request_paths = sorted(glob.glob(os.path.join(queue_dir, '*.request.json')))
+            queued = []
+            for path in request_paths:
+                with open(path) as request_handle:
+                    queued.append(json.load(request_handle))
+
+            target_envs = sorted(set(tenant for request in queued for tenant in request['tenants']))
+            requested_by = ', '.join(request['requested_by'] for request in queued)
+            logging.info(f"removing metadata for {len(target_envs)} tenants from {len(queued)} destroy requests")
+
+            result = commit_removals(data_dir, target_envs, requested_by)
+
+            for path in request_paths:
+                with open(path.replace('.request.json', '.result.json'), 'w') as result_handle:
+                    json.dump(result, result_handle)
+                os.remove(path)
+        else:
+            logging.info("destroy request was handled together with another pipeline's")
+
+    with open(result_path) as result_handle:
+        result = json.load(result_handle)
+    os.remove(result_path)
+    return result
+
+
+def git(data_dir: str, *args):
+    return subprocess.run(["git"] + list(args), cwd=data_dir, check=True, capture_output=True, text=True)
+
+
+def remove_metadata(data_dir: str, target_envs: list) -> list:
+    ''' delete vars, inventory, and API data json. Returns the paths that were there '''
+    removed = []
+    for target_env in target_envs:
+        for sub_dir, suffix in metadata_paths:
+            path = os.path.join(sub_dir, target_env + suffix)
+            try:
+                os.remove(os.path.join(data_dir, path))
+                removed.append(path)
+            except FileNotFoundError:
+                logging.info(f"{path} already gone")
+    return removed
+
+
+def restore_checkout(data_dir: str, ref: str):
+    ''' put the checkout back to ref, out of any rebase a failed pull left it in, so the next run can pull '''
+    for args in [("rebase", "--abort"), ("reset", "--hard", ref)]:
+        try:
+            git(data_dir, *args)
+        except subprocess.CalledProcessError as e:
+            # There is no rebase to abort most of the time.
+            logging.debug(f"git {' '.join(args)}: {(e.stderr or '').strip()}")
+
+
+def commit_removals(data_dir: str, target_envs: list, requested_by: str) -> dict:
+    ''' remove the tenants' metadata and push it as one commit, rebasing onto whatever got pushed meanwhile.
+    On failure the checkout goes back to origin/master; the requests fail and are done again when they are retried. '''
     try:
+        # Deletions a killed run never committed are redone below. A commit it never pushed is kept and pushed.
+        restore_checkout(data_dir, "HEAD")
+        git(data_dir, "pull", "--rebase", "origin", "master")
+
         logging.info("deleting metadata files...")
-        os.chdir(f"{data_dir}")
-        subprocess.run(["rm", f"vars/{target_env}.yml"])
-        subprocess.run(["rm", f"inventory/{target_env}.yml"])
-        subprocess.run(["rm", f"api_data/{target_env}.json"])
-    except CalledProcessError as e:
-        logging.error(f"failed to delete localfiles! {e}")
-    try:
-        subprocess.run(["git", "config", "--global", "user.email",
-                       "'jnknsprd@or1010050155065.corp.adobe.com'"])
-        subprocess.run(["git", "config", "--global",
-                       "user.name", "'Your Obedient Servant'"])
-        subprocess.run(
-            ["git", "branch", "--set-upstream-to=origin/master", "master"])
-        subprocess.run(["git", "pull"])
-        subprocess.run(["git", "add", "-A"])
-        subprocess.run(["git", "commit", "-m", f"'Auto commit of campaign-infrastructure-destruction pipeline {job_name} {build_number}'"])
-        subprocess.run(["git", "push", "--set-upstream", "origin", "master"])
-    except CalledProcessError as e:
-        logging.error(f"failed to delete files from git! {e}")
+        removed = remove_metadata(data_dir, target_envs)
+        if removed:
+            git(data_dir, "add", "-A", "--", *removed)
+            git(data_dir, *git_identity, "commit", "-m",
+                f"Auto commit of campaign-infrastructure-destruction pipeline {requested_by}")
+        elif git(data_dir, "rev-list", "--count", "origin/master..HEAD").stdout.strip() == "0":
+            return {"success": True, "commit": None, "error": None}
+        else:
+            logging.info("metadata already gone, but not pushed yet")
+        commit = git(data_dir, "rev-parse", "--short", "HEAD").stdout.strip()
+
+        for attempt in range(1, push_attempts + 1):
+            try:
+                git(data_dir, "push", "origin", "HEAD:master")
+                return {"success": True, "commit": commit, "error": None}
+            except subprocess.CalledProcessError as e:
+                if attempt == push_attempts:
+                    raise
+                # Someone else pushed first. Replay our commit on top of theirs and go again.
+                logging.info(f"push attempt {attempt} rejected, rebasing: {e.stderr.strip()}")
+                time.sleep(random.uniform(0, push_backoff_seconds * attempt))
+                git(data_dir, "pull", "--rebase", "origin", "master")
+                commit = git(data_dir, "rev-parse", "--short", "HEAD").stdout.strip()
+
+    except subprocess.CalledProcessError as e:
+        restore_checkout(data_dir, "origin/master")
+        return {"success": False, "commit": None, "error": f"{' '.join(e.cmd)}: {(e.stderr or '').strip()}"}
 
 
 if __name__ == "__main__":
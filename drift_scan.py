@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+'''
+Read-only drift scan across every customer environment in a batch directory (the --batch-dir layout of
+infra_service.py). Each environment gets a terraform plan that neither locks nor writes its state, and the
+outcome goes into a local index: when it was last scanned, what would change and what went wrong.
+
+Scans are incremental. Environments that were scanned recently are skipped, the rest go in order of how
+stale their last scan is (environments that drifted or whose config changed go first), and a scan stops
+starting new plans when its deadline is near. The next scan picks up where the last one stopped.
+'''
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from python_terraform import Terraform, IsFlagged
+
+import infra_service
+from inventory_store import InventoryStore
+from tf_cache import plan_fingerprint
+from tf_output import planned_resources
+
+# pylint: disable=line-too-long
+
+default_index_dir = os.environ.get('DRIFT_INDEX_DIR', os.path.expanduser('~/.cache/infra_service/drift'))
+
+# Azure Resource Manager allows about 12000 reads an hour per subscription, and a refresh reads every
+# resource in the state at least once.
+default_reads_per_hour = 12000
+
+# Plans terraform runs concurrently inside one scan (terraform's own default is 10).
+default_terraform_parallelism = 5
+
+scan_log_file = 'drift_scan.log'
+
+
+def get_args():
+    ''' process commandline arguments '''
+    parser = argparse.ArgumentParser(
+        description='Plan every customer environment read-only and record which ones have drifted')
+    parser.add_argument('--batch-dir', dest='batch_dir', action='store', required=True,
+                        help='Directory with one rendered config (and its state) per customer environment')
+    parser.add_argument('--customer-env', dest='customer_envs', action='store', nargs='+', default=None,
+                        help='Only scan these customer environments')
+    parser.add_argument('--data-dir', dest='data_dir', action='store', default=os.environ.get('ANSIBLE_DATA_DIR'),
+                        help='Inventory to take the customer environments from (default $ANSIBLE_DATA_DIR); '
+                             'without it every directory in --batch-dir is scanned')
+    parser.add_argument('--products', dest='products', action='store', nargs='+', default=None,
+                        help='With --data-dir, only scan customer environments with these products')
+    parser.add_argument('--regions', dest='regions', action='store', nargs='+', default=None,
+                        help='With --data-dir, only scan customer environments in these regions')
+    parser.add_argument('--index', dest='index_path', action='store', default=None,
+                        help='SQLite file the results are kept in (default: one per batch dir under $DRIFT_INDEX_DIR)')
+    parser.add_argument('--max-parallel', dest='max_parallel', action='store', type=infra_service.positive_int, default=8,
+                        help='How many plans run at once')
+    parser.add_argument('--max-per-subscription', dest='max_per_subscription', action='store', type=infra_service.positive_int, default=2,
+                        help='How many plans in the same Azure subscription run at once')
+    parser.add_argument('--reads-per-hour', dest='reads_per_hour', action='store', type=float, default=default_reads_per_hour,
+                        help='Azure API reads allowed per subscription per hour; plans wait for their share')
+    parser.add_argument('--terraform-parallelism', dest='terraform_parallelism', action='store', type=infra_service.positive_int,
+                        default=default_terraform_parallelism, help='Concurrent API operations within one plan')
+    parser.add_argument('--min-interval', dest='min_interval', action='store', type=float, default=20 * 3600,
+                        help='Seconds after a scan before the same environment is scanned again')
+    parser.add_argument('--change-boost', dest='change_boost', action='store', type=float, default=24 * 3600,
+                        help='Environments that drifted, failed or changed config are scanned as if their last scan '
+                             'was this many seconds older')
+    parser.add_argument('--time-budget', dest='time_budget', action='store', type=float, default=None,
+                        help='Seconds the scan may take. No plan is started that is not expected to finish in time')
+    parser.add_argument('--report', dest='report', action='store', default=None,
+                        help='Also write the index to this file as JSON once the scan is over')
+    return parser.parse_args()
+
+
+class DriftIndex:
+    ''' What the last scan of each customer environment found, in a SQLite file '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS drift (
+                                           tenant TEXT PRIMARY KEY,
+                                           subscription TEXT,
+                                           last_scan REAL NOT NULL,
+                                           scan_seconds REAL NOT NULL,
+                                           fingerprint TEXT,
+                                           exit_code INTEGER NOT NULL,
+                                           result TEXT NOT NULL,
+                                           changed_count INTEGER NOT NULL,
+                                           changes TEXT NOT NULL,
+                                           error_line TEXT,
+                                           last_change REAL)''')
+
+    def close(self):
+        self.connection.close()
+
+    def entries(self):
+        ''' Map of tenant to its last scan '''
+        columns = ['tenant', 'subscription', 'last_scan', 'scan_seconds', 'fingerprint', 'exit_code', 'result',
+                   'changed_count', 'changes', 'error_line', 'last_change']
+        with self.lock:
+            rows = self.connection.execute(f"SELECT {', '.join(columns)} FROM drift ORDER BY tenant").fetchall()
+        entries = collections.OrderedDict()
+        for row in rows:
+            entry = dict(zip(columns, row))
+            entry['changes'] = json.loads(entry['changes'])
+            entries[entry['tenant']] = entry
+        return entries
+
+    def record(self, scan, previous):
+        ''' Store the outcome of one scan. last_change moves whenever what the plan would change is different. '''
+        last_change = previous['last_change'] if previous else None
+        if previous is None or previous['changes'] != scan['changes']:
+            last_change = scan['last_scan']
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO drift VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (scan['tenant'], scan['subscription'], scan['last_scan'], scan['scan_seconds'],
+                                     scan['fingerprint'], scan['exit_code'], scan['result'], len(scan['changes']),
+                                     json.dumps(scan['changes'], sort_keys=True), scan['error_line'], last_change))
+
+
+class TokenBucket:
+    ''' Azure API reads per subscription. A plan takes as many tokens as it is expected to make reads. '''
+
+    def __init__(self, per_hour):
+        self.capacity = per_hour / 4
+        self.rate = per_hour / 3600
+        self.tokens = collections.defaultdict(lambda: self.capacity)
+        self.updated = collections.defaultdict(time.monotonic)
+
+    def _fill(self, subscription):
+        now = time.monotonic()
+        self.tokens[subscription] = min(self.capacity, self.tokens[subscription] + (now - self.updated[subscription]) * self.rate)
+        self.updated[subscription] = now
+
+    def wait_seconds(self, subscription, cost):
+        ''' How long until a plan of this cost can start. A plan bigger than the bucket waits for a full bucket. '''
+        self._fill(subscription)
+        missing = min(cost, self.capacity) - self.tokens[subscription]
+        return max(0.0, missing / self.rate)
+
+    def take(self, subscription, cost):
+        self._fill(subscription)
+        self.tokens[subscription] -= min(cost, self.capacity)
+
+
+def default_index_path(batch_dir):
+    ''' One index per batch dir, kept out of the batch dir itself '''
+    batch_dir_id = hashlib.sha256(os.path.abspath(batch_dir).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(default_index_dir, f"drift-{batch_dir_id}.sqlite")
+
+
+def state_reads(working_dir):
+    ''' Roughly how many API reads refreshing this environment takes: one per resource instance in its state '''
+    state_path = os.path.join(working_dir, 'terraform.tfstate')
+    if not os.path.exists(state_path):
+        return 1
+    with open(state_path, 'r') as state_handle:
+        try:
+            state = json.load(state_handle)
+        except ValueError:
+            return 1
+    return max(1, sum(len(resource.get('instances', [])) if isinstance(resource, dict) else 1
+                      for resource in state.get('resources', [])))
+
+
+def set_terraform_bin(terraform_bin):
+    ''' Scan process initializer '''
+    infra_service.terraform_bin_path = terraform_bin
+
+
+def scan_tenant(tenant, working_dir, terraform_parallelism):
+    ''' Scan process: plan one environment without locking or saving anything, and describe the outcome '''
+    start = time.time()
+    terra = Terraform(working_dir=working_dir, terraform_bin_path=infra_service.terraform_bin_path)
+
+    with open(os.path.join(working_dir, scan_log_file), 'w') as log_handle, contextlib.redirect_stdout(log_handle):
+        infra_service.tf_init(terra)
+        # No -out: the plan infra_service saved, and its plan cache, stay as they are.
+        plan_code, plan_stdout, plan_stderr = terra.plan(detailed_exitcode=IsFlagged, lock=False, input=False,
+                                                         parallelism=terraform_parallelism)
+        print(plan_stdout, flush=True)
+        print(plan_stderr, flush=True)
+
+    scan = {"tenant": tenant, "last_scan": start, "scan_seconds": round(time.time() - start, 1), "changes": {},
+            "error_line": None}
+    if plan_code in [0, 2]:
+        scan['exit_code'] = infra_service.exit_codes['SUCCESS']
+        scan['result'] = 'DRIFTED' if plan_code == 2 else 'CLEAN'
+        scan['changes'] = planned_resources(plan_stdout)
+        return scan
+
+    # The same classification infra_service gives a failed plan: the last line the error catalog knows.
+    scan['exit_code'] = infra_service.exit_codes['I_HAVE_NO_CLUE']
+    for line in reversed((plan_stdout + '\n' + plan_stderr).splitlines()):
+        entry = infra_service.classify_line(line)
+        if entry is not None:
+            scan['exit_code'] = infra_service.exit_codes[entry['exit_code']]
+            scan['error_line'] = line.strip()
+            break
+    scan['result'] = infra_service.exit_code_names[scan['exit_code']]
+    return scan
+
+
+def tenant_fingerprint(working_dir):
+    ''' plan_fingerprint of an environment, as infra_service would compute it for a create plan '''
+    return plan_fingerprint(Terraform(working_dir=working_dir, terraform_bin_path=infra_service.terraform_bin_path), False)
+
+
+def failed_scan(tenant, started, error):
+    ''' The record of a scan whose process failed, so that it counts as scanned (and failed) like a plan that failed '''
+    return {"tenant": tenant, "last_scan": started, "scan_seconds": round(time.time() - started, 1), "changes": {},
+            "exit_code": infra_service.exit_codes['I_HAVE_NO_CLUE'], "result": infra_service.exit_code_names[infra_service.exit_codes['I_HAVE_NO_CLUE']],
+            "error_line": f"scan failed: {error}"}
+
+
+def scan_order(tenants, entries, fingerprints, args, now):
+    ''' The tenants that are due a scan, the stalest first '''
+    due = []
+    for tenant in tenants:
+        entry = entries.get(tenant)
+        if entry is None:
+            due.append((float('-inf'), tenant))
+            continue
+        changed = entry['fingerprint'] != fingerprints[tenant]
+        if now - entry['last_scan'] < args.min_interval and not changed:
+            continue
+        effective_scan = entry['last_scan']
+        if changed or entry['changed_count'] or entry['result'] not in ['CLEAN', 'DRIFTED']:
+            effective_scan -= args.change_boost
+        due.append((effective_scan, tenant))
+    return [tenant for _, tenant in sorted(due)]
+
+
+def inventory_tenants(args):
+    ''' Customer environments to consider: the inventory's (filtered) where there is one, else the batch dir's '''
+    batch_dir = os.path.abspath(args.batch_dir)
+    present = sorted(name for name in os.listdir(batch_dir) if os.path.isdir(os.path.join(batch_dir, name)))
+    if args.customer_envs:
+        return [tenant for tenant in args.customer_envs if tenant in present]
+    if not args.data_dir:
+        return present
+
+    store = InventoryStore(args.data_dir)
+    try:
+        known = set(store.tenants(products=args.products, regions=args.regions))
+    finally:
+        store.close()
+    return [tenant for tenant in present if tenant in known]
+
+
+def run_scan(args):
+    ''' Scan whatever is due, within the limits and the time budget. Returns the scans made. '''
+    batch_dir = os.path.abspath(args.batch_dir)
+    start = time.time()
+    deadline = start + args.time_budget if args.time_budget else None
+
+    index = DriftIndex(args.index_path or default_index_path(batch_dir))
+    entries = index.entries()
+
+    tenants = inventory_tenants(args)
+    working_dirs = {tenant: os.path.join(batch_dir, tenant) for tenant in tenants}
+    # Each fingerprint reads the state with terraform (state pull), so they are taken side by side.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_parallel) as fingerprint_pool:
+        fingerprints = dict(zip(tenants, fingerprint_pool.map(tenant_fingerprint, [working_dirs[tenant] for tenant in tenants])))
+    pending = collections.deque(scan_order(tenants, entries, fingerprints, args, start))
+
+    print(f"{len(pending)} of {len(tenants)} customer environments are due a drift scan. Index: {index.path}", flush=True)
+
+    infra_service.share_plugin_cache()
+    bucket = TokenBucket(args.reads_per_hour)
+    subscriptions = {tenant: infra_service.tenant_subscription(working_dirs[tenant]) for tenant in pending}
+    subscription_load = collections.Counter()
+    running = {}
+    started = {}
+    scans = []
+    skipped = 0
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.max_parallel, initializer=set_terraform_bin,
+                                                initargs=(infra_service.terraform_bin_path,)) as pool:
+        while pending or running:
+            wait_seconds = None
+            for tenant in list(pending):
+                if len(running) >= args.max_parallel:
+                    break
+                subscription = subscriptions[tenant]
+                if subscription_load[subscription] >= args.max_per_subscription:
+                    continue
+
+                # Leave anything that would run past the deadline to the next scan. Its last duration is the best guess.
+                expected = entries[tenant]['scan_seconds'] if tenant in entries else 0
+                if deadline is not None and time.time() + expected > deadline:
+                    pending.remove(tenant)
+                    skipped += 1
+                    continue
+
+                cost = state_reads(working_dirs[tenant])
+                delay = bucket.wait_seconds(subscription, cost)
+                if delay > 0:
+                    wait_seconds = delay if wait_seconds is None else min(wait_seconds, delay)
+                    continue
+
+                bucket.take(subscription, cost)
+                pending.remove(tenant)
+                subscription_load[subscription] += 1
+                future = pool.submit(scan_tenant, tenant, working_dirs[tenant], args.terraform_parallelism)
+                running[future] = tenant
+                started[future] = time.time()
+
+            if not running:
+                if pending:
+                    time.sleep(min(wait_seconds or 1, 60))
+                continue
+
+            done, _ = concurrent.futures.wait(running, timeout=wait_seconds, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                tenant = running.pop(future)
+                subscription_load[subscriptions[tenant]] -= 1
+                try:
+                    scan = future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    # Recorded like a failed plan. Left out of the index, it would look never scanned and go first every time.
+                    print(f"{tenant}: scan failed: {error}", flush=True)
+                    scan = failed_scan(tenant, started[future], error)
+                del started[future]
+                scan['subscription'] = subscriptions[tenant]
+                scan['fingerprint'] = fingerprints[tenant]
+                # Recorded straight away, so an interrupted scan loses nothing already done.
+                index.record(scan, entries.get(tenant))
+                scans.append(scan)
+                print(f"{tenant}: {scan['result']}, {len(scan['changes'])} changes, {scan['scan_seconds']:.0f} seconds", flush=True)
+
+    print("------------------------------------------------------", flush=True)
+    results = collections.Counter(scan['result'] for scan in scans)
+    print(f"Scanned {len(scans)} customer environments in {time.time() - start:.0f} seconds: "
+          f"{', '.join(f'{count} {result}' for result, count in sorted(results.items())) or 'nothing to do'}", flush=True)
+    if skipped:
+        print(f"{skipped} left for the next scan, as they would not have finished in time", flush=True)
+    print("------------------------------------------------------", flush=True)
+
+    if args.report:
+        with open(args.report + '.tmp', 'w') as report_handle:
+            json.dump(index.entries(), report_handle, indent=2, sort_keys=True)
+        os.replace(args.report + '.tmp', args.report)
+
+    index.close()
+    return scans
+
+
+def main():
+    ''' main body of the script '''
+    logging.basicConfig(level=logging.INFO)
+    args = get_args()
+    scans = run_scan(args)
+    if all(scan['exit_code'] == infra_service.exit_codes['SUCCESS'] for scan in scans):
+        exit(0)
+    else:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+'''
+Load the terraform error catalog and compile its patterns for classifying log lines.
+'''
+
+import os
+import re
+
+import yaml
+
+default_catalog_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'error_catalog.yml')
+
+
+class ErrorCatalog:
+    ''' A list of catalog entries with their patterns compiled once, checked against a line in catalog order '''
+
+    def __init__(self, entries):
+        self.entries = entries
+
+        # A plain search per pattern. Folding them into one alternation looks cheaper, but keeping catalog
+        # order then means anchoring every branch with a leading .*?, and the engine rescans the line for
+        # each branch anyway, which is much slower on the ordinary lines that match nothing.
+        self.patterns = [(re.compile(entry['pattern']), entry) for entry in entries]
+
+    def classify(self, line):
+        ''' Return the first catalog entry matching the line, or None '''
+        for pattern, entry in self.patterns:
+            if pattern.search(line):
+                return entry
+        return None
+
+
+def load_catalog(path=None, known_codes=None):
+    ''' Read and validate the catalog data file. The path defaults to $INFRA_ERROR_CATALOG, then the
+    catalog shipped next to this file. '''
+
+    if path is None:
+        path = os.environ.get('INFRA_ERROR_CATALOG', default_catalog_path)
+
+    with open(path, 'r') as catalog_handle:
+        entries = yaml.safe_load(catalog_handle) or []
+
+    for entry in entries:
+        for key in ['name', 'pattern', 'exit_code']:
+            if key not in entry:
+                raise ValueError(f"Error catalog entry {entry} in {path} is missing '{key}'")
+
+        if known_codes is not None and entry['exit_code'] not in known_codes:
+            raise ValueError(f"Error catalog entry {entry['name']} has unknown exit code {entry['exit_code']}")
+
+        entry.setdefault('retryable', False)
+        entry.setdefault('fatal', False)
+        entry.setdefault('message', None)
+
+    return ErrorCatalog(entries)
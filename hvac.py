@@ -1,22 +1,26 @@
-import time
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-import hvac
 import logging
 import os
 import argparse
-import yaml 
 import json
 
+from inventory_store import InventoryStore
+from login_check import run_login_checks, default_concurrency, default_ready_timeout_seconds
+from vault_cache import VaultCache
+
 def run():
+    args = get_args()
     try:
-        args = get_args()
-        api_data = inventory_lookup(args.customer_env, args.localfile)
-        if api_data.get('product') == '6' or api_data.get('product') == '7':
+        tenants = []
+        for customer_env in args.customer_envs:
+            api_data = inventory_lookup(customer_env, args.localfile)
+            if api_data.get('product') == '6' or api_data.get('product') == '7':
+                print("INFO: Skipping {}, its product has no campaign login".format(customer_env))
+                continue
+            tenants.append((customer_env, api_data))
+        if not tenants:
             return
-        connect_vault()
-        #setup_webdriver()
-        check_login_success(api_data)
+        with connect_vault() as vault:
+            check_login_success(vault, tenants, args)
     except Exception as e:
         print("ERROR: Testing failed! {}".format(e))
         failure(args.fail_hard)
@@ -28,12 +32,17 @@ def get_args():
     ''' process commandline arguments '''
     parser = argparse.ArgumentParser(
         description='Get Command line arguments for full inventory generator')
-    parser.add_argument('--customer-env', dest='customer_env', action='store', required=True,
-                        help='Full path to ansible vars file')
+    parser.add_argument('--customer-env', dest='customer_envs', action='store', required=True, nargs='+',
+                        help='Customer environments to check (names of ansible vars files)')
     parser.add_argument('--localfile', dest='localfile', action='store',
                         required=False, help='Path to local json file')
     parser.add_argument('--fail-hard', dest='fail_hard', action='store_true', default=False,
                         help='If you pass this arg, the script will exit 1 if the test fails')
+    parser.add_argument('--concurrency', dest='concurrency', action='store', type=int, default=default_concurrency,
+                        help='How many instances are checked at once')
+    parser.add_argument('--ready-timeout', dest='ready_timeout', action='store', type=float,
+                        default=default_ready_timeout_seconds,
+                        help='Seconds an instance gets to start serving its login page')
     return parser.parse_args()
 
 def inventory_lookup(customer_env, localfile=None):
@@ -66,20 +75,19 @@ def inventory_lookup(customer_env, localfile=None):
             logging.error("ANSIBLE_DATA_DIR environmental variable not found")
             exit(1)
 
-        inventory_file = "{}.yml".format(customer_env)
-        inventory_path = os.path.join(ansible_data_dir, "vars", inventory_file)
-
-        api_data = {}
-
-        if os.path.exists(inventory_path):
-            with open(inventory_path, 'r') as inventory_handle:
-                api_data = yaml.load(inventory_handle)
+        # Parsed vars files are cached (see inventory_store.py), so this only parses the file if it changed.
+        store = InventoryStore(ansible_data_dir)
+        try:
+            api_data = store.get(customer_env)
+        finally:
+            store.close()
 
-                api_data['tenanturl'] = api_data['campaign_url']
+        if api_data is not None:
+            api_data['tenanturl'] = api_data['campaign_url']
 
-                return api_data
+            return api_data
         else:
-            logging.error("%s not found in %s", inventory_file, ansible_data_dir)
+            logging.error("%s.yml not found in %s", customer_env, os.path.join(ansible_data_dir, "vars"))
             exit(1)
 
 def failure(fail_hard):
@@ -89,98 +97,56 @@ def failure(fail_hard):
         exit(0)
 
 def connect_vault():
-    global vault
-    adobe_vault_url = ''
+    adobe_vault_url = os.environ.get('VAULT_ADDR', '')
+
+    if 'VAULT_TOKEN' not in os.environ:
+        print("ERROR: VAULT_TOKEN environment variable not set. Exiting.")
+        exit(1)
+
+    # One pooled session for every secret read by this run. Secrets are cached for their lease, on disk
+    # too if VAULT_CACHE_PATH and VAULT_CACHE_KEY are set (see vault_cache.py).
     try:
-        vault = hvac.Client(adobe_vault_url)
+        vault = VaultCache(adobe_vault_url, os.environ['VAULT_TOKEN'])
         print('INFO: Established connection to CST Vault')
     except Exception as error:
         print('ERROR: Vault connection failed. Maybe the token is expired?')
         print(error)
         exit(1)
-
-    if 'VAULT_TOKEN' in os.environ:
-        vault.token = os.environ['VAULT_TOKEN']
+    return vault
+
+# Log in to every instance over HTTP and ensure that the UI is loaded
+def check_login_success(vault, tenants, args):
+    # Every tenant's secret in one go; tenants sharing a secret path share the read.
+    secrets = vault.read_many([vars_data['vault_secret_path'] for _, vars_data in tenants])
+
+    checks = []
+    results = []
+    for customer_env, vars_data in tenants:
+        vault_secret_path = vars_data['vault_secret_path']
+        secret = secrets.get(vault_secret_path)
+        # A tenant without its secret can't be checked, which is a failure of its own, not a reason to stop checking the rest.
+        if secret is None or 'admin' not in (secret.get('data') or {}):
+            results.append({"tenant": customer_env, "url": vars_data['tenanturl'], "success": False,
+                            "reason": "no admin password in Vault at {}".format(vault_secret_path), "seconds": 0})
+            continue
+        checks.append({
+            "tenant": customer_env,
+            "url": vars_data['tenanturl'],
+            "username": 'admin',
+            "password": secret['data']['admin']
+        })
+
+    if checks:
+        results += run_login_checks(checks, args.concurrency, args.ready_timeout)
+
+    for result in results:
+        status = "Login successful!" if result['success'] else "Login failed!"
+        print("{}: {} {} ({} after {}s)".format(result['tenant'], status, result['url'], result['reason'], result['seconds']))
+
+    if all(result['success'] for result in results):
+        exit(0)
     else:
-        print("ERROR: VAULT_TOKEN environment variable not set. Exiting.")
-        exit(1)
-
-def setup_webdriver():
-    global driver
-    #chrome_options = Options()
-    #chrome_options.add_argument('--headless')
-    #chrome_options.add_argument('--no-sandbox')
-    #chrome_options.add_argument('--disable-dev-shm-usage')
-    try:
-        #driver = webdriver.Chrome('/usr/local/bin/chromedriver',chrome_options=chrome_options)
-        driver = webdriver.Chrome()
-    except Exception as e:
-        print ("err==>>",e)
-        #print("Failed to initialize selenium webdriver! Are the selenium driver and Chrome properly installed?")
-
-def login(instance_url, username, password):
-    driver = None
-    chrome_options = Options()
-    chrome_options.add_argument('--headless')
-    chrome_options.add_argument('--no-sandbox')
-    chrome_options.add_argument('--disable-dev-shm-usage')
-    
-    try:
-        driver = webdriver.Chrome('/usr/local/bin/chromedriver', chrome_options=chrome_options)
-    except Exception as e:
-        print ("err==>>",e)
-        #print("Failed to initialize selenium webdriver! Are the selenium driver and Chrome properly installed?")
-    
-    login_url = instance_url + "/xtk/logon.jssp?ims=0"
-    print("connecting to {}".format(login_url))
-    driver.get(login_url)
-    time.sleep(3) # Let the user actually see something!
-    login_box = driver.find_element_by_css_selector('#username')
-    login_box.send_keys(username)
-    password_box = driver.find_element_by_css_selector('#password')
-    password_box.send_keys(password)
-    password_box.submit()
-    time.sleep(4) # Let the user actually see something!
-
-def check_element_exists(element):
-    try:
-        driver.find_element_by_css_selector(element)
-        return True
-    except Exception as e:
-        print(e)
-        return False
-
-def check_for_text(text):
-    try:
-        if (text in driver.page_source):
-            return True
-        else:
-            return False
-    except Exception as e:
-        print("failed to find text on page! {}".format(e))
-
-# Log in and ensure that the UI is loaded
-def check_login_success(vars_data):
-    camp_instance_url = vars_data['tenanturl']
-    vault_secret_path = vars_data['vault_secret_path']
-    admin_username = 'admin'
-    admin_password = vault.read(vault_secret_path)['data']['admin']
-
-    try:
-        login(camp_instance_url, admin_username, admin_password)
-        if check_element_exists('#') or check_for_text('Your instance has been upgraded to repo'):
-            print("Login successful!")
-            driver.quit()
-            exit(0)
-        else:
-            print("Login failed!")
-            print("Selenium test failure! Is the campaign application running?")
-            driver.quit()
-            failure(args.fail_hard)
-
-    except Exception as e:
-        print("login test failed! {}".format(e))
-        driver.quit()
+        print("Login test failure! Is the campaign application running?")
         failure(args.fail_hard)
 
 if __name__ == "__main__":
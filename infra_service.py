@@ -6,14 +6,36 @@ Create, alter and destroy Azure resources.
 import os
 import logging
 import argparse
-import io
 import re
 import time
+import json
+import fcntl
+import contextlib
+import collections
+import concurrent.futures
+import random
+import shutil
+import signal
+import subprocess
+import threading
 
 from python_terraform import *
 
+from error_catalog import load_catalog
+from log_capture import SegmentedLogCapture
+from tf_output import planned_resources, completed_resources, unfinished_resources, failed_resources, refreshed_resources, resource_type
+from tf_cache import working_dir_of, plan_fingerprint, load_cached_plan, save_cached_plan, clear_cached_plan, record_applied_plan
+from tf_cache import init_requirements, init_is_current, load_init_marker, record_init
+from tf_cache import record_refresh, stale_resources
+from metrics import RunMetrics, collecting, span, timed, record_resources
+from plan_analysis import load_plan, protected_resource_types
+from stack_layers import layer_names, layer_dependencies, layer_dependents, layer_waves
+from stack_layers import state_file, resource_address, resource_layers
+
 # pylint: disable=logging-fstring-interpolation,line-too-long,anomalous-backslash-in-string,no-else-return
 
+terraform_bin_path = "/usr/local/bin/terraform-v12"
+
 # placeholder codes are temporary. real codes will be put in when we build the standalone microservice.
 # Jenkins has no way to raise these today, so they have no actual value.
 
@@ -25,29 +47,150 @@ exit_codes = {
     "GENERIC_FAILURE": 10005,
     "I_HAVE_NO_CLUE": 10006,
     "RETRYABLE_ERROR": 10007,
-    "VM_CORE_QUOTA": 10008
+    "VM_CORE_QUOTA": 10008,
+    "UNEXPECTED_DESTROY": 10009
 }
 
-def get_args():
-    ''' process commandline arguments '''
+exit_code_names = {code: name for name, code in exit_codes.items()}
+
+# Known terraform output signatures. The catalog lives in error_catalog.yml so that new Azure errors
+# can be added without touching this file. Its patterns are compiled once, here.
+catalog = load_catalog(known_codes=exit_codes)
+
+# Codes that are worth another terraform attempt.
+retryable_codes = set(exit_codes[entry['exit_code']] for entry in catalog.entries if entry['retryable'])
+
+# Lines that are just noise in the detailed output.
+refreshing_regexp = re.compile('Refreshing\s+state')
+
+# How many times terraform apply/destroy is attempted, and how long to back off between attempts.
+# The delay before attempt n is a random value up to backoff_seconds * 2^(n-2), capped at max_backoff_seconds.
+default_retry_policy = {
+    "max_attempts": 3,
+    "backoff_seconds": 15,
+    "max_backoff_seconds": 300
+}
+
+# How much of the state plan refreshes first. full refreshes everything, none nothing, and ttl only the
+# resources that were last refreshed more than ttl_seconds ago. Destroy plans always refresh everything.
+refresh_modes = ['full', 'none', 'ttl']
+default_refresh_policy = {
+    "mode": "full",
+    "ttl_seconds": 3600
+}
+
+# The plan is saved here, relative to the working directory, and exactly this plan is applied.
+plan_file = 'tfplan'
+
+# How long terraform gets to shut down cleanly after an early abort before it is terminated.
+abort_grace_seconds = 120
+
+def positive_int(value):
+    ''' argparse type for counts that must be at least 1 '''
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return number
+
+def non_negative_int(value):
+    ''' argparse type for counts that can be zero but not negative '''
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative, not {value}")
+    return number
+
+def non_negative_float(value):
+    ''' argparse type for delays and ages that can be zero but not negative '''
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative, not {value}")
+    return number
+
+def get_args(argv=None):
+    ''' process commandline arguments (sys.argv, or argv if given) '''
     parser = argparse.ArgumentParser(
                 description='Get Command line arguments for infrastructure management tool')
     parser.add_argument('--destroy', dest='action_destroy', action='store_true',
                         default=False, help='Execute a destroy action')
     parser.add_argument('--apply', dest='action_apply', action='store_true',
                         default=False, help='Actually do the work')
-
-    return parser.parse_args()
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        default=False, help='Classify terraform output as it is produced and abort early on fatal errors')
+    parser.add_argument('--allow-destroy', dest='allow_destroy', action='store_true',
+                        default=False, help='Apply even if the plan deletes or replaces a database server or a managed disk')
+    parser.add_argument('--no-plan-cache', dest='plan_cache', action='store_false',
+                        default=True, help='Always run a fresh plan, even if config and state are unchanged since the last one')
+    parser.add_argument('--max-attempts', dest='max_attempts', action='store', type=positive_int,
+                        default=default_retry_policy['max_attempts'], help='Maximum number of apply/destroy attempts')
+    parser.add_argument('--retry-backoff', dest='backoff_seconds', action='store', type=non_negative_float,
+                        default=default_retry_policy['backoff_seconds'], help='Base delay in seconds before a retry')
+    parser.add_argument('--retry-max-backoff', dest='max_backoff_seconds', action='store', type=non_negative_float,
+                        default=default_retry_policy['max_backoff_seconds'], help='Upper bound in seconds on the delay before a retry')
+    parser.add_argument('--refresh', dest='refresh_mode', action='store', choices=refresh_modes,
+                        default=default_refresh_policy['mode'], help='Which resources plan refreshes: all of them, none, or those older than --refresh-ttl')
+    parser.add_argument('--refresh-ttl', dest='refresh_ttl', action='store', type=non_negative_float,
+                        default=default_refresh_policy['ttl_seconds'], help='With --refresh ttl, seconds a refreshed resource is considered current for')
+    parser.add_argument('--metrics-file', dest='metrics_file', action='store', default=os.environ.get('INFRA_METRICS_FILE'),
+                        help='Append timings (phases and per-resource durations) to this file as JSON lines')
+    parser.add_argument('--metrics-textfile-dir', dest='metrics_textfile_dir', action='store',
+                        default=os.environ.get('INFRA_METRICS_TEXTFILE_DIR'),
+                        help='Write timings of the last run to this node_exporter textfile collector directory')
+    parser.add_argument('--batch-dir', dest='batch_dir', action='store',
+                        default=None, help='Run every customer environment under this directory (one rendered config per subdirectory) concurrently')
+    parser.add_argument('--customer-env', dest='customer_envs', action='store', nargs='+',
+                        default=None, help='With --batch-dir, only run these customer environments')
+    parser.add_argument('--max-parallel', dest='max_parallel', action='store', type=positive_int,
+                        default=4, help='With --batch-dir, how many customer environments run at once')
+    parser.add_argument('--max-per-subscription', dest='max_per_subscription', action='store', type=positive_int,
+                        default=2, help='With --batch-dir, how many customer environments in the same Azure subscription run at once')
+    parser.add_argument('--log-buffer-lines', dest='log_buffer_lines', action='store', type=positive_int,
+                        default=5000, help='Lines of terraform output kept in memory per attempt; older lines are spilled to disk')
+    parser.add_argument('--layers', dest='layers', action='store', nargs='*',
+                        default=None, help='The config was rendered as layers (render_config.py --layers). Run these layers, '
+                                           'or every layer that was rendered if none are named, in dependency order')
+    parser.add_argument('--migrate-state', dest='migrate_state', action='store_true', default=False,
+                        help='With --layers, first move the resources of a stack that ran as a single workspace into the '
+                             'states of the layers that declare them')
+
+    args = parser.parse_args(argv)
+    if args.layers is not None and args.batch_dir:
+        parser.error('--layers and --batch-dir cannot be combined')
+    if args.migrate_state and args.layers is None:
+        parser.error('--migrate-state needs --layers')
+    return args
+
+
+def classify_line(line):
+    ''' Match a single line of terraform output against the error catalog.
+    Returns the matching catalog entry, or None if the line is not interesting. '''
+    return catalog.classify(line)
+
+
+def print_detailed_output(log_capture):
+    ''' Print the current segment's error message to screen in the most human readable format we can '''
+    print(" ", flush=True)
+    print("An execution error occurred. Detailed output:", flush=True)
+    print("------------------------------------------------------", flush=True)
+    spill_note = log_capture.spill_note()
+    if spill_note:
+        print(spill_note, flush=True)
+    log_lines = log_capture.getvalue().splitlines()
+    for line in log_lines:
+        line = line.strip()
+        if len(line) > 1 and not refreshing_regexp.search(line):
+            print(line, flush=True)
+    print("------------------------------------------------------", flush=True)
 
 
-def log_review(log_capture_string):
+@timed('log_review')
+def log_review(log_capture):
     ''' Parse the log output and match known patterns '''
 
-    # Logging module has been configured to capture the output to a string, rather than
-    # print it. Here we will try to do something useful with that data.
+    # Logging module has been configured to capture the output of the current plan or apply
+    # attempt, rather than print it. Here we will try to do something useful with that data.
     #
     # a side effect is that we have to use print() for on screen output.
-    log_contents = log_capture_string.getvalue()
+    log_contents = log_capture.getvalue()
 
     # The log is saved as a multi-line string. Break it into multiple lines for ease
     # of parsing.
@@ -58,138 +201,310 @@ def log_review(log_capture_string):
     detailed_output = False
     return_code = exit_codes['I_HAVE_NO_CLUE']
 
-    # This list defines the retryable errors we want to capture.
-    # They must be in the form of a re.search regexp:
-    # - whitespace escaped
-    # .* before and after to allow them to appear anywhere in the string
-
-    retryable_errors = [
-        '.*RetryableError.*',
-        '.*context\s+deadline\s+exceeded.*'
-    ]
-
-    retryable_regexp = '(?:% s)' % '|'.join(retryable_errors) 
-
     # Since the end of the log is the most meaningful, start from the end.
     for line in reversed(log_lines):
+        entry = classify_line(line)
 
-        # This is the standard "create succeeded" message from terraform
-        if re.match("Apply complete!", line):
-            print(line, flush=True)
-            return_code = exit_codes['SUCCESS']
-            break
+        if entry is None:
+            continue
 
-        # For destroys, this is the expected success message
-        elif re.match("Destroy complete!", line) or re.match("Destruction complete", line):
+        return_code = exit_codes[entry['exit_code']]
+        if return_code == exit_codes['SUCCESS']:
             print(line, flush=True)
-            return_code = exit_codes['SUCCESS']
-            break
-
-        # There isn't a single consistent way to tell whether an error can be retried or not. This is
-        # something we will build up over time. The key here is that if terraform returns retryable_error,
-        # this wrapper will attempt to run terraform a second time before bailing out completely. It's not
-        # much reliency but it's something.
-
-        elif re.search(retryable_regexp, line):
-            return_code = exit_codes['RETRYABLE_ERROR']
+        else:
+            if entry['message']:
+                print(f"{entry['message']} {return_code}", flush=True)
             detailed_output = True
-            break
-
-        # Some, not all, errors start with Error:
-        elif re.match("Error:", line):
-            # this error happens when the terraform config specifies an invalid plugin configuration
-            if re.search('error\s+satisfying\s+plugin\s+requirements', line):
-                return_code = exit_codes['PLUGIN_ERROR']
-                print(f"Terraform plugin configuration invalid {return_code}", flush=True)
-                detailed_output = True
-                break
-
-            # VM cores quota exceeded
-            elif re.search('exceeding\s+approved\s+Total\s+Regional\s+Cores\s+quota', line):
-                return_code = exit_codes['VM_CORE_QUOTA']
-                print(f"VM Core quota exceeded. Microsoft support ticket required. {return_code}", flush=True)
-                detailed_output = True
-                break
-
-            # this happens if you try to use a terraform resource that doesn't exist.
-            elif re.search('unknown\s+resource', line):
-                return_code = exit_codes['UNKNOWN_RESOURCE']
-                print(f"Terraform unknown resource error {return_code}", flush=True)
-                detailed_output = True
-                break
-
-            # This one is "something failed but I don't know what"
-            else:
-                return_code = exit_codes['GENERIC_FAILURE']
-                print(f"Terraform unhandled exception {return_code}", flush=True)
-                detailed_output = True
-                break
+        break
 
     # If we get some sort of failure, print the entire error message to screen in the most
     # human readable format we can.
     if detailed_output:
-        print(" ", flush=True)
-        print("An execution error occurred. Detailed output:", flush=True)
-        print("------------------------------------------------------", flush=True)
-        for line in log_lines:
-            line = line.strip()
-            if len(line) > 1 and not re.search('Refreshing\s+state', line):
-                print(line, flush=True)
-        print("------------------------------------------------------", flush=True)
+        print_detailed_output(log_capture)
 
     return return_code
 
 
-def tf_apply(terra, logger, log_capture_string, apply, destroy):
-    ''' Execute terraform plan/apply for an azure environment '''
+def stream_terraform(terra, logger, cmd, *args, **kwargs):
+    ''' Run a terraform command, feeding its output to the logger and classifying it line by line
+    as it is produced. On a fatal error terraform is interrupted instead of waiting for it to finish.
+    Returns the terraform return code, the captured output and the fatal catalog entry (or None). '''
 
-    # This is used to print readable output further down.
-    if destroy:
-        action_string = 'destroy'
+    cmds = terra.generate_cmd_string(cmd, *args, **kwargs)
+
+    # stderr is folded into stdout so the lines reach us in the order terraform wrote them.
+    process = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               cwd=terra.working_dir, env=os.environ.copy())
+
+    output_lines = []
+    fatal_entry = None
+
+    for raw_line in iter(process.stdout.readline, b''):
+        line = raw_line.decode('utf-8', errors='replace').rstrip('\n')
+        output_lines.append(line)
+        logger.info(line)
+
+        entry = classify_line(line)
+        if entry is not None and entry['fatal']:
+            fatal_entry = entry
+            break
+
+    if fatal_entry is not None:
+        # Terraform treats SIGINT as a request to stop cleanly and release the state lock. Anything it
+        # prints while shutting down is noise, so it is drained and thrown away.
+        print(f"Fatal error detected, interrupting terraform {cmd}", flush=True)
+        process.send_signal(signal.SIGINT)
+        drain = threading.Thread(target=process.stdout.read, daemon=True)
+        drain.start()
+        try:
+            process.wait(timeout=abort_grace_seconds)
+        except subprocess.TimeoutExpired:
+            process.terminate()
+            process.wait()
     else:
-        action_string = 'create'
+        process.wait()
+        process.stdout.close()
 
-    # See? Told you.
-    print(f"Executing terraform {action_string} plan", flush=True)
+    return process.returncode, '\n'.join(output_lines), fatal_entry
 
-    # Actually execute terraform
-    plan_code, plan_stdout, plan_stderr = terra.plan(destroy=destroy)
 
-    # Feed stdout / stderr to logging module.
-    logger.info(plan_stdout)
-    logger.error(plan_stderr)
+def retry_delay(attempt, retry_policy):
+    ''' Exponential backoff with full jitter for the given (1 based) attempt number '''
+    ceiling = min(retry_policy['max_backoff_seconds'], retry_policy['backoff_seconds'] * 2 ** (attempt - 2))
+    return random.uniform(0, ceiling)
+
+
+def fatal_abort(log_capture, fatal_entry):
+    ''' Report a fatal error caught while streaming terraform output '''
+    fatal_code = exit_codes[fatal_entry['exit_code']]
+    if fatal_entry['message']:
+        print(f"{fatal_entry['message']} {fatal_code}", flush=True)
+    print_detailed_output(log_capture)
+    return fatal_code
+
+
+def tf_refresh_stale(terra, logger, log_capture, ttl_seconds, stream):
+    ''' Refresh just the resources in state that haven't been refreshed for ttl_seconds. Returns an exit code if
+    the refresh failed, and otherwise the refresh mode the plan should use. '''
+
+    working_dir = working_dir_of(terra)
+
+    list_code, list_stdout, _ = terra.cmd('state list')
+    in_state = list_stdout.splitlines() if list_code == 0 else []
+    stale = stale_resources(working_dir, in_state, ttl_seconds)
+
+    # A new stack, or one that hasn't been looked at for a while. Plan may as well refresh it all.
+    if len(stale) == len(in_state):
+        print("No resources refreshed recently. Refreshing everything", flush=True)
+        return None, 'full'
+
+    print(f"{len(in_state) - len(stale)} of {len(in_state)} resources refreshed in the last {ttl_seconds:.0f} seconds. "
+          f"Refreshing the other {len(stale)}", flush=True)
+
+    if stale:
+        log_capture.start_segment('refresh')
+
+        with span('refresh', resources=len(stale)):
+            if stream:
+                refresh_code, _, fatal_entry = stream_terraform(terra, logger, 'refresh', no_color=IsFlagged, input=False, target=stale)
+                if fatal_entry is not None:
+                    return fatal_abort(log_capture, fatal_entry), None
+            else:
+                refresh_code, refresh_stdout, refresh_stderr = terra.cmd('refresh', no_color=IsFlagged, input=False, target=stale)
+                logger.info(refresh_stdout)
+                logger.error(refresh_stderr)
+
+        if refresh_code != 0:
+            exit_handler = log_review(log_capture)
+            print(f"Refresh failed with error {exit_handler}", flush=True)
+            return exit_handler, None
+
+    record_refresh(working_dir, stale, keep=in_state)
+    return None, 'none'
+
+
+def tf_plan(terra, logger, log_capture, destroy, stream, refresh_policy=None):
+    ''' Run terraform plan, saving it to plan_file. Returns an exit code if the plan failed, and a
+    description of the plan otherwise. '''
+
+    if refresh_policy is None:
+        refresh_policy = default_refresh_policy
+
+    # Whatever gets destroyed has to be judged on what is really there.
+    refresh_mode = 'full' if destroy else refresh_policy['mode']
 
-    # Assume that apply was NOT set.
-    skip_apply = False
+    if refresh_mode == 'ttl':
+        exit_handler, refresh_mode = tf_refresh_stale(terra, logger, log_capture, refresh_policy['ttl_seconds'], stream)
+        if exit_handler is not None:
+            return exit_handler, None
+
+    # -refresh=false unless plan is to refresh everything itself.
+    refresh = None if refresh_mode == 'full' else False
+
+    # A plan left over from an earlier run must never be read back, or applied, as this one.
+    stale_plan_path = os.path.join(working_dir_of(terra), plan_file)
+    if os.path.exists(stale_plan_path):
+        os.remove(stale_plan_path)
+
+    # Each plan and apply attempt is reviewed on its own output only.
+    log_capture.start_segment('plan')
+
+    # Actually execute terraform
+    with span('plan', refresh=refresh_mode):
+        if stream:
+            plan_code, plan_stdout, fatal_entry = stream_terraform(terra, logger, 'plan', detailed_exitcode=IsFlagged,
+                                                                  destroy=destroy, no_color=IsFlagged, input=False, out=plan_file,
+                                                                  refresh=refresh)
+            if fatal_entry is not None:
+                return fatal_abort(log_capture, fatal_entry), None
+        else:
+            plan_code, plan_stdout, plan_stderr = terra.plan(destroy=destroy, out=plan_file, refresh=refresh)
+
+            # Feed stdout / stderr to logging module.
+            logger.info(plan_stdout)
+            logger.error(plan_stderr)
 
     # Plan will return 0 or 2 as success codes, depending on whether changes are needed or not.
     # any other code is a failure.
-    if plan_code in [0, 2]:
-
-        # Since the plan worked, lets dig out the lines we care about.
-        terra_plan = plan_stdout.splitlines()
-
-        for line in terra_plan:
-            line = line.strip()
-            # Don't display empty lines (there are a lot) or refreshing state info
-            if len(line) > 1 and not re.search('Refreshing\s+state', line):
-
-                # The line that starts with Plan: is where it tells you what it's going to do.
-                if re.search('Plan:', line):
-                    # TODO: add logic here for unexpected changes or destroys. Not in scope today.
-                    print(line, flush=True)
-                elif re.search('No changes. Infrastructure is up-to-date', line):
-                    # If terraform plan says no changes are needed, skipp apply even if --apply is passed
-                    skip_apply = True
-                elif destroy:
-                    # On destroy only, print the entire output so that we get solid confirmation EXACTLY what will be destroyed.
-                    print(line, flush=True)
-
-    else:
+    if plan_code not in [0, 2]:
         # If the plan failed to execute, that's usually a syntax issue.
-        exit_handler = log_review(log_capture_string)
+        exit_handler = log_review(log_capture)
         print(f"Plan failed with error {exit_handler}", flush=True)
-        return exit_handler
+        return exit_handler, None
+
+    if refresh_mode == 'full':
+        record_refresh(working_dir_of(terra), refreshed_resources(plan_stdout))
+
+    # With -detailed-exitcode, 0 is terraform saying there is nothing to do. No need to read the plan back.
+    if plan_code == 0:
+        return None, {"no_changes": True, "planned": {}, "display": [], "plan_file": plan_file, "protected": []}
+
+    # The saved plan, read back as JSON, says exactly what will change. Terraform that can't show it
+    # leaves the plan's text output to go on.
+    with span('plan_analysis'):
+        plan_index = load_plan(terra, plan_file)
+    if plan_index is not None:
+        plan = plan_from_index(plan_index, destroy)
+    else:
+        plan = plan_from_text(plan_stdout, destroy)
+
+    for line in plan['display']:
+        print(line, flush=True)
+
+    return None, plan
+
+
+def plan_from_index(plan_index, destroy):
+    ''' Description of a plan from its PlanIndex '''
+    plan = {
+        "no_changes": plan_index.no_changes,
+        # Every resource the plan is going to touch. Retries only need to target the ones that haven't finished yet.
+        "planned": plan_index.planned(),
+        # What the operator gets to see, kept so it can be shown again when the plan is reused.
+        "display": [],
+        "plan_file": plan_file,
+        # Data that would be lost. Destroying everything is what a destroy is for, so only other plans are checked.
+        "protected": [] if destroy else plan_index.unexpected_destroys()
+    }
+    if not plan['no_changes']:
+        # One line per resource: on destroy that is solid confirmation of EXACTLY what will be destroyed.
+        plan['display'] = plan_index.compact_diff() + [plan_index.summary()]
+    return plan
+
+
+def plan_from_text(plan_stdout, destroy):
+    ''' Description of a plan from the text terraform plan printed '''
+    planned = planned_resources(plan_stdout)
+    plan = {
+        # Assume that apply was NOT set.
+        "no_changes": False,
+        "planned": planned,
+        "display": [],
+        "plan_file": plan_file,
+        "protected": [] if destroy else [(address, change) for address, change in sorted(planned.items())
+                                         if change in ['will be destroyed', 'must be replaced']
+                                         and resource_type(address) in protected_resource_types]
+    }
+
+    # Since the plan worked, lets dig out the lines we care about.
+    terra_plan = plan_stdout.splitlines()
+
+    for line in terra_plan:
+        line = line.strip()
+        # Don't display empty lines (there are a lot) or refreshing state info
+        if len(line) > 1 and not refreshing_regexp.search(line):
+
+            # The line that starts with Plan: is where it tells you what it's going to do.
+            if re.search('Plan:', line):
+                plan['display'].append(line)
+            elif re.search('No changes. Infrastructure is up-to-date', line):
+                # If terraform plan says no changes are needed, skipp apply even if --apply is passed
+                plan['no_changes'] = True
+            elif destroy:
+                # On destroy only, print the entire output so that we get solid confirmation EXACTLY what will be destroyed.
+                plan['display'].append(line)
+
+    return plan
+
+
+def tf_apply(terra, logger, log_capture, apply, destroy, stream=False, retry_policy=None, plan_cache=True, refresh_policy=None,
+             allow_destroy=False):
+    ''' Execute terraform plan/apply for an azure environment '''
+
+    if retry_policy is None:
+        retry_policy = default_retry_policy
+
+    if refresh_policy is None:
+        refresh_policy = default_refresh_policy
+
+    # This is used to print readable output further down.
+    if destroy:
+        action_string = 'destroy'
+    else:
+        action_string = 'create'
+
+    working_dir = working_dir_of(terra)
+
+    # If the rendered config and the state are exactly as they were for the last plan, that plan still
+    # stands and there is no need to refresh and diff the whole stack again. Unless it was made with less
+    # refreshing than this run asks for: that would hide drift this run is meant to find.
+    refresh_mode = 'full' if destroy else refresh_policy['mode']
+    fingerprint = None
+    plan = None
+    if plan_cache:
+        fingerprint = plan_fingerprint(terra, destroy)
+        plan = load_cached_plan(working_dir, fingerprint, refresh_mode)
+
+    if plan is not None:
+        print(f"Config and state unchanged since the last terraform {action_string} plan. Reusing it", flush=True)
+        for line in plan['display']:
+            print(line, flush=True)
+    else:
+        # See? Told you.
+        print(f"Executing terraform {action_string} plan", flush=True)
+
+        exit_handler, plan = tf_plan(terra, logger, log_capture, destroy, stream, refresh_policy)
+        if exit_handler is not None:
+            return exit_handler
+
+        if plan_cache:
+            # A targeted refresh writes to the state, which moves the fingerprint on.
+            if refresh_policy['mode'] == 'ttl' and not destroy:
+                fingerprint = plan_fingerprint(terra, destroy)
+            save_cached_plan(working_dir, fingerprint, dict(plan, refresh=refresh_mode))
+
+    skip_apply = plan['no_changes']
+    planned = plan['planned']
+
+    # Deleting or replacing a database or a data disk is never a side effect anyone wants from a config change.
+    protected = plan.get('protected', [])
+    if protected:
+        print(f"The plan deletes or replaces {len(protected)} resources holding data:", flush=True)
+        for address, change in protected:
+            print(f"  {address}: {change}", flush=True)
+        if apply and not allow_destroy:
+            print(f"Refusing to apply without --allow-destroy {exit_codes['UNEXPECTED_DESTROY']}", flush=True)
+            return exit_codes['UNEXPECTED_DESTROY']
 
     if apply:
         # If the plan has no action, skip the apply and return success
@@ -200,31 +515,91 @@ def tf_apply(terra, logger, log_capture_string, apply, destroy):
         # Give the operator 30 seconds to abort if the destroy plan looks bad.
         if destroy:
             print("Pausing for 30 seconds before destroying existing infrastructure.", flush=True)
-            time.sleep(30)
+            with span('destroy_pause'):
+                time.sleep(30)
 
         # Let the operator know that things are going to be quiet for a bit.
         print(f"Starting terraform {action_string}. There will be little to no output for the next 15 - 20+ minutes.", flush=True)
 
-        # Retryable errors are common. This is a simple loop to try again if it fails. Counting from one because humans.
+        # The first attempt applies the saved plan, so what gets applied is exactly what was shown above.
+        # Retryable errors are common. Try again, with a growing and randomised delay so parallel runs don't
+        # retry in lock step, and only against the resources that haven't finished yet. Counting from one because humans.
         count = 1
-        max_retries = 3
         exit_handler = exit_codes['RETRYABLE_ERROR']
+        completed = {}
+        targets = None
+
+        while count <= retry_policy['max_attempts'] and exit_handler in retryable_codes:
 
-        while count < max_retries and exit_handler == exit_codes['RETRYABLE_ERROR']:
+            if count > 1:
+                delay = retry_delay(count, retry_policy)
+                print(f"Waiting {delay:.0f} seconds before retrying", flush=True)
+                with span('retry_wait', attempt=count):
+                    time.sleep(delay)
 
             print(f"Terraform apply attempt {count} starting", flush=True)
+            log_capture.start_segment(f"{action_string}-attempt-{count}")
+
+            if targets:
+                print(f"Retrying {len(targets)} unfinished resources: {', '.join(targets)}", flush=True)
+
+            with span('apply', attempt=count, action=action_string, targeted=bool(targets)):
+                if stream:
+                    # Output is logged as it arrives, and a fatal error ends the attempt (and the run) immediately.
+                    if count == 1:
+                        return_code, output, fatal_entry = stream_terraform(terra, logger, 'apply', plan['plan_file'], auto_approve=IsFlagged,
+                                                                            no_color=IsFlagged, input=False)
+                    elif destroy:
+                        return_code, output, fatal_entry = stream_terraform(terra, logger, 'destroy', auto_approve=True, force=IsFlagged,
+                                                                            no_color=IsFlagged, input=False)
+                    else:
+                        return_code, output, fatal_entry = stream_terraform(terra, logger, 'apply', auto_approve=IsFlagged,
+                                                                            no_color=IsFlagged, input=False, target=targets)
+                    if fatal_entry is not None:
+                        record_resources(output, f"{action_string}-attempt-{count}")
+                        return fatal_abort(log_capture, fatal_entry)
+                else:
+                    if count == 1:
+                        # Variables are baked into a saved plan and terraform refuses -var-file alongside one, so the
+                        # default (empty) variables python_terraform would pass are switched off.
+                        return_code, stdout, stderr = terra.apply(plan['plan_file'], skip_plan=True, var=None)
+                    elif destroy:
+                        return_code, stdout, stderr = terra.destroy(auto_approve=True)
+                    else:
+                        return_code, stdout, stderr = terra.apply(skip_plan=True, target=targets)
+
+                    logger.info(stdout)
+                    logger.error(stderr)
+                    output = stdout + stderr
+
+            record_resources(output, f"{action_string}-attempt-{count}")
+            exit_handler = log_review(log_capture)
+            completed = completed_resources(output, completed)
+
+            # A destroy retry is already cheap since everything that went away stays gone. For creates, work out
+            # what is left: everything planned that hasn't completed, plus anything terraform complained about.
+            # Without a parsed plan there is nothing to go on, so the next attempt covers the whole config.
+            if exit_handler in retryable_codes and not destroy and planned:
+                targets = sorted(unfinished_resources(planned, completed) | failed_resources(output)) or None
 
-            if destroy:
-                return_code, stdout, stderr = terra.destroy(auto_approve=True)
-            else:
-                return_code, stdout, stderr = terra.apply(skip_plan=True)
+            count += 1
 
-            logger.info(stdout)
-            logger.error(stderr)
+        # The saved plan is now the record of what was applied, even if the apply didn't finish.
+        record_applied_plan(working_dir, plan['plan_file'], exit_handler)
 
-            exit_handler = log_review(log_capture_string)
+        # Whatever was just created or changed is as fresh as it gets.
+        if not destroy:
+            record_refresh(working_dir, [address for address, verbs in completed.items() if verbs & {'Creation', 'Modifications'}])
 
-            count += 1
+        # Once applied, the saved plan is spent. On success the config and the new state are in sync, which is
+        # as good as a plan with no changes; anything else needs a fresh plan next time.
+        if plan_cache:
+            if exit_handler == exit_codes['SUCCESS']:
+                save_cached_plan(working_dir, plan_fingerprint(terra, destroy),
+                                 {"no_changes": True, "planned": {}, "display": [], "plan_file": plan['plan_file'],
+                                  "refresh": plan.get('refresh', refresh_mode)})
+            else:
+                clear_cached_plan(working_dir)
 
         return exit_handler
     else:
@@ -232,25 +607,316 @@ def tf_apply(terra, logger, log_capture_string, apply, destroy):
         return exit_codes['APPLY_NOT_SPECIFIED']
 
 
-def main():
-    ''' main body of the script '''
+@timed('init')
+def tf_init(terra):
+    ''' Run terraform init, unless this working directory is already initialised for the same providers,
+    backend and modules '''
+
+    working_dir = working_dir_of(terra)
+    requirements = init_requirements(working_dir, terraform_bin_path)
+
+    if init_is_current(working_dir, requirements):
+        marker = load_init_marker(working_dir)
+        print(f"Provider requirements unchanged. Skipping terraform init (last init took {marker['init_seconds']:.1f} seconds)", flush=True)
+        return
+
+    init_start = time.time()
+
+    # Terraform doesn't expect several inits to fill the shared plugin cache at the same time,
+    # so they take turns. Plans and applies still run side by side.
+    plugin_cache_dir = os.environ.get('TF_PLUGIN_CACHE_DIR')
+    if plugin_cache_dir:
+        with open(os.path.join(plugin_cache_dir, '.infra_service.lock'), 'w') as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            init_code, _, _ = terra.init()
+    else:
+        init_code, _, _ = terra.init()
+
+    init_seconds = time.time() - init_start
+    print(f"Terraform init took {init_seconds:.1f} seconds", flush=True)
+
+    # A failed init is left for plan to report, and must not be remembered.
+    if init_code == 0:
+        record_init(working_dir, requirements, init_seconds)
+
 
-    logger = logging.getLogger('basic_logger')
+def run_workspace(args, working_dir=None, logger_name='basic_logger', tenant=None):
+    ''' Init and plan/apply one terraform working directory (the current one by default) '''
+
+    # Where the time goes, for this working directory only. Written out once the run is over.
+    run_metrics = RunMetrics(tenant or os.environ.get('customer_env', 'default'), os.path.abspath(working_dir or os.getcwd()))
+    with collecting(run_metrics):
+        tf_exit_code = None
+        try:
+            tf_exit_code = run_terraform(args, working_dir, logger_name)
+            return tf_exit_code
+        finally:
+            run_metrics.finish(tf_exit_code)
+            if args.metrics_file:
+                run_metrics.write_json_lines(args.metrics_file)
+            if args.metrics_textfile_dir:
+                run_metrics.write_prometheus(args.metrics_textfile_dir)
+
+
+def run_terraform(args, working_dir, logger_name):
+    ''' The body of run_workspace '''
+
+    logger = logging.getLogger(logger_name)
     logger.setLevel(logging.DEBUG)
 
-    log_capture_string = io.StringIO()
-    capture_handle = logging.StreamHandler(log_capture_string)
-    capture_handle.setLevel(logging.DEBUG)
+    log_capture = SegmentedLogCapture(max_lines=args.log_buffer_lines)
+    log_capture.setLevel(logging.DEBUG)
+
+    logger.addHandler(log_capture)
+
+    terra = Terraform(working_dir=working_dir, terraform_bin_path=terraform_bin_path)
+
+    tf_init(terra)
+
+    retry_policy = {
+        "max_attempts": args.max_attempts,
+        "backoff_seconds": args.backoff_seconds,
+        "max_backoff_seconds": args.max_backoff_seconds
+    }
+
+    refresh_policy = {
+        "mode": args.refresh_mode,
+        "ttl_seconds": args.refresh_ttl
+    }
+
+    try:
+        return tf_apply(terra, logger, log_capture,
+                        args.action_apply, args.action_destroy, args.stream, retry_policy, args.plan_cache, refresh_policy,
+                        args.allow_destroy)
+    finally:
+        logger.removeHandler(log_capture)
+        log_capture.close()
+
+
+def tenant_subscription(working_dir):
+    ''' The Azure subscription a rendered customer config deploys into '''
+    subscription_regexp = re.compile('^\s*subscription_id\s*=\s*"([^"]+)"')
+    for file_name in sorted(os.listdir(working_dir)):
+        if not file_name.endswith('.tf'):
+            continue
+        with open(os.path.join(working_dir, file_name), 'r') as tf_handle:
+            for line in tf_handle:
+                match = subscription_regexp.match(line)
+                if match:
+                    return match.group(1)
+    return None
+
+
+def run_tenant(tenant, working_dir, args):
+    ''' Batch worker: run one customer environment (or layer), with its output going to a log file in its working directory '''
+    with open(os.path.join(working_dir, 'infra_service.log'), 'w') as log_handle, contextlib.redirect_stdout(log_handle):
+        tf_exit_code = run_workspace(args, working_dir, logger_name=f"basic_logger.{tenant}", tenant=tenant)
+        print(f"Infra service returned {tf_exit_code}", flush=True)
+    return tf_exit_code
+
+
+def share_plugin_cache():
+    ''' Point every terraform this process starts at one plugin cache, so providers are only downloaded once per agent '''
+    plugin_cache_dir = os.environ.setdefault('TF_PLUGIN_CACHE_DIR', os.path.expanduser('~/.terraform.d/plugin-cache'))
+    os.makedirs(plugin_cache_dir, exist_ok=True)
+
+
+def run_batch(args):
+    ''' Run plan/apply for many customer environments at once, in a process pool '''
+
+    batch_dir = os.path.abspath(args.batch_dir)
+    tenants = args.customer_envs or sorted(name for name in os.listdir(batch_dir)
+                                           if os.path.isdir(os.path.join(batch_dir, name)))
+
+    share_plugin_cache()
+
+    pending = collections.deque()
+    for tenant in tenants:
+        working_dir = os.path.join(batch_dir, tenant)
+        pending.append((tenant, working_dir, tenant_subscription(working_dir)))
+
+    print(f"Running {len(pending)} customer environments, {args.max_parallel} at a time "
+          f"and {args.max_per_subscription} per Azure subscription", flush=True)
+
+    results = {}
+    running = {}
+    subscription_load = collections.Counter()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.max_parallel) as pool:
+        while pending or running:
+
+            # Start whatever fits under both the overall and the per-subscription limit, keeping the queue order otherwise.
+            for item in list(pending):
+                if len(running) >= args.max_parallel:
+                    break
+                tenant, working_dir, subscription = item
+                if subscription_load[subscription] >= args.max_per_subscription:
+                    continue
+                pending.remove(item)
+                subscription_load[subscription] += 1
+                running[pool.submit(run_tenant, tenant, working_dir, args)] = (tenant, subscription)
+                print(f"{tenant}: started (subscription {subscription})", flush=True)
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                tenant, subscription = running.pop(future)
+                subscription_load[subscription] -= 1
+                try:
+                    results[tenant] = future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    print(f"{tenant}: worker failed: {error}", flush=True)
+                    results[tenant] = exit_codes['I_HAVE_NO_CLUE']
+                print(f"{tenant}: finished with {exit_code_names.get(results[tenant])} {results[tenant]}", flush=True)
+
+    print("------------------------------------------------------", flush=True)
+    for tenant in tenants:
+        print(f"{tenant}: {exit_code_names.get(results[tenant])} {results[tenant]}", flush=True)
+    print("------------------------------------------------------", flush=True)
+
+    with open(os.path.join(batch_dir, 'batch_results.json'), 'w') as results_handle:
+        json.dump({tenant: {"exit_code": code, "result": exit_code_names.get(code)} for tenant, code in results.items()},
+                  results_handle, indent=2, sort_keys=True)
+
+    return results
+
+
+def single_state_resources(stack_dir):
+    ''' Managed resources still in the state of a stack from before it was split into layers '''
+    if not os.path.exists(os.path.join(stack_dir, state_file)):
+        return []
+
+    terra = Terraform(working_dir=stack_dir, terraform_bin_path=terraform_bin_path)
+    list_code, list_stdout, list_stderr = terra.cmd('state list', state=state_file)
+    if list_code != 0:
+        raise RuntimeError(f"terraform state list failed in {stack_dir}: {list_stderr}")
+
+    resources = []
+    for line in list_stdout.splitlines():
+        address = resource_address(line.strip())
+        # Data sources are read again by whichever layer declares them; only managed resources have to move.
+        if address and not address.startswith('data.') and address not in resources:
+            resources.append(address)
+    return resources
+
+
+def migrate_to_layers(stack_dir):
+    ''' Move the resources of a stack that ran as a single workspace into the states of the layers that now declare
+    them, so the layers take them over instead of planning to create them again. Nothing is moved unless every
+    resource has a layer to go to. The single state is kept as it was in terraform.tfstate.pre-layers. '''
+
+    resources = single_state_resources(stack_dir)
+    if not resources:
+        return True
+
+    owners = resource_layers(stack_dir, [layer for layer in layer_names if os.path.isdir(os.path.join(stack_dir, layer))])
+    homeless = [address for address in resources if address not in owners]
+    if homeless:
+        print(f"Not migrating: no rendered layer declares {', '.join(homeless)}", flush=True)
+        return False
+
+    # Not overwritten by a second attempt, which would find the state half migrated.
+    backup_path = os.path.join(stack_dir, state_file + '.pre-layers')
+    if not os.path.exists(backup_path):
+        shutil.copy2(os.path.join(stack_dir, state_file), backup_path)
+
+    terra = Terraform(working_dir=stack_dir, terraform_bin_path=terraform_bin_path)
+    for address in resources:
+        layer = owners[address]
+        move_code, _, move_stderr = terra.cmd('state mv', address, address,
+                                              state=state_file, state_out=os.path.join(layer, state_file))
+        if move_code != 0:
+            print(f"{address}: moving to the {layer} layer failed: {move_stderr}", flush=True)
+            return False
+        print(f"{address}: moved to the {layer} layer", flush=True)
+
+    print(f"Moved {len(resources)} resources into the layer states. The single state was {backup_path}", flush=True)
+    return True
+
+
+def run_layers(args, stack_dir):
+    ''' Run plan/apply for a customer stack rendered as layers, each in its own subdirectory with its own state.
+    Layers run in waves; the layers in a wave don't depend on each other and run at the same time. '''
+
+    layers = args.layers or [layer for layer in layer_names if os.path.isdir(os.path.join(stack_dir, layer))]
+    waves = layer_waves(layers, destroy=args.action_destroy)
+
+    if args.migrate_state and not migrate_to_layers(stack_dir):
+        return {layer: exit_codes['GENERIC_FAILURE'] for layer in layers}
+
+    # The layers start with states of their own. Resources still in the single state would be planned as new.
+    unmigrated = single_state_resources(stack_dir)
+    if unmigrated:
+        print(f"{len(unmigrated)} resources are still in {os.path.join(stack_dir, state_file)}, which the layers don't use, "
+              f"and they would be created again. Run once with --migrate-state to move them into the layer states", flush=True)
+        return {layer: exit_codes['GENERIC_FAILURE'] for layer in layers}
+
+    share_plugin_cache()
+
+    # A plan-only run still plans the layers that come later; anything else stops them.
+    proceed_codes = {exit_codes['SUCCESS'], exit_codes['APPLY_NOT_SPECIFIED']}
+    results = {}
+
+    print(f"Running layers {' -> '.join(', '.join(wave) for wave in waves)}", flush=True)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(len(wave) for wave in waves)) as pool:
+        for wave in waves:
+            running = {}
+            for layer in wave:
+                # A layer can't be applied before the layers it reads from, and can't be destroyed while
+                # the layers reading from it are still there.
+                if args.action_destroy:
+                    blockers = layer_dependents(layer)
+                else:
+                    blockers = layer_dependencies[layer]
+                failed = [blocker for blocker in blockers if blocker in results and results[blocker] not in proceed_codes]
+                if failed:
+                    print(f"{layer}: skipped because {', '.join(failed)} did not succeed", flush=True)
+                    results[layer] = exit_codes['GENERIC_FAILURE']
+                    continue
+
+                running[pool.submit(run_tenant, layer, os.path.join(stack_dir, layer), args)] = layer
+                print(f"{layer}: started", flush=True)
+
+            for future in concurrent.futures.as_completed(running):
+                layer = running[future]
+                try:
+                    results[layer] = future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    print(f"{layer}: worker failed: {error}", flush=True)
+                    results[layer] = exit_codes['I_HAVE_NO_CLUE']
+                print(f"{layer}: finished with {exit_code_names.get(results[layer])} {results[layer]}. "
+                      f"Output is in {os.path.join(stack_dir, layer, 'infra_service.log')}", flush=True)
+
+    print("------------------------------------------------------", flush=True)
+    for layer in [layer for wave in waves for layer in wave]:
+        print(f"{layer}: {exit_code_names.get(results[layer])} {results[layer]}", flush=True)
+    print("------------------------------------------------------", flush=True)
+
+    return results
 
-    logger.addHandler(capture_handle)
 
-    os.chdir("modules")
-    terra = Terraform(terraform_bin_path="/usr/local/bin/terraform-v12")
-    terra.init()
+def main():
+    ''' main body of the script '''
 
     args = get_args()
-    tf_exit_code = tf_apply(terra, logger, log_capture_string,
-                            args.action_apply, args.action_destroy)
+
+    if args.batch_dir:
+        results = run_batch(args)
+        if all(code == exit_codes['SUCCESS'] for code in results.values()):
+            exit(0)
+        else:
+            exit(1)
+
+    os.chdir("modules")
+
+    if args.layers is not None:
+        results = run_layers(args, os.getcwd())
+        # Report the first layer that failed, so that callers see the same codes as for a single workspace.
+        failures = [code for code in results.values() if code != exit_codes['SUCCESS']]
+        tf_exit_code = failures[0] if failures else exit_codes['SUCCESS']
+    else:
+        tf_exit_code = run_workspace(args)
     print(f"Infra service returned {tf_exit_code}", flush=True)
 
     if tf_exit_code == exit_codes['SUCCESS']:
@@ -258,8 +924,6 @@ def main():
     else:
         exit(1)
 
-    log_capture_string.close()
-
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+'''
+SQLite index of the customer inventory in ANSIBLE_DATA_DIR (vars/*.yml and api_data/*.json).
+'''
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+
+import yaml
+
+default_cache_dir = os.environ.get('INVENTORY_CACHE_DIR', os.path.expanduser('~/.cache/infra_service/inventory'))
+
+# Where each kind of inventory file lives under the data dir, and how it is named.
+inventory_sources = {
+    "vars": ("vars", ".yml"),
+    "api_data": ("api_data", ".json")
+}
+
+# Bumped whenever the table layout or the encoding of data changes, so that older caches are rebuilt.
+# 2: data is pickled, which keeps dates and non-string keys as YAML loaded them; JSON turned them into strings.
+schema_version = 2
+
+# Values pulled out of every inventory file into their own indexed columns, as the first of these key paths
+# that is present.
+indexed_fields = {
+    "product": [("product",)],
+    "region": [("region",), ("azure_region",), ("terraform", "region")]
+}
+
+
+class InventoryLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    ''' The C YAML loader, where available, reading ansible-vault encrypted values as their ciphertext '''
+
+
+InventoryLoader.add_constructor('!vault', lambda loader, node: loader.construct_scalar(node))
+
+
+def field_value(data, key_paths):
+    ''' The first of key_paths present in data, as a string, or None '''
+    for key_path in key_paths:
+        value = data
+        for key in key_path:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            return None if value is None else str(value)
+    return None
+
+
+def parse_inventory_file(path):
+    ''' Load one vars or api_data file '''
+    with open(path, 'r') as inventory_handle:
+        if path.endswith('.json'):
+            return json.load(inventory_handle)
+        return yaml.load(inventory_handle, Loader=InventoryLoader) or {}
+
+
+class InventoryStore:
+    ''' Parsed inventory, kept in a SQLite file and brought up to date by file mtime and size. A single tenant
+    lookup only looks at that tenant's file; bulk queries rescan the directories first. '''
+
+    def __init__(self, data_dir, cache_path=None):
+        self.data_dir = os.path.abspath(data_dir)
+
+        # One cache per data dir. Kept out of the data dir itself, which is a git checkout.
+        if cache_path is None:
+            data_dir_id = hashlib.sha256(self.data_dir.encode('utf-8')).hexdigest()[:16]
+            os.makedirs(default_cache_dir, exist_ok=True)
+            cache_path = os.path.join(default_cache_dir, f"inventory-{data_dir_id}.sqlite")
+        self.cache_path = cache_path
+
+        # Batch runs look tenants up from several processes at once.
+        self.connection = sqlite3.connect(cache_path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] != schema_version:
+                self.connection.execute('DROP TABLE IF EXISTS inventory')
+                self.connection.execute(f'PRAGMA user_version = {schema_version}')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS inventory (
+                                           kind TEXT NOT NULL,
+                                           tenant TEXT NOT NULL,
+                                           mtime_ns INTEGER NOT NULL,
+                                           size INTEGER NOT NULL,
+                                           product TEXT,
+                                           region TEXT,
+                                           data BLOB NOT NULL,
+                                           PRIMARY KEY (kind, tenant))''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS inventory_product ON inventory (kind, product)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS inventory_region ON inventory (kind, region)')
+
+    def close(self):
+        ''' Close the cache '''
+        self.connection.close()
+
+    def inventory_path(self, kind, tenant):
+        ''' Path of a tenant's inventory file of the given kind '''
+        sub_dir, suffix = inventory_sources[kind]
+        return os.path.join(self.data_dir, sub_dir, tenant + suffix)
+
+    def _store(self, kind, tenant, path, stat):
+        data = parse_inventory_file(path)
+        self.connection.execute('INSERT OR REPLACE INTO inventory VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (kind, tenant, stat.st_mtime_ns, stat.st_size,
+                                 field_value(data, indexed_fields['product']), field_value(data, indexed_fields['region']),
+                                 pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)))
+        return data
+
+    def get(self, tenant, kind='vars'):
+        ''' A tenant's parsed inventory file, or None if there isn't one '''
+        path = self.inventory_path(kind, tenant)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            with self.connection:
+                self.connection.execute('DELETE FROM inventory WHERE kind = ? AND tenant = ?', (kind, tenant))
+            return None
+
+        row = self.connection.execute('SELECT mtime_ns, size, data FROM inventory WHERE kind = ? AND tenant = ?',
+                                      (kind, tenant)).fetchone()
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            # Only ever written by _store above, into a cache file in this user's own cache directory.
+            return pickle.loads(row[2])
+
+        with self.connection:
+            return self._store(kind, tenant, path, stat)
+
+    def refresh(self, kind='vars'):
+        ''' Bring the cache up to date with every file of this kind. Returns how many files were (re)parsed and
+        how many were dropped because the file is gone. '''
+        sub_dir, suffix = inventory_sources[kind]
+        source_dir = os.path.join(self.data_dir, sub_dir)
+
+        cached = {tenant: (mtime_ns, size) for tenant, mtime_ns, size in
+                  self.connection.execute('SELECT tenant, mtime_ns, size FROM inventory WHERE kind = ?', (kind,))}
+        parsed = 0
+
+        with self.connection:
+            with os.scandir(source_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(suffix) or not entry.is_file():
+                        continue
+                    tenant = entry.name[:-len(suffix)]
+                    stat = entry.stat()
+                    if cached.pop(tenant, None) == (stat.st_mtime_ns, stat.st_size):
+                        continue
+                    try:
+                        self._store(kind, tenant, entry.path, stat)
+                    except (yaml.YAMLError, ValueError) as error:
+                        logging.warning("Skipping unparseable inventory file %s: %s", entry.path, error)
+                        continue
+                    parsed += 1
+
+            # Whatever is left has no file any more.
+            self.connection.executemany('DELETE FROM inventory WHERE kind = ? AND tenant = ?',
+                                        [(kind, tenant) for tenant in cached])
+
+        return parsed, len(cached)
+
+    def tenants(self, kind='vars', products=None, regions=None):
+        ''' Names of the tenants with any of the given products and in any of the given regions (either
+        filter can be left out), after bringing the cache up to date '''
+        self.refresh(kind)
+
+        query = 'SELECT tenant FROM inventory WHERE kind = ?'
+        parameters = [kind]
+        for column, values in [('product', products), ('region', regions)]:
+            if values:
+                query += f" AND {column} IN ({', '.join('?' * len(values))})"
+                parameters += [str(value) for value in values]
+
+        return [tenant for tenant, in self.connection.execute(query + ' ORDER BY tenant', parameters)]
+
+
+def get_args():
+    ''' process commandline arguments '''
+    parser = argparse.ArgumentParser(
+        description='Query the customer inventory in ANSIBLE_DATA_DIR')
+    parser.add_argument('--data-dir', dest='data_dir', action='store', default=os.environ.get('ANSIBLE_DATA_DIR'),
+                        help='Inventory checkout (defaults to $ANSIBLE_DATA_DIR)')
+    parser.add_argument('--kind', dest='kind', action='store', choices=list(inventory_sources), default='vars',
+                        help='Which inventory files to query')
+    parser.add_argument('--product', dest='products', action='store', nargs='+', default=None,
+                        help='Only tenants with one of these products')
+    parser.add_argument('--region', dest='regions', action='store', nargs='+', default=None,
+                        help='Only tenants in one of these regions')
+    parser.add_argument('--tenant', dest='tenant', action='store', default=None,
+                        help='Print one tenant\'s inventory as JSON instead')
+    return parser.parse_args()
+
+
+def main():
+    ''' main body of the script '''
+    args = get_args()
+    if not args.data_dir:
+        logging.error("ANSIBLE_DATA_DIR environmental variable not found and --data-dir not given")
+        exit(1)
+
+    store = InventoryStore(args.data_dir)
+    try:
+        if args.tenant:
+            print(json.dumps(store.get(args.tenant, args.kind), indent=2, default=str))
+        else:
+            for tenant in store.tenants(args.kind, args.products, args.regions):
+                print(tenant)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+'''
+Bounded, per-attempt capture of terraform output for infra_service.py.
+'''
+
+import collections
+import gzip
+import logging
+import os
+import tempfile
+
+
+class SegmentedLogCapture(logging.Handler):
+    ''' Logging handler that keeps the output of the current segment (the plan, or one apply attempt)
+    in a fixed size ring buffer. Lines pushed out of the buffer are spilled to a gzip file on disk,
+    so memory stays flat however verbose terraform gets or however many attempts are made. A segment's
+    spill file is removed once the segment is over, or when the handler is closed. '''
+
+    def __init__(self, max_lines=5000, spill_dir=None):
+        super().__init__()
+        if max_lines < 1:
+            raise ValueError(f"max_lines must be at least 1, not {max_lines}")
+        self.max_lines = max_lines
+        self.spill_dir = spill_dir or os.environ.get('INFRA_LOG_SPILL_DIR', tempfile.gettempdir())
+        self.lines = collections.deque(maxlen=max_lines)
+        self.segment = None
+        self.spill_path = None
+        self.spill_handle = None
+        self.spilled_lines = 0
+
+    def start_segment(self, name):
+        ''' Start a new segment. Earlier output is no longer visible through getvalue() '''
+        self.acquire()
+        try:
+            self._remove_spill()
+            self.lines.clear()
+            self.segment = name
+            self.spilled_lines = 0
+        finally:
+            self.release()
+
+    def emit(self, record):
+        try:
+            text = self.format(record)
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+            return
+
+        for line in text.splitlines():
+            if len(self.lines) == self.max_lines:
+                self._spill(self.lines[0])
+            self.lines.append(line)
+
+    def getvalue(self):
+        ''' The in-memory tail of the current segment, in the same form io.StringIO.getvalue() gives '''
+        self.acquire()
+        try:
+            return '\n'.join(self.lines) + '\n' if self.lines else ''
+        finally:
+            self.release()
+
+    def spill_note(self):
+        ''' A line for the operator saying where the rest of the segment went, or None if nothing was spilled '''
+        if not self.spilled_lines:
+            return None
+        return (f"{self.spilled_lines} earlier lines of {self.segment} were written to {self.spill_path} "
+                f"(removed when the next segment starts or the run ends)")
+
+    def close(self):
+        self.acquire()
+        try:
+            self._remove_spill()
+        finally:
+            self.release()
+        super().close()
+
+    def _spill(self, line):
+        if self.spill_handle is None:
+            spill_fd, self.spill_path = tempfile.mkstemp(prefix=f"infra_service-{self.segment}-", suffix='.log.gz',
+                                                         dir=self.spill_dir)
+            os.close(spill_fd)
+            self.spill_handle = gzip.open(self.spill_path, 'wt', encoding='utf-8')
+        self.spill_handle.write(line + '\n')
+        self.spilled_lines += 1
+
+    def _close_spill(self):
+        if self.spill_handle is not None:
+            self.spill_handle.close()
+            self.spill_handle = None
+
+    def _remove_spill(self):
+        self._close_spill()
+        if self.spill_path is not None:
+            try:
+                os.remove(self.spill_path)
+            except FileNotFoundError:
+                pass
+            self.spill_path = None
@@ -0,0 +1,151 @@
+'''
+HTTP level login smoke check for campaign instances, run concurrently across many tenants.
+'''
+
+import asyncio
+import html.parser
+import time
+import urllib.parse
+
+import aiohttp
+
+logon_path = '/xtk/logon.jssp?ims=0'
+
+# Text on the page a successful login lands on.
+success_markers = ['Your instance has been upgraded to repo']
+
+default_concurrency = 20
+# How long an instance gets to start answering with a login form, and how often it is asked.
+default_ready_timeout_seconds = 300
+default_poll_seconds = 5
+default_request_timeout_seconds = 30
+
+
+class LogonFormParser(html.parser.HTMLParser):
+    ''' Pulls the login form out of the logon page: where it posts to, its fields, and the names of the
+    #username and #password inputs '''
+
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self.current = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form':
+            self.current = {"action": attrs.get('action', ''), "method": (attrs.get('method') or 'get').lower(),
+                            "fields": {}, "username": None, "password": None}
+            self.forms.append(self.current)
+        elif tag == 'input' and self.current is not None and attrs.get('name'):
+            self.current['fields'][attrs['name']] = attrs.get('value') or ''
+            if attrs.get('id') in ['username', 'password']:
+                self.current[attrs['id']] = attrs['name']
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self.current = None
+
+    def logon_form(self):
+        ''' The form with the password field, or None '''
+        for form in self.forms:
+            if form['password'] and form['username']:
+                return form
+        return None
+
+
+def parse_logon_form(page):
+    ''' The login form on a page, or None if the page doesn't have one '''
+    parser = LogonFormParser()
+    parser.feed(page)
+    return parser.logon_form()
+
+
+async def wait_for_logon_form(session, logon_url, deadline, poll_seconds):
+    ''' Poll the logon page until it answers with a login form. Returns the form and the URL it came from,
+    or raises TimeoutError with the last thing that went wrong. '''
+    last_problem = 'no response'
+    while True:
+        try:
+            async with session.get(logon_url) as response:
+                page = await response.text(errors='replace')
+                if response.status == 200:
+                    form = parse_logon_form(page)
+                    if form is not None:
+                        return form, str(response.url)
+                    last_problem = 'logon page has no login form'
+                else:
+                    last_problem = f"logon page returned HTTP {response.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            last_problem = f"{type(error).__name__}: {error}"
+
+        if time.monotonic() + poll_seconds > deadline:
+            raise TimeoutError(f"instance not ready: {last_problem}")
+        await asyncio.sleep(poll_seconds)
+
+
+async def check_login(session, instance_url, username, password, ready_timeout=default_ready_timeout_seconds,
+                      poll_seconds=default_poll_seconds):
+    ''' Log in to one instance. Returns whether it worked and why not. '''
+    logon_url = instance_url.rstrip('/') + logon_path
+    deadline = time.monotonic() + ready_timeout
+
+    try:
+        form, form_url = await wait_for_logon_form(session, logon_url, deadline, poll_seconds)
+    except TimeoutError as error:
+        return False, str(error)
+
+    fields = dict(form['fields'])
+    fields[form['username']] = username
+    fields[form['password']] = password
+    action_url = urllib.parse.urljoin(form_url, form['action'] or form_url)
+
+    try:
+        if form['method'] == 'post':
+            request = session.post(action_url, data=fields)
+        else:
+            request = session.get(action_url, params=fields)
+        async with request as response:
+            page = await response.text(errors='replace')
+            status = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        return False, f"login request failed: {type(error).__name__}: {error}"
+
+    if status >= 400:
+        return False, f"login returned HTTP {status}"
+    if any(marker in page for marker in success_markers):
+        return True, 'logged in'
+    # Being handed the login form again means the credentials were refused.
+    if parse_logon_form(page) is not None:
+        return False, 'login form shown again after logging in'
+    # Anything else (an error page, a redirect somewhere unrelated) isn't a login that worked.
+    return False, 'no login form, but not the page a login lands on either'
+
+
+async def check_tenant(connector, semaphore, check, ready_timeout, poll_seconds):
+    ''' Check one tenant, with its own cookies but the shared connection pool '''
+    async with semaphore:
+        start = time.monotonic()
+        timeout = aiohttp.ClientTimeout(total=default_request_timeout_seconds)
+        async with aiohttp.ClientSession(connector=connector, connector_owner=False, timeout=timeout) as session:
+            success, reason = await check_login(session, check['url'], check['username'], check['password'],
+                                                ready_timeout, poll_seconds)
+        return {"tenant": check['tenant'], "url": check['url'], "success": success, "reason": reason,
+                "seconds": round(time.monotonic() - start, 2)}
+
+
+async def check_logins(checks, concurrency=default_concurrency, ready_timeout=default_ready_timeout_seconds,
+                       poll_seconds=default_poll_seconds):
+    ''' Check every tenant in checks (dicts of tenant, url, username and password), at most concurrency at once '''
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+    try:
+        return await asyncio.gather(*[check_tenant(connector, semaphore, check, ready_timeout, poll_seconds)
+                                      for check in checks])
+    finally:
+        await connector.close()
+
+
+def run_login_checks(checks, concurrency=default_concurrency, ready_timeout=default_ready_timeout_seconds,
+                     poll_seconds=default_poll_seconds):
+    ''' Synchronous entry point for check_logins '''
+    return asyncio.run(check_logins(checks, concurrency, ready_timeout, poll_seconds))
@@ -0,0 +1,156 @@
+'''
+Timing spans and per-resource durations for infra_service.py, written as JSON lines and as a Prometheus
+textfile collector file.
+'''
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import socket
+import time
+
+from tf_output import resource_durations, resource_type
+
+# The collector spans are recorded into. Runs in one process happen one after the other, so there is only
+# ever one; outside collecting() spans cost nothing and go nowhere.
+active = None
+
+
+class RunMetrics:
+    ''' Everything measured during one run of one terraform working directory '''
+
+    def __init__(self, tenant, working_dir):
+        self.tenant = tenant
+        self.working_dir = working_dir
+        self.started = time.time()
+        self.finished = None
+        self.exit_code = None
+        self.spans = []
+        self.resources = []
+
+    def add_span(self, name, start, seconds, labels):
+        ''' Record a finished span '''
+        self.spans.append({"name": name, "start": start, "seconds": round(seconds, 3), "labels": labels})
+
+    def add_resources(self, output, phase):
+        ''' Record how long each resource in a chunk of apply/destroy output took '''
+        for address, action, seconds in resource_durations(output):
+            self.resources.append({"address": address, "resource_type": resource_type(address),
+                                   "action": action, "seconds": seconds, "phase": phase})
+
+    def finish(self, exit_code):
+        ''' Mark the run as over '''
+        self.finished = time.time()
+        self.exit_code = exit_code
+
+    def json_lines(self):
+        ''' One JSON object per span and per resource, then one for the run as a whole '''
+        run = {"tenant": self.tenant, "working_dir": self.working_dir, "host": socket.gethostname(),
+               "build": os.environ.get('BUILD_TAG'), "run_start": self.started}
+        lines = [dict(run, type="span", **span) for span in self.spans]
+        lines += [dict(run, type="resource", **resource) for resource in self.resources]
+        lines.append(dict(run, type="run", exit_code=self.exit_code, seconds=round((self.finished or time.time()) - self.started, 3)))
+        return [json.dumps(line, sort_keys=True) for line in lines]
+
+    def write_json_lines(self, path):
+        ''' Append this run's records to a JSON lines file '''
+        with open(path, 'a') as metrics_handle:
+            metrics_handle.write('\n'.join(self.json_lines()) + '\n')
+
+    def prometheus_text(self):
+        ''' This run in the Prometheus text exposition format '''
+        tenant = {"tenant": self.tenant}
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{{{format_labels(dict(tenant, **labels))}}} {value}")
+
+        # A phase that ran more than once (refreshes, retries) is summed, with the attempt kept apart for applies.
+        phase_seconds = collections.OrderedDict()
+        for span in self.spans:
+            labels = {"phase": span['name']}
+            if 'attempt' in span['labels']:
+                labels['attempt'] = span['labels']['attempt']
+            key = tuple(sorted(labels.items()))
+            phase_seconds[key] = phase_seconds.get(key, 0) + span['seconds']
+
+        by_type = collections.OrderedDict()
+        for resource in self.resources:
+            key = (("action", resource['action']), ("resource_type", resource['resource_type']))
+            by_type.setdefault(key, []).append(resource['seconds'])
+
+        metric('infra_service_phase_seconds', 'Time spent in each phase of the last infra_service run',
+               [(dict(key), round(seconds, 3)) for key, seconds in phase_seconds.items()])
+        metric('infra_service_resource_seconds', 'Total time terraform reported for resources of each type in the last run',
+               [(dict(key), sum(durations)) for key, durations in by_type.items()])
+        metric('infra_service_resource_max_seconds', 'Slowest resource of each type in the last run',
+               [(dict(key), max(durations)) for key, durations in by_type.items()])
+        metric('infra_service_resources', 'Resources of each type terraform finished in the last run',
+               [(dict(key), len(durations)) for key, durations in by_type.items()])
+        metric('infra_service_run_seconds', 'Duration of the last infra_service run',
+               [({}, round((self.finished or time.time()) - self.started, 3))])
+        metric('infra_service_exit_code', 'Exit code of the last infra_service run',
+               [({}, self.exit_code if self.exit_code is not None else -1)])
+        metric('infra_service_last_run_timestamp_seconds', 'When the last infra_service run finished',
+               [({}, round(self.finished or time.time(), 3))])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, textfile_dir):
+        ''' Write this run to textfile_dir for node_exporter's textfile collector, one file per tenant '''
+        file_name = 'infra_service_' + ''.join(c if c.isalnum() or c in '-_' else '_' for c in self.tenant) + '.prom'
+        path = os.path.join(textfile_dir, file_name)
+        # The collector must never see a half written file.
+        with open(path + '.tmp', 'w') as prom_handle:
+            prom_handle.write(self.prometheus_text())
+        os.replace(path + '.tmp', path)
+
+
+def format_labels(labels):
+    ''' Prometheus label set, escaped '''
+    escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in labels.items()}
+    return ','.join(f'{name}="{value}"' for name, value in sorted(escaped.items()))
+
+
+@contextlib.contextmanager
+def collecting(run_metrics):
+    ''' Make run_metrics the collector for spans and resources for the duration of the block '''
+    global active  # pylint: disable=global-statement
+    previous, active = active, run_metrics
+    try:
+        yield run_metrics
+    finally:
+        active = previous
+
+
+@contextlib.contextmanager
+def span(name, **labels):
+    ''' Time the block as a span. Labels can be added to the yielded dict inside the block. '''
+    start = time.time()
+    try:
+        yield labels
+    finally:
+        if active is not None:
+            active.add_span(name, start, time.time() - start, labels)
+
+
+def record_resources(output, phase):
+    ''' Record per-resource durations from apply/destroy output '''
+    if active is not None:
+        active.add_resources(output, phase)
+
+
+def timed(name):
+    ''' Decorator timing every call of a function as a span '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+'''
+Pick a PostgreSQL performance profile from pg_profiles.yml for a customer cluster's Azure database, or for a
+self-hosted primary from its memory and cores, and write the self-hosted settings of a profile as a
+postgresql.conf include. Hot standbys are given their primary's profile, so that they never have fewer
+connections or worker processes than it.
+'''
+
+import argparse
+import os
+import re
+
+import yaml
+
+default_profiles_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pg_profiles.yml')
+
+# Memory per vCore of each Azure Database for PostgreSQL pricing tier.
+tier_memory_gb = {"B": 2, "GP": 5, "MO": 10}
+
+# B_Gen5_2, GP_Gen5_8, MO_Gen5_32
+sku_regexp = re.compile(r'^(B|GP|MO)_\w+?_(\d+)$')
+
+
+def load_profiles(path=None):
+    ''' Read and validate the profiles data file. The path defaults to $INFRA_PG_PROFILES, then the file
+    shipped next to this one. '''
+
+    if path is None:
+        path = os.environ.get('INFRA_PG_PROFILES', default_profiles_path)
+
+    with open(path, 'r') as profiles_handle:
+        profiles = yaml.safe_load(profiles_handle) or []
+
+    for profile in profiles:
+        for key in ['name', 'azure', 'self_hosted_memory_gb', 'self_hosted']:
+            if key not in profile:
+                raise ValueError(f"PostgreSQL profile {profile} in {path} is missing '{key}'")
+        profile.setdefault('max_memory_gb', None)
+        profile.setdefault('max_instances', None)
+
+    if not profiles or profiles[-1]['max_memory_gb'] is not None or profiles[-1]['max_instances'] is not None:
+        raise ValueError(f"The last PostgreSQL profile in {path} must have no limits, so that every cluster gets one")
+
+    return profiles
+
+
+def sku_memory_gb(sku):
+    ''' Memory of an Azure database SKU, or None if the name isn't one we know how to read '''
+    match = sku_regexp.match(str(sku))
+    if match is None:
+        return None
+    return tier_memory_gb[match.group(1)] * int(match.group(2))
+
+
+def select_profile(cluster, profiles=None):
+    ''' The profile for a customer.cluster from the vars file, or None if the cluster has no database SKU '''
+    if profiles is None:
+        profiles = load_profiles()
+
+    by_name = {profile['name']: profile for profile in profiles}
+    if cluster.get('pg_profile'):
+        if cluster['pg_profile'] not in by_name:
+            raise ValueError(f"Unknown PostgreSQL profile {cluster['pg_profile']}, expected one of {', '.join(by_name)}")
+        return by_name[cluster['pg_profile']]
+
+    memory_gb = sku_memory_gb(cluster.get('db_sku'))
+    if memory_gb is None:
+        return None
+    instances = int(cluster.get('number_of_instances') or 1)
+
+    for profile in profiles:
+        if profile['max_memory_gb'] is not None and memory_gb > profile['max_memory_gb']:
+            continue
+        if profile['max_instances'] is not None and instances > profile['max_instances']:
+            continue
+        return profile
+    return profiles[-1]
+
+
+def host_memory_gb():
+    ''' Memory of the machine this runs on '''
+    with open('/proc/meminfo', 'r') as meminfo_handle:
+        for line in meminfo_handle:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) / (1024 * 1024)
+    raise ValueError("No MemTotal in /proc/meminfo")
+
+
+def select_self_hosted_profile(memory_gb, cpus, profiles=None):
+    ''' The biggest profile whose self-hosted settings a server with this much memory and this many cores
+    can hold, or None if it can't hold any '''
+    if profiles is None:
+        profiles = load_profiles()
+
+    fitting = [profile for profile in profiles
+               if profile['self_hosted_memory_gb'] <= memory_gb
+               and int(profile['self_hosted'].get('max_worker_processes', 0)) <= cpus]
+    if not fitting:
+        return None
+    return max(fitting, key=lambda profile: profile['self_hosted_memory_gb'])
+
+
+def self_hosted_conf(profile):
+    ''' postgresql.conf lines for a profile's self-hosted settings. Without a profile, none: postgresql.conf
+    stays as it is. '''
+    if profile is None:
+        return "# No PostgreSQL profile fits this server, written by pg_profiles.py. Do not edit.\n"
+    lines = [f"# PostgreSQL profile '{profile['name']}', written by pg_profiles.py from pg_profiles.yml. Do not edit.", '']
+    for name, value in profile['self_hosted'].items():
+        lines.append(f"{name} = {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def get_args():
+    ''' process commandline arguments '''
+    parser = argparse.ArgumentParser(
+        description='Write the self-hosted settings of a PostgreSQL profile for inclusion from postgresql.conf')
+    parser.add_argument('--profile', dest='profile', action='store', default=None,
+                        help='Profile to use, by name, instead of the one that fits this server')
+    parser.add_argument('--standby', dest='standby', action='store_true', default=False,
+                        help='This server is a hot standby. It needs --profile, naming the profile of its primary')
+    parser.add_argument('--memory-gb', dest='memory_gb', action='store', type=float, default=None,
+                        help='Memory of the server PostgreSQL runs on (default: this machine\'s)')
+    parser.add_argument('--cpus', dest='cpus', action='store', type=int, default=None,
+                        help='Cores of the server PostgreSQL runs on (default: this machine\'s)')
+    parser.add_argument('--output', dest='output', action='store', default='profile.conf',
+                        help='Where to write the settings')
+
+    args = parser.parse_args()
+    if args.standby and not args.profile:
+        parser.error("--standby needs --profile with the primary's profile (on the first line of the primary's profile.conf)")
+    return args
+
+
+def main():
+    ''' main body of the script '''
+    args = get_args()
+
+    if args.profile:
+        profile = select_profile({"pg_profile": args.profile})
+        memory_gb = args.memory_gb if args.memory_gb is not None else host_memory_gb()
+        if memory_gb < profile['self_hosted_memory_gb']:
+            print(f"Warning: profile {profile['name']} is written for {profile['self_hosted_memory_gb']}GB of memory "
+                  f"and this server has {memory_gb:.0f}GB", flush=True)
+    else:
+        memory_gb = args.memory_gb if args.memory_gb is not None else host_memory_gb()
+        cpus = args.cpus if args.cpus is not None else os.cpu_count()
+        profile = select_self_hosted_profile(memory_gb, cpus)
+        if profile is None:
+            print(f"{memory_gb:.0f}GB of memory and {cpus} cores is less than any PostgreSQL profile is for. "
+                  f"Leaving postgresql.conf as it is", flush=True)
+
+    with open(args.output + '.tmp', 'w') as output_handle:
+        output_handle.write(self_hosted_conf(profile))
+    os.replace(args.output + '.tmp', args.output)
+    if profile is not None:
+        print(f"Wrote PostgreSQL profile {profile['name']} to {args.output}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
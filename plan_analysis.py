@@ -0,0 +1,106 @@
+'''
+A saved terraform plan, read once from terraform show -json and indexed by resource address and action.
+'''
+
+import json
+
+from python_terraform import IsFlagged
+
+# Resource types holding data that a plan must not delete or replace behind the operator's back.
+protected_resource_types = ['azurerm_postgresql_server', 'azurerm_managed_disk']
+
+# terraform show -json actions lists, as one word.
+action_names = {
+    ("no-op",): "no-op",
+    ("read",): "read",
+    ("create",): "create",
+    ("update",): "update",
+    ("delete",): "delete",
+    ("delete", "create"): "replace",
+    ("create", "delete"): "replace"
+}
+
+# The same changes in the words plan's text output uses, which is what tf_output.planned_resources gives.
+planned_wording = {
+    "create": "will be created",
+    "update": "will be updated in-place",
+    "delete": "will be destroyed",
+    "replace": "must be replaced"
+}
+
+diff_symbols = {"create": "+", "update": "~", "delete": "-", "replace": "-/+"}
+
+# How many changed attributes of an updated resource the compact diff names.
+diff_attribute_limit = 8
+
+
+def load_plan(terra, plan_file):
+    ''' The PlanIndex for a saved plan, or None if terraform can't show it as JSON '''
+    return_code, stdout, _ = terra.cmd('show', plan_file, json=IsFlagged, no_color=IsFlagged)
+    if return_code != 0 or not stdout.strip():
+        return None
+    try:
+        return PlanIndex(json.loads(stdout))
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def changed_attributes(change):
+    ''' Top level attributes an update changes, including those only known after apply '''
+    before = change.get('before') or {}
+    after = change.get('after') or {}
+    after_unknown = change.get('after_unknown') or {}
+    keys = set(before) | set(after) | set(key for key, unknown in after_unknown.items() if unknown)
+    return sorted(key for key in keys if before.get(key) != after.get(key) or after_unknown.get(key))
+
+
+class PlanIndex:
+    ''' Every resource change in a plan, by address and by action '''
+
+    def __init__(self, plan_json):
+        self.changes = {}
+        self.by_action = {}
+        for resource_change in plan_json.get('resource_changes') or []:
+            action = action_names.get(tuple(resource_change['change']['actions']), 'update')
+            self.changes[resource_change['address']] = {"type": resource_change['type'], "action": action,
+                                                        "change": resource_change['change']}
+            self.by_action.setdefault(action, []).append(resource_change['address'])
+
+    def addresses(self, *actions):
+        ''' Addresses with any of the given actions '''
+        return sorted(address for action in actions for address in self.by_action.get(action, []))
+
+    @property
+    def no_changes(self):
+        return not self.addresses('create', 'update', 'delete', 'replace')
+
+    def planned(self):
+        ''' Map of address to planned change, as tf_output.planned_resources reads it from plan's text output '''
+        return {address: planned_wording[change['action']] for address, change in self.changes.items()
+                if change['action'] in planned_wording}
+
+    def summary(self):
+        ''' The Plan: line terraform prints, counted the same way (a replacement is an add and a destroy) '''
+        added = len(self.addresses('create', 'replace'))
+        changed = len(self.addresses('update'))
+        destroyed = len(self.addresses('delete', 'replace'))
+        return f"Plan: {added} to add, {changed} to change, {destroyed} to destroy."
+
+    def unexpected_destroys(self, resource_types=None):
+        ''' (address, action) for every protected resource the plan deletes or replaces '''
+        resource_types = protected_resource_types if resource_types is None else resource_types
+        return [(address, self.changes[address]['action']) for address in self.addresses('delete', 'replace')
+                if self.changes[address]['type'] in resource_types]
+
+    def compact_diff(self, actions=None):
+        ''' One line per changed resource, naming the attributes that change on updates '''
+        lines = []
+        for address in self.addresses(*(actions or diff_symbols)):
+            change = self.changes[address]
+            line = f"{diff_symbols[change['action']]} {address}"
+            if change['action'] == 'update':
+                attributes = changed_attributes(change['change'])
+                more = len(attributes) - diff_attribute_limit
+                line += f": {', '.join(attributes[:diff_attribute_limit])}" + (f" and {more} more" if more > 0 else '')
+            lines.append(line)
+        return lines
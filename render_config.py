@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+'''
+Render azuretf.jinja into terraform config for one or many customer environments.
+'''
+
+import argparse
+import glob
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import shutil
+import time
+
+import jinja2
+import yaml
+
+from pg_profiles import load_profiles, select_profile
+from stack_layers import layer_dependencies, layer_names
+
+template_dir = os.path.dirname(os.path.abspath(__file__))
+default_template = 'azuretf.jinja'
+default_cache_dir = os.environ.get('INFRA_TEMPLATE_CACHE', os.path.expanduser('~/.cache/infra_service/templates'))
+
+# Records, per output directory, what each rendered file was rendered from.
+render_manifest_file = '.render_manifest.json'
+
+# Config next to the rendered file that every layer needs a copy of (variable declarations and values).
+layer_shared_patterns = ['*.tf', '*.tfvars', '*.tfvars.json']
+
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# How azuretf.jinja writes the *_allow firewall rules (vars file key nsg_rule_mode): one rule per address as it
+# used to, one rule per purpose with every address in it, or both while a tenant moves from one to the other.
+nsg_rule_modes = ['per_ip', 'both', 'aggregated']
+
+
+def get_args():
+    ''' process commandline arguments '''
+    parser = argparse.ArgumentParser(
+        description='Render terraform config from the customer vars files')
+    parser.add_argument('vars_files', nargs='+',
+                        help='Customer vars (YAML) files to render')
+    parser.add_argument('--output-dir', dest='output_dir', action='store', required=True,
+                        help='Where to write the rendered config')
+    parser.add_argument('--per-tenant', dest='per_tenant', action='store_true', default=False,
+                        help='Write each vars file to its own subdirectory of --output-dir, named after the file')
+    parser.add_argument('--template', dest='template', action='store', default=default_template,
+                        help='Template to render, relative to this script')
+    parser.add_argument('--output-name', dest='output_name', action='store', default='customer.tf',
+                        help='File name of the rendered config')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store', default=default_cache_dir,
+                        help='Where compiled templates are kept between runs')
+    parser.add_argument('--force', dest='force', action='store_true', default=False,
+                        help='Render even if nothing changed since the last render')
+    parser.add_argument('--layers', dest='layers', action='store', nargs='*', default=None,
+                        help=f"Render the stack as separate layers, each into its own subdirectory of the output directory "
+                             f"(all of {', '.join(layer_names)} if none are named)")
+    return parser.parse_args()
+
+
+def stable_id(value, length=16):
+    ''' Short hex digest of a value, for names that must be unique but must not change between renders '''
+    return hashlib.sha256(str(value).encode('utf-8')).hexdigest()[:length]
+
+
+def address_values(address_maps):
+    ''' Every address in the given name to address maps (or lists), without duplicates '''
+    addresses = []
+    for address_map in address_maps:
+        values = address_map.values() if isinstance(address_map, dict) else (address_map or [])
+        addresses.extend(str(value).strip() for value in values if value not in [None, ''])
+    return sorted(set(addresses))
+
+
+def address_prefixes(*address_maps):
+    ''' The addresses of the given maps as NSG source_address_prefixes: adjoining networks merged, single
+    hosts written without a prefix length, anything that isn't an address (service tags) kept as it is '''
+    networks = []
+    others = []
+    for address in address_values(address_maps):
+        try:
+            networks.append(ipaddress.ip_network(address, strict=False))
+        except ValueError:
+            others.append(address)
+
+    prefixes = []
+    for version in [4, 6]:
+        for network in ipaddress.collapse_addresses(network for network in networks if network.version == version):
+            prefixes.append(str(network.network_address) if network.prefixlen == network.max_prefixlen else str(network))
+    return prefixes + others
+
+
+def ip_ranges(*address_maps):
+    ''' The addresses of the given maps, each an address or a first-last range, as the fewest [first, last]
+    ranges that cover exactly the same addresses '''
+    ranges = []
+    for address in address_values(address_maps):
+        first, _, last = address.partition('-')
+        ranges.append((ipaddress.ip_address(first.strip()), ipaddress.ip_address((last or first).strip())))
+
+    merged = []
+    for first, last in sorted(ranges, key=lambda bounds: (bounds[0].version, bounds[0], bounds[1])):
+        if merged and merged[-1][1].version == first.version and int(first) <= int(merged[-1][1]) + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return [[str(first), str(last)] for first, last in merged]
+
+
+def build_environment(cache_dir=default_cache_dir):
+    ''' Jinja environment with the template filters and a persistent compiled-template cache '''
+    os.makedirs(cache_dir, exist_ok=True)
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                                     bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir),
+                                     keep_trailing_newline=True)
+    environment.filters['stable_id'] = stable_id
+    environment.filters['address_prefixes'] = address_prefixes
+    environment.filters['ip_ranges'] = ip_ranges
+    return environment
+
+
+def with_pg_profile(context, profiles):
+    ''' The template context, plus the PostgreSQL performance profile for the customer's cluster as pg_profile '''
+    cluster = (context.get('customer') or {}).get('cluster') or {}
+    return dict(context, pg_profile=select_profile(cluster, profiles))
+
+
+def content_hash(data):
+    ''' sha256 of a string '''
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def load_manifest(output_dir):
+    ''' The render manifest for an output directory '''
+    manifest_path = os.path.join(output_dir, render_manifest_file)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as manifest_handle:
+        try:
+            return json.load(manifest_handle)
+        except ValueError:
+            return {}
+
+
+def save_manifest(output_dir, manifest):
+    ''' Write the render manifest for an output directory '''
+    manifest_path = os.path.join(output_dir, render_manifest_file)
+    with open(manifest_path + '.tmp', 'w') as manifest_handle:
+        json.dump(manifest, manifest_handle, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def render(environment, template_name, context, output_path, force=False):
+    ''' Render one template to output_path. Returns False if the inputs, the template and the existing output
+    are all exactly as they were for the last render, in which case nothing is done. '''
+
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    output_name = os.path.basename(output_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    template_source = environment.loader.get_source(environment, template_name)[0]
+    input_hash = content_hash(template_name + '\0' + template_source + '\0' +
+                              json.dumps(context, sort_keys=True, default=str))
+
+    manifest = load_manifest(output_dir)
+    previous = manifest.get(output_name, {})
+
+    existing_output = None
+    if os.path.exists(output_path):
+        with open(output_path, 'r') as output_handle:
+            existing_output = output_handle.read()
+
+    # The output hash check catches hand edits to the rendered file, which the next render should undo.
+    if (not force and existing_output is not None and previous.get('input_hash') == input_hash
+            and previous.get('output_hash') == content_hash(existing_output)):
+        return False
+
+    output = environment.get_template(template_name).render(**context)
+
+    # Leave the file alone if it came out the same, so its mtime keeps meaning something.
+    if output != existing_output:
+        with open(output_path + '.tmp', 'w') as output_handle:
+            output_handle.write(output)
+        os.replace(output_path + '.tmp', output_path)
+
+    manifest[output_name] = {"input_hash": input_hash, "output_hash": content_hash(output)}
+    save_manifest(output_dir, manifest)
+
+    return True
+
+
+def share_with_layers(output_dir, output_name, layers):
+    ''' Copy the config files every layer needs from the output directory into the layer directories '''
+    for pattern in layer_shared_patterns:
+        for shared_path in glob.glob(os.path.join(output_dir, pattern)):
+            if os.path.basename(shared_path) == output_name:
+                continue
+            for layer in layers:
+                layer_dir = os.path.join(output_dir, layer)
+                os.makedirs(layer_dir, exist_ok=True)
+                shutil.copy2(shared_path, layer_dir)
+
+
+def main():
+    ''' main body of the script '''
+    logging.basicConfig(level=logging.INFO)
+
+    args = get_args()
+    environment = build_environment(args.cache_dir)
+    profiles = load_profiles()
+
+    layers = None
+    if args.layers is not None:
+        layers = args.layers or layer_names
+        for layer in layers:
+            if layer not in layer_dependencies:
+                raise ValueError(f"Unknown layer {layer}, expected one of {', '.join(layer_names)}")
+
+    start = time.time()
+    rendered = 0
+    skipped = 0
+
+    for vars_path in args.vars_files:
+        with open(vars_path, 'r') as vars_handle:
+            context = with_pg_profile(yaml.load(vars_handle, Loader=yaml_loader), profiles)
+        if context.get('nsg_rule_mode', 'per_ip') not in nsg_rule_modes:
+            raise ValueError(f"Unknown nsg_rule_mode {context['nsg_rule_mode']} in {vars_path}, expected one of {', '.join(nsg_rule_modes)}")
+
+        if args.per_tenant:
+            tenant = os.path.splitext(os.path.basename(vars_path))[0]
+            output_path = os.path.join(args.output_dir, tenant, args.output_name)
+        else:
+            output_path = os.path.join(args.output_dir, args.output_name)
+
+        if layers is None:
+            targets = [(output_path, context)]
+        else:
+            # One working directory per layer, each with its own state: <output dir>/<layer>/<output name>
+            output_dir, output_name = os.path.split(output_path)
+            share_with_layers(output_dir, output_name, layers)
+            targets = [(os.path.join(output_dir, layer, output_name),
+                        dict(context, layer=layer, layer_dependencies=layer_dependencies)) for layer in layers]
+
+        for target_path, target_context in targets:
+            if render(environment, args.template, target_context, target_path, args.force):
+                logging.info("Rendered %s from %s", target_path, vars_path)
+                rendered += 1
+            else:
+                logging.debug("%s is up to date", target_path)
+                skipped += 1
+
+    logging.info("Rendered %d, unchanged %d, in %.2f seconds", rendered, skipped, time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
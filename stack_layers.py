@@ -0,0 +1,90 @@
+'''
+The layers a customer stack can be split into, and the order they have to run in.
+'''
+
+import glob
+import os
+import re
+
+# Which layers each layer reads state outputs from. Must agree with the refs in azuretf.jinja.
+layer_dependencies = {
+    "network": [],
+    "database": ["network"],
+    "compute": ["network"],
+    "dns": ["network", "compute"],
+    "sink": ["network", "compute"]
+}
+
+layer_names = list(layer_dependencies)
+
+# The state of a stack that runs as a single workspace, and of each layer in its own subdirectory.
+state_file = 'terraform.tfstate'
+
+resource_regexp = re.compile(r'^\s*resource\s+"([^"]+)"\s+"([^"]+)"')
+
+# terraform state list prints one resource instance per line: type.name, type.name[0] or type.name["key"]
+instance_key_regexp = re.compile(r'\[[^\]]*\]$')
+
+
+def layer_waves(layers=None, destroy=False):
+    ''' Group layers into waves that can run in parallel: every layer comes after the layers it depends on.
+    A destroy goes the other way round, so nothing is removed while a later layer still uses it.
+    Dependencies outside the requested layers are assumed to be in place already. '''
+
+    if layers is None:
+        layers = layer_names
+
+    for layer in layers:
+        if layer not in layer_dependencies:
+            raise ValueError(f"Unknown layer {layer}, expected one of {', '.join(layer_names)}")
+
+    remaining = [layer for layer in layer_names if layer in layers]
+    placed = set()
+    waves = []
+
+    while remaining:
+        wave = [layer for layer in remaining
+                if all(dependency in placed or dependency not in remaining for dependency in layer_dependencies[layer])]
+        waves.append(wave)
+        placed.update(wave)
+        remaining = [layer for layer in remaining if layer not in placed]
+
+    if destroy:
+        waves.reverse()
+
+    return waves
+
+
+def layer_dependents(layer):
+    ''' Layers that read state outputs from this one '''
+    return [name for name in layer_names if layer in layer_dependencies[name]]
+
+
+def resource_address(instance_address):
+    ''' The resource an instance address from terraform state list belongs to '''
+    return instance_key_regexp.sub('', instance_address)
+
+
+def config_resources(config_dir):
+    ''' Addresses of the managed resources declared by the rendered config in a directory '''
+    addresses = []
+    for config_path in sorted(glob.glob(os.path.join(config_dir, '*.tf'))):
+        with open(config_path, 'r') as config_handle:
+            for line in config_handle:
+                match = resource_regexp.match(line)
+                if match:
+                    addresses.append(f"{match.group(1)}.{match.group(2)}")
+    return addresses
+
+
+def resource_layers(stack_dir, layers=None):
+    ''' Which layer each managed resource of a stack rendered as layers is declared in '''
+    if layers is None:
+        layers = layer_names
+
+    owners = {}
+    for layer in layers:
+        for address in config_resources(os.path.join(stack_dir, layer)):
+            if owners.setdefault(address, layer) != layer:
+                raise ValueError(f"{address} is declared in both the {owners[address]} and {layer} layers")
+    return owners
@@ -0,0 +1,40 @@
+'''
+Shared fixtures. The tests run the scripts against the stand-ins in bench/ rather than Azure.
+'''
+
+import os
+import sys
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+fake_terraform_path = os.path.join(repo_dir, 'bench', 'fake_terraform.py')
+
+
+@pytest.fixture
+def fake_terraform(tmp_path, monkeypatch):
+    ''' infra_service pointed at the fake terraform, with its caches kept inside tmp_path '''
+    import infra_service
+
+    wrapper_path = tmp_path / 'terraform'
+    wrapper_path.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{fake_terraform_path}" "$@"\n')
+    wrapper_path.chmod(0o755)
+
+    (tmp_path / 'plugin-cache').mkdir()
+    monkeypatch.setenv('TF_PLUGIN_CACHE_DIR', str(tmp_path / 'plugin-cache'))
+    monkeypatch.setenv('INFRA_LOG_SPILL_DIR', str(tmp_path))
+    monkeypatch.setattr(infra_service, 'terraform_bin_path', str(wrapper_path))
+    return str(wrapper_path)
+
+
+@pytest.fixture
+def working_dir(tmp_path):
+    ''' A rendered config with a few resources for the fake terraform '''
+    working_dir = tmp_path / 'modules'
+    working_dir.mkdir()
+    (working_dir / 'customer.tf').write_text('provider "azurerm" {\n  subscription_id = "test"\n}\n\n'
+                                             'resource "azurerm_resource_group" "rg" {\n}\n\n'
+                                             'resource "azurerm_virtual_network" "vnet" {\n}\n')
+    return str(working_dir)
@@ -0,0 +1,36 @@
+import json
+import os
+
+import infra_service
+from archive_terraform_artifacts import archive, collect_artifacts
+
+
+def run_infra_service(working_dir, *argv):
+    return infra_service.run_workspace(infra_service.get_args(['--retry-backoff', '0'] + list(argv)), working_dir)
+
+
+def test_applied_plan_is_archived(fake_terraform, working_dir, tmp_path):
+    assert run_infra_service(working_dir, '--apply') == infra_service.exit_codes['SUCCESS']
+
+    # The plan cache now says "no changes", which describes the state after the apply, not the plan.
+    with open(os.path.join(working_dir, '.infra_plan_cache.json')) as cache_handle:
+        assert json.load(cache_handle)['no_changes']
+
+    assert 'tfplan' in collect_artifacts(working_dir)
+    assert archive(working_dir, str(tmp_path / 'archive'), 'tenant')
+    with open(tmp_path / 'archive' / 'tenant' / 'manifest.json') as manifest_handle:
+        assert 'tfplan' in json.load(manifest_handle)['files']
+
+
+def test_plan_without_changes_is_not_archived(fake_terraform, working_dir):
+    assert run_infra_service(working_dir, '--apply') == infra_service.exit_codes['SUCCESS']
+    assert run_infra_service(working_dir, '--no-plan-cache') == infra_service.exit_codes['APPLY_NOT_SPECIFIED']
+
+    # A fresh plan that changes nothing replaced the applied one.
+    assert os.path.exists(os.path.join(working_dir, 'tfplan'))
+    assert 'tfplan' not in collect_artifacts(working_dir)
+
+
+def test_unapplied_plan_with_changes_is_archived(fake_terraform, working_dir):
+    assert run_infra_service(working_dir) == infra_service.exit_codes['APPLY_NOT_SPECIFIED']
+    assert 'tfplan' in collect_artifacts(working_dir)
@@ -0,0 +1,99 @@
+'''
+destroy.py's coalescing committer, against a local bare repository standing in for the inventory remote.
+'''
+
+import os
+import subprocess
+
+import pytest
+
+import destroy
+
+tenants = ['acme', 'globex', 'initech']
+
+
+def git(cwd, *args):
+    return subprocess.run(['git'] + list(args), cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    ''' A checkout of a bare "origin" holding metadata for a few tenants '''
+    for name, value in [('NAME', 'Test'), ('EMAIL', 'test@example.com')]:
+        monkeypatch.setenv(f'GIT_AUTHOR_{name}', value)
+        monkeypatch.setenv(f'GIT_COMMITTER_{name}', value)
+    monkeypatch.setattr(destroy, 'queue_dir', str(tmp_path / 'queue'))
+    monkeypatch.setattr(destroy, 'push_backoff_seconds', 0)
+
+    origin_dir = tmp_path / 'origin.git'
+    git(tmp_path, 'init', '-q', '--bare', '--initial-branch=master', str(origin_dir))
+    git(tmp_path, 'clone', '-q', str(origin_dir), 'data')
+    data_dir = tmp_path / 'data'
+    git(data_dir, 'checkout', '-q', '-b', 'master')
+    for sub_dir, suffix in destroy.metadata_paths:
+        (data_dir / sub_dir).mkdir()
+        for tenant in tenants:
+            (data_dir / sub_dir / (tenant + suffix)).write_text(f'{tenant}\n')
+    git(data_dir, 'add', '-A')
+    git(data_dir, 'commit', '-q', '-m', 'metadata')
+    git(data_dir, 'push', '-q', 'origin', 'master')
+    return str(data_dir)
+
+
+def origin_files(data_dir):
+    git(data_dir, 'fetch', '-q', 'origin')
+    return git(data_dir, 'ls-tree', '-r', '--name-only', 'origin/master').split()
+
+
+def checkout_is_clean(data_dir):
+    return git(data_dir, 'status', '--porcelain') == '' and git(data_dir, 'rev-parse', 'HEAD') == git(data_dir, 'rev-parse', 'origin/master')
+
+
+def test_queued_requests_are_coalesced_into_one_commit(data_dir):
+    first_path = destroy.spool_request(['acme'], 'job 1')
+    second_path = destroy.spool_request(['globex', 'acme'], 'job 2')
+    commits_before = git(data_dir, 'rev-list', '--count', 'HEAD')
+
+    first = destroy.process_queue(data_dir, first_path)
+    second = destroy.process_queue(data_dir, second_path)
+
+    assert first['success'] and first['commit']
+    assert second == first
+    assert int(git(data_dir, 'rev-list', '--count', 'origin/master')) == int(commits_before) + 1
+    assert origin_files(data_dir) == ['api_data/initech.json', 'inventory/initech.yml', 'vars/initech.yml']
+    assert 'job 1, job 2' in git(data_dir, 'log', '-1', '--format=%s', 'origin/master')
+    assert os.listdir(destroy.queue_dir) == ['.leader.lock']
+
+
+def test_rejected_push_leaves_the_checkout_as_origin_has_it(data_dir):
+    hook_path = os.path.join(data_dir, '..', 'origin.git', 'hooks', 'pre-receive')
+    with open(hook_path, 'w') as hook_handle:
+        hook_handle.write('#!/bin/sh\necho rejected >&2\nexit 1\n')
+    os.chmod(hook_path, 0o755)
+
+    result = destroy.commit_removals(data_dir, ['acme'], 'job 1')
+
+    assert not result['success']
+    assert 'push' in result['error']
+    assert checkout_is_clean(data_dir)
+    assert os.path.exists(os.path.join(data_dir, 'vars', 'acme.yml'))
+
+    # Once the remote takes pushes again, the next run goes through.
+    os.remove(hook_path)
+    assert destroy.commit_removals(data_dir, ['acme'], 'job 2')['success']
+    assert 'vars/acme.yml' not in origin_files(data_dir)
+    assert checkout_is_clean(data_dir)
+
+
+def test_a_removal_committed_but_never_pushed_is_pushed(data_dir):
+    # A run that was killed between commit and push, leaving an uncommitted deletion behind too.
+    git(data_dir, 'rm', '-q', 'vars/acme.yml', 'inventory/acme.yml', 'api_data/acme.json')
+    git(data_dir, 'commit', '-q', '-m', 'unpushed removal')
+    os.remove(os.path.join(data_dir, 'vars', 'globex.yml'))
+
+    result = destroy.commit_removals(data_dir, ['acme'], 'job 2')
+
+    assert result['success'] and result['commit']
+    assert not [path for path in origin_files(data_dir) if 'acme' in path]
+    assert 'vars/globex.yml' in origin_files(data_dir)
+    assert checkout_is_clean(data_dir)
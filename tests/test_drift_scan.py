@@ -0,0 +1,112 @@
+'''
+drift_scan.py: scan order, the per-subscription read budget, and whole scans against the fake terraform.
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import types
+
+import pytest
+
+import drift_scan
+import infra_service
+
+subscription_config = 'provider "azurerm" {\n  subscription_id = "test"\n}\n\n'
+
+
+def order_args(**overrides):
+    return argparse.Namespace(**dict({"min_interval": 3600, "change_boost": 86400}, **overrides))
+
+
+def entry(last_scan, result='CLEAN', changed_count=0, fingerprint='same'):
+    return {"last_scan": last_scan, "result": result, "changed_count": changed_count, "fingerprint": fingerprint}
+
+
+def test_scan_order_puts_new_then_stalest_first_and_skips_recent_scans():
+    now = 1000000
+    entries = {"recent": entry(now - 60), "old": entry(now - 7200), "older": entry(now - 9000),
+               "recent_changed": entry(now - 60, fingerprint='before'), "drifted": entry(now - 5000, 'DRIFTED', 3),
+               "failed": entry(now - 4000, 'I_HAVE_NO_CLUE')}
+    tenants = ['recent', 'old', 'older', 'recent_changed', 'drifted', 'failed', 'new']
+    fingerprints = dict.fromkeys(tenants, 'same')
+
+    order = drift_scan.scan_order(tenants, entries, fingerprints, order_args(), now)
+
+    # Drifted, failed and changed environments count as a day staler than they are.
+    assert order == ['new', 'drifted', 'failed', 'recent_changed', 'older', 'old']
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(drift_scan, 'time', types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_token_bucket_lets_a_quarter_hour_of_reads_through_then_refills(clock):
+    bucket = drift_scan.TokenBucket(3600)
+
+    assert bucket.wait_seconds('sub-a', 900) == 0
+    bucket.take('sub-a', 900)
+    # One read a second comes back, so 100 reads are 100 seconds away. Other subscriptions are not affected.
+    assert bucket.wait_seconds('sub-a', 100) == pytest.approx(100)
+    assert bucket.wait_seconds('sub-b', 900) == 0
+
+    clock[0] += 100
+    assert bucket.wait_seconds('sub-a', 100) == pytest.approx(0)
+
+
+def test_token_bucket_makes_a_plan_bigger_than_the_bucket_wait_for_a_full_one(clock):
+    bucket = drift_scan.TokenBucket(3600)
+    bucket.take('sub-a', 10)
+
+    assert bucket.wait_seconds('sub-a', 5000) == pytest.approx(10)
+    clock[0] += 10
+    bucket.take('sub-a', 5000)
+    assert bucket.wait_seconds('sub-a', 1) == pytest.approx(1)
+
+
+@pytest.fixture
+def batch_dir(tmp_path, fake_terraform):
+    ''' Three environments: one applied and clean, one with changes waiting, and one whose scan process fails '''
+    batch_dir = tmp_path / 'batch'
+    for tenant in ['clean', 'drifted', 'broken']:
+        (batch_dir / tenant).mkdir(parents=True)
+        (batch_dir / tenant / 'customer.tf').write_text(subscription_config + f'resource "azurerm_resource_group" "{tenant}" {{\n}}\n')
+    subprocess.run([fake_terraform, 'apply', '-auto-approve'], cwd=str(batch_dir / 'clean'), check=True, stdout=subprocess.DEVNULL)
+    # The scan log can't be opened, which fails the scan process itself rather than the plan.
+    (batch_dir / 'broken' / drift_scan.scan_log_file).mkdir()
+    return str(batch_dir)
+
+
+def scan(monkeypatch, batch_dir, index_path):
+    monkeypatch.setattr(sys, 'argv', ['drift_scan.py', '--batch-dir', batch_dir, '--index', index_path])
+    monkeypatch.delenv('ANSIBLE_DATA_DIR', raising=False)
+    return {scan['tenant']: scan for scan in drift_scan.run_scan(drift_scan.get_args())}
+
+
+def test_failed_scans_are_recorded_and_not_rescanned_straight_away(monkeypatch, batch_dir, tmp_path):
+    index_path = str(tmp_path / 'drift.sqlite')
+
+    scans = scan(monkeypatch, batch_dir, index_path)
+
+    assert scans['clean']['result'] == 'CLEAN'
+    assert scans['drifted']['result'] == 'DRIFTED'
+    assert list(scans['drifted']['changes']) == ['azurerm_resource_group.drifted']
+    assert scans['broken']['exit_code'] == infra_service.exit_codes['I_HAVE_NO_CLUE']
+
+    index = drift_scan.DriftIndex(index_path)
+    try:
+        entries = index.entries()
+    finally:
+        index.close()
+    assert entries['broken']['error_line'].startswith('scan failed:')
+    assert entries['broken']['fingerprint'] is not None
+
+    # Everything was scanned moments ago, so there is nothing to do until a config changes.
+    assert scan(monkeypatch, batch_dir, index_path) == {}
+    with open(os.path.join(batch_dir, 'broken', 'customer.tf'), 'a') as config_handle:
+        config_handle.write('resource "azurerm_public_ip" "ip" {\n}\n')
+    assert list(scan(monkeypatch, batch_dir, index_path)) == ['broken']
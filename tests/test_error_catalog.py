@@ -0,0 +1,52 @@
+'''
+Classifying terraform output lines with error_catalog.yml.
+'''
+
+import pytest
+
+from error_catalog import load_catalog
+
+
+@pytest.fixture
+def catalog():
+    return load_catalog()
+
+
+@pytest.mark.parametrize('line, name', [
+    ('Apply complete! Resources: 3 added, 0 changed, 0 destroyed.', 'apply_complete'),
+    ('Destroy complete! Resources: 3 destroyed.', 'destroy_complete'),
+    # Matches retryable_error and generic_error: the earlier entry wins.
+    ('Error: Code="RetryableError" Message="A retryable error occurred."', 'retryable_error'),
+    ('Error: waiting for creation: context deadline exceeded', 'context_deadline_exceeded'),
+    ('Error: unknown resource type: azurerm_bench', 'unknown_resource'),
+    ('Error: something went wrong that nobody has seen before', 'generic_error'),
+])
+def test_first_matching_entry_wins(catalog, line, name):
+    assert catalog.classify(line)['name'] == name
+
+
+def test_patterns_are_searched_for_anywhere_unless_anchored(catalog):
+    assert catalog.classify('  on customer.tf line 3: RetryableError')['name'] == 'retryable_error'
+    assert catalog.classify('  Error: indented, so not the start of the line') is None
+
+
+def test_ordinary_lines_match_nothing(catalog):
+    assert catalog.classify('azurerm_resource_group.rg: Creation complete after 2s [id=/subscriptions/x]') is None
+    assert catalog.classify('') is None
+
+
+def test_order_comes_from_the_catalog_file(tmp_path):
+    catalog_path = tmp_path / 'catalog.yml'
+    catalog_path.write_text("- name: generic_error\n  pattern: '^Error:'\n  exit_code: GENERIC_FAILURE\n"
+                            "- name: retryable_error\n  pattern: 'RetryableError'\n  exit_code: RETRYABLE_ERROR\n  retryable: true\n")
+    catalog = load_catalog(str(catalog_path))
+
+    assert catalog.classify('Error: Code="RetryableError"')['name'] == 'generic_error'
+    assert catalog.classify('Code="RetryableError"')['name'] == 'retryable_error'
+
+
+def test_entries_without_an_exit_code_are_rejected(tmp_path):
+    catalog_path = tmp_path / 'catalog.yml'
+    catalog_path.write_text("- name: broken\n  pattern: 'x'\n")
+    with pytest.raises(ValueError):
+        load_catalog(str(catalog_path))
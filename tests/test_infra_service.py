@@ -0,0 +1,143 @@
+'''
+infra_service.py against the fake terraform.
+'''
+
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import pytest
+from python_terraform import Terraform
+
+import infra_service
+import tf_cache
+
+
+@pytest.mark.parametrize('argv', [['--max-attempts', '0'], ['--retry-backoff', '-1'], ['--retry-max-backoff', '-5'],
+                                  ['--refresh-ttl', '-60']])
+def test_retry_and_refresh_settings_out_of_range_are_rejected(argv, capsys):
+    with pytest.raises(SystemExit):
+        infra_service.get_args(argv)
+    assert 'must' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('attempt', [2, 3, 4, 10])
+def test_retry_delay_is_full_jitter_up_to_the_capped_exponential(attempt):
+    retry_policy = {"max_attempts": 10, "backoff_seconds": 15, "max_backoff_seconds": 100}
+    ceiling = min(100, 15 * 2 ** (attempt - 2))
+
+    delays = [infra_service.retry_delay(attempt, retry_policy) for _ in range(500)]
+
+    assert all(0 <= delay <= ceiling for delay in delays)
+    # Full jitter spreads retries over the whole range rather than bunching them at the ceiling.
+    assert min(delays) < ceiling / 4 and max(delays) > ceiling * 3 / 4
+
+
+def test_retry_applies_only_the_unfinished_resources(fake_terraform, working_dir, monkeypatch, capsys):
+    monkeypatch.setenv('FAKE_TF_ERROR', 'retryable_error')
+    monkeypatch.setenv('FAKE_TF_ERROR_AFTER', '0.5')
+    args = infra_service.get_args(['--apply', '--retry-backoff', '0'])
+
+    assert infra_service.run_workspace(args, working_dir) == infra_service.exit_codes['SUCCESS']
+
+    output = capsys.readouterr().out
+    assert 'Terraform apply attempt 2 starting' in output
+    assert 'Retrying 1 unfinished resources: azurerm_virtual_network.vnet' in output
+    assert 'Terraform apply attempt 3 starting' not in output
+
+
+def test_retry_gives_up_after_max_attempts(fake_terraform, working_dir, monkeypatch, capsys):
+    monkeypatch.setenv('FAKE_TF_ERROR', 'retryable_error')
+    monkeypatch.setenv('FAKE_TF_ERROR_ATTEMPTS', '5')
+    args = infra_service.get_args(['--apply', '--retry-backoff', '0', '--max-attempts', '2'])
+
+    assert infra_service.run_workspace(args, working_dir) == infra_service.exit_codes['RETRYABLE_ERROR']
+
+    output = capsys.readouterr().out
+    assert 'Terraform apply attempt 2 starting' in output
+    assert 'Terraform apply attempt 3 starting' not in output
+
+
+def test_streamed_output_is_cut_short_on_a_fatal_error(tmp_path):
+    # Prints a fatal error and then carries on for a minute, as terraform would with other resources still going.
+    slow_path = tmp_path / 'slow_terraform'
+    slow_path.write_text(f'#!{sys.executable}\nimport time\n'
+                         'print("Error: Operation results in exceeding approved Total Regional Cores quota.", flush=True)\n'
+                         'time.sleep(60)\nprint("Apply complete!", flush=True)\n')
+    slow_path.chmod(0o755)
+    terra = Terraform(working_dir=str(tmp_path), terraform_bin_path=str(slow_path))
+
+    start = time.time()
+    return_code, output, fatal_entry = infra_service.stream_terraform(terra, logging.getLogger('test'), 'apply')
+
+    assert time.time() - start < 30
+    assert fatal_entry['name'] == 'vm_core_quota'
+    assert return_code != 0
+    assert 'Apply complete!' not in output
+
+
+def test_streamed_apply_stops_at_a_fatal_error_without_retrying(fake_terraform, working_dir, monkeypatch, capsys):
+    monkeypatch.setenv('FAKE_TF_ERROR', 'vm_core_quota')
+    args = infra_service.get_args(['--apply', '--stream', '--retry-backoff', '0'])
+
+    assert infra_service.run_workspace(args, working_dir) == infra_service.exit_codes['VM_CORE_QUOTA']
+
+    output = capsys.readouterr().out
+    assert 'VM Core quota exceeded' in output
+    assert 'Terraform apply attempt 2 starting' not in output
+
+
+def test_streamed_apply_without_errors_succeeds(fake_terraform, working_dir, capsys):
+    args = infra_service.get_args(['--apply', '--stream'])
+
+    assert infra_service.run_workspace(args, working_dir) == infra_service.exit_codes['SUCCESS']
+    assert 'Apply complete!' in capsys.readouterr().out
+
+
+def test_init_is_skipped_until_provider_requirements_change(fake_terraform, working_dir, capsys):
+    terra = Terraform(working_dir=working_dir, terraform_bin_path=fake_terraform)
+
+    infra_service.tf_init(terra)
+    assert 'Terraform init took' in capsys.readouterr().out
+
+    with open(os.path.join(working_dir, 'customer.tf'), 'a') as config_handle:
+        config_handle.write('\nresource "azurerm_public_ip" "ip" {\n}\n')
+    infra_service.tf_init(terra)
+    assert 'Skipping terraform init' in capsys.readouterr().out
+
+    with open(os.path.join(working_dir, 'customer.tf'), 'a') as config_handle:
+        config_handle.write('\nterraform {\n  required_providers {\n    azurerm = {\n      version = "~> 2.40"\n    }\n  }\n}\n')
+    infra_service.tf_init(terra)
+    assert 'Terraform init took' in capsys.readouterr().out
+
+    # Without its .terraform directory the working directory is not initialised, whatever was recorded.
+    shutil.rmtree(os.path.join(working_dir, '.terraform'))
+    infra_service.tf_init(terra)
+    assert 'Terraform init took' in capsys.readouterr().out
+
+
+def test_ttl_refresh_refreshes_only_resources_not_refreshed_recently(fake_terraform, working_dir, capsys):
+    assert infra_service.run_workspace(infra_service.get_args(['--apply']), working_dir) == infra_service.exit_codes['SUCCESS']
+    capsys.readouterr()
+
+    def plan():
+        infra_service.run_workspace(infra_service.get_args(['--refresh', 'ttl', '--no-plan-cache']), working_dir)
+        return capsys.readouterr().out
+
+    # Both were just created.
+    assert 'Refreshing the other 0' in plan()
+
+    refresh_times = tf_cache.load_refresh_times(working_dir)
+    refresh_times['azurerm_virtual_network.vnet'] -= 7200
+    with open(os.path.join(working_dir, tf_cache.refresh_store_file), 'w') as store_handle:
+        json.dump(refresh_times, store_handle)
+    assert '1 of 2 resources refreshed in the last 3600 seconds. Refreshing the other 1' in plan()
+    # The targeted refresh counts as a refresh.
+    assert 'Refreshing the other 0' in plan()
+
+    os.remove(os.path.join(working_dir, tf_cache.refresh_store_file))
+    assert 'Refreshing everything' in plan()
+    assert 'Refreshing the other 0' in plan()
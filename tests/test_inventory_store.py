@@ -0,0 +1,117 @@
+'''
+inventory_store.py against a small ANSIBLE_DATA_DIR layout.
+'''
+
+import datetime
+import json
+import os
+import sqlite3
+
+import pytest
+import yaml
+
+import inventory_store
+from inventory_store import InventoryStore, InventoryLoader
+
+vars_file = '''customer:
+  tenant_id: acme
+  fullname: Acme Corp
+  provisioned: 2021-03-04
+  last_upgrade: 2022-01-02 03:04:05
+  cluster:
+    number_of_instances: 2
+    db_sku: GP_Gen5_8
+    no_cloudfront: false
+    db_password: !vault |
+      $ANSIBLE_VAULT;1.1;AES256
+      6231
+ports:
+  443: https
+  5432: postgres
+terraform:
+  region: westeurope
+product: 7
+qe_jenkins_allow:
+  jenkins1: 10.0.0.1
+maintenance_window: null
+'''
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    data_dir = tmp_path / 'data'
+    (data_dir / 'vars').mkdir(parents=True)
+    (data_dir / 'api_data').mkdir()
+    (data_dir / 'vars' / 'acme.yml').write_text(vars_file)
+    (data_dir / 'vars' / 'globex.yml').write_text('terraform:\n  region: eastus2\nproduct: 6\n')
+    (data_dir / 'api_data' / 'acme.json').write_text(json.dumps({"url": "https://acme.example.com", "instances": [1, 2]}))
+    return str(data_dir)
+
+
+@pytest.fixture
+def store(data_dir, tmp_path):
+    store = InventoryStore(data_dir, str(tmp_path / 'inventory.sqlite'))
+    yield store
+    store.close()
+
+
+def test_cached_vars_keep_the_types_yaml_gave_them(data_dir, store, tmp_path):
+    expected = yaml.load(vars_file, Loader=InventoryLoader)
+    assert store.get('acme') == expected
+
+    # From the cache this time, through a fresh connection.
+    reopened = InventoryStore(data_dir, str(tmp_path / 'inventory.sqlite'))
+    try:
+        cached = reopened.get('acme')
+    finally:
+        reopened.close()
+
+    assert cached == expected
+    assert cached['customer']['provisioned'] == datetime.date(2021, 3, 4)
+    assert cached['customer']['last_upgrade'] == datetime.datetime(2022, 1, 2, 3, 4, 5)
+    assert cached['ports'] == {443: 'https', 5432: 'postgres'}
+    assert cached['product'] == 7
+    assert cached['maintenance_window'] is None
+    assert cached['customer']['cluster']['db_password'].startswith('$ANSIBLE_VAULT')
+
+
+def test_api_data_round_trips(store):
+    assert store.get('acme', kind='api_data') == {"url": "https://acme.example.com", "instances": [1, 2]}
+    assert store.get('nobody', kind='api_data') is None
+
+
+def test_changed_and_removed_files_are_picked_up(data_dir, store):
+    assert store.get('globex')['product'] == 6
+    with open(os.path.join(data_dir, 'vars', 'globex.yml'), 'w') as vars_handle:
+        vars_handle.write('terraform:\n  region: eastus2\nproduct: 2\nextra: true\n')
+    assert store.get('globex')['product'] == 2
+
+    os.remove(os.path.join(data_dir, 'vars', 'globex.yml'))
+    assert store.get('globex') is None
+    assert store.tenants() == ['acme']
+
+
+def test_tenants_filter_on_indexed_fields(store):
+    assert store.tenants() == ['acme', 'globex']
+    assert store.tenants(products=[7]) == ['acme']
+    assert store.tenants(regions=['eastus2', 'northeurope']) == ['globex']
+    assert store.tenants(products=['6'], regions=['westeurope']) == []
+
+
+def test_a_cache_from_an_older_version_is_rebuilt(data_dir, tmp_path):
+    cache_path = str(tmp_path / 'old.sqlite')
+    connection = sqlite3.connect(cache_path)
+    connection.execute('CREATE TABLE inventory (kind TEXT, tenant TEXT, mtime_ns INTEGER, size INTEGER, '
+                       'product TEXT, region TEXT, data TEXT, PRIMARY KEY (kind, tenant))')
+    stat = os.stat(os.path.join(data_dir, 'vars', 'acme.yml'))
+    connection.execute('INSERT INTO inventory VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       ('vars', 'acme', stat.st_mtime_ns, stat.st_size, '7', 'westeurope', '{"stale": true}'))
+    connection.commit()
+    connection.close()
+
+    store = InventoryStore(data_dir, cache_path)
+    try:
+        assert store.get('acme')['customer']['provisioned'] == datetime.date(2021, 3, 4)
+        assert store.connection.execute('PRAGMA user_version').fetchone()[0] == inventory_store.schema_version
+    finally:
+        store.close()
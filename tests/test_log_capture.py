@@ -0,0 +1,39 @@
+import logging
+import os
+
+import pytest
+
+from log_capture import SegmentedLogCapture
+
+
+def capture_logger(log_capture):
+    logger = logging.getLogger(f"test_log_capture.{id(log_capture)}")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(log_capture)
+    return logger
+
+
+def test_spill_files_are_removed(tmp_path):
+    log_capture = SegmentedLogCapture(max_lines=2, spill_dir=str(tmp_path))
+    logger = capture_logger(log_capture)
+
+    log_capture.start_segment('plan')
+    for line in range(5):
+        logger.info(line)
+    plan_spill = log_capture.spill_path
+    assert os.path.exists(plan_spill)
+    assert log_capture.getvalue() == '3\n4\n'
+
+    log_capture.start_segment('apply-attempt-1')
+    assert not os.path.exists(plan_spill)
+    for line in range(5):
+        logger.info(line)
+
+    log_capture.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_max_lines_must_be_positive():
+    with pytest.raises(ValueError):
+        SegmentedLogCapture(max_lines=0)
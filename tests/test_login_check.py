@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+from login_check import run_login_checks
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+from fake_campaign import FakeCampaign  # pylint: disable=wrong-import-position
+
+
+def check(url, password):
+    return run_login_checks([{"tenant": 'tenant', "url": url, "username": 'admin', "password": password}],
+                            ready_timeout=5, poll_seconds=0.1)[0]
+
+
+def test_login_succeeds():
+    with FakeCampaign('admin', 'secret') as campaign:
+        result = check(campaign.url, 'secret')
+    assert result['success'], result['reason']
+
+
+def test_bad_password_fails():
+    with FakeCampaign('admin', 'secret') as campaign:
+        result = check(campaign.url, 'wrong')
+    assert not result['success']
+    assert 'login form shown again' in result['reason']
+
+
+@pytest.mark.parametrize('after_login', ['error', 'elsewhere'])
+def test_no_login_form_is_not_success(after_login):
+    with FakeCampaign('admin', 'secret', after_login=after_login) as campaign:
+        result = check(campaign.url, 'secret')
+    assert not result['success']
+
+
+def test_instance_that_never_answers_fails():
+    result = run_login_checks([{"tenant": 'tenant', "url": 'http://127.0.0.1:9', "username": 'admin', "password": 'x'}],
+                              ready_timeout=0.2, poll_seconds=0.1)[0]
+    assert not result['success']
+    assert 'not ready' in result['reason']
@@ -0,0 +1,71 @@
+'''
+metrics.py: timing spans and per-resource durations, as JSON lines and as a textfile collector file.
+'''
+
+import json
+import os
+
+import infra_service
+from metrics import RunMetrics
+
+
+def test_prometheus_text_sums_phases_and_groups_resources_by_type():
+    run_metrics = RunMetrics('acme "prod"', '/work/acme')
+    run_metrics.add_span('plan', 0, 20.0, {"refresh": "full"})
+    run_metrics.add_span('apply', 20, 100.0, {"attempt": 1})
+    run_metrics.add_span('apply', 120, 30.0, {"attempt": 2})
+    run_metrics.add_span('refresh', 150, 1.5, {})
+    run_metrics.add_span('refresh', 160, 2.5, {})
+    run_metrics.add_resources('azurerm_virtual_machine.vm[0]: Creation complete after 4m12s [id=/x]\n'
+                              'module.db.azurerm_virtual_machine.vm[1]: Creation complete after 1h2m3s [id=/y]\n'
+                              'azurerm_public_ip.ip: Destruction complete after 5s\n'
+                              'azurerm_public_ip.ip: Still destroying... [10s elapsed]\n', 'create-attempt-1')
+    run_metrics.finish(10000)
+
+    lines = run_metrics.prometheus_text().splitlines()
+
+    tenant = 'tenant="acme \\"prod\\""'
+    assert f'infra_service_phase_seconds{{phase="plan",{tenant}}} 20.0' in lines
+    assert f'infra_service_phase_seconds{{attempt="1",phase="apply",{tenant}}} 100.0' in lines
+    assert f'infra_service_phase_seconds{{attempt="2",phase="apply",{tenant}}} 30.0' in lines
+    assert f'infra_service_phase_seconds{{phase="refresh",{tenant}}} 4.0' in lines
+    vm = f'action="Creation",resource_type="azurerm_virtual_machine",{tenant}'
+    assert f'infra_service_resource_seconds{{{vm}}} {252 + 3723}' in lines
+    assert f'infra_service_resource_max_seconds{{{vm}}} 3723' in lines
+    assert f'infra_service_resources{{{vm}}} 2' in lines
+    assert f'infra_service_resources{{action="Destruction",resource_type="azurerm_public_ip",{tenant}}} 1' in lines
+    assert f'infra_service_exit_code{{{tenant}}} 10000' in lines
+    assert '# TYPE infra_service_run_seconds gauge' in lines
+
+
+def test_a_run_writes_its_metrics_to_both_files(fake_terraform, working_dir, tmp_path):
+    with open(os.path.join(working_dir, 'customer.tf'), 'a') as config_handle:
+        config_handle.write('\nresource "azurerm_virtual_machine" "vm" {\n}\n')
+    metrics_path = str(tmp_path / 'metrics.jsonl')
+    textfile_dir = tmp_path / 'textfile'
+    textfile_dir.mkdir()
+    args = infra_service.get_args(['--apply', '--metrics-file', metrics_path, '--metrics-textfile-dir', str(textfile_dir)])
+
+    assert infra_service.run_workspace(args, working_dir, tenant='acme/prod') == infra_service.exit_codes['SUCCESS']
+
+    with open(metrics_path, 'r') as metrics_handle:
+        records = [json.loads(line) for line in metrics_handle]
+    assert all(record['tenant'] == 'acme/prod' for record in records)
+    assert {record['name'] for record in records if record['type'] == 'span'} >= {'init', 'plan', 'apply'}
+    resources = {record['address']: record for record in records if record['type'] == 'resource'}
+    assert resources['azurerm_virtual_machine.vm']['seconds'] == 260
+    assert resources['azurerm_virtual_machine.vm']['phase'] == 'create-attempt-1'
+    assert records[-1]['type'] == 'run' and records[-1]['exit_code'] == infra_service.exit_codes['SUCCESS']
+
+    # One file per tenant, named so the collector will pick it up, and nothing half written left behind.
+    assert os.listdir(str(textfile_dir)) == ['infra_service_acme_prod.prom']
+    prometheus_text = (textfile_dir / 'infra_service_acme_prod.prom').read_text()
+    assert 'infra_service_resource_seconds{action="Creation",resource_type="azurerm_virtual_machine",tenant="acme/prod"} 260' in prometheus_text
+    assert f'infra_service_exit_code{{tenant="acme/prod"}} {infra_service.exit_codes["SUCCESS"]}' in prometheus_text
+
+    # Another run appends to the JSON lines and replaces the textfile.
+    args = infra_service.get_args(['--metrics-file', metrics_path, '--metrics-textfile-dir', str(textfile_dir)])
+    infra_service.run_workspace(args, working_dir, tenant='acme/prod')
+    with open(metrics_path, 'r') as metrics_handle:
+        assert sum(json.loads(line)['type'] == 'run' for line in metrics_handle) == 2
+    assert os.listdir(str(textfile_dir)) == ['infra_service_acme_prod.prom']
@@ -0,0 +1,35 @@
+'''
+Picking PostgreSQL profiles for self-hosted primaries and their standbys.
+'''
+
+import sys
+
+import pytest
+
+import pg_profiles
+
+
+@pytest.mark.parametrize('memory_gb, cpus, name', [(16, 8, None), (32, 8, 'small'), (64, 8, 'medium'),
+                                                   (64, 4, 'small'), (512, 64, 'xlarge')])
+def test_primary_gets_the_biggest_profile_it_can_hold(memory_gb, cpus, name):
+    profile = pg_profiles.select_self_hosted_profile(memory_gb, cpus)
+    assert (profile and profile['name']) == name
+
+
+def run_main(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['pg_profiles.py'] + list(argv))
+    pg_profiles.main()
+
+
+def test_standby_takes_the_primary_profile_even_when_smaller(tmp_path, monkeypatch):
+    primary_path, standby_path = str(tmp_path / 'primary.conf'), str(tmp_path / 'standby.conf')
+    run_main(monkeypatch, '--memory-gb', '64', '--cpus', '8', '--output', primary_path)
+    run_main(monkeypatch, '--standby', '--profile', 'medium', '--memory-gb', '32', '--cpus', '4', '--output', standby_path)
+
+    with open(primary_path) as primary_handle, open(standby_path) as standby_handle:
+        assert primary_handle.read() == standby_handle.read()
+
+
+def test_standby_without_a_profile_is_refused(tmp_path, monkeypatch):
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, '--standby', '--output', str(tmp_path / 'standby.conf'))
@@ -0,0 +1,93 @@
+'''
+plan_analysis.py: the PlanIndex of a saved plan, and the guard against plans that destroy data.
+'''
+
+import json
+import os
+
+from python_terraform import Terraform
+
+import infra_service
+from plan_analysis import PlanIndex, load_plan
+
+
+def resource_change(address, actions, before=None, after=None, after_unknown=None):
+    resource_type, name = address.split('.', 1)
+    return {"address": address, "mode": "managed", "type": resource_type, "name": name,
+            "change": {"actions": actions, "before": before, "after": after, "after_unknown": after_unknown or {}}}
+
+
+plan_json = {"format_version": "0.1", "resource_changes": [
+    resource_change('azurerm_postgresql_server.db', ['delete', 'create'], {"sku_name": "GP_Gen5_4"}, {"sku_name": "GP_Gen5_8"}),
+    resource_change('azurerm_managed_disk.data', ['delete'], {"disk_size_gb": 128}),
+    resource_change('azurerm_managed_disk.new', ['create'], None, {"disk_size_gb": 256}, {"id": True}),
+    resource_change('azurerm_virtual_machine.vm', ['delete']),
+    resource_change('azurerm_public_ip.ip', ['create', 'delete']),
+    resource_change('azurerm_network_security_group.nsg', ['update'],
+                    {"name": "nsg", "tags": {}, **{f"rule_{index}": index for index in range(10)}},
+                    {"name": "nsg", "tags": {"env": "prod"}, **{f"rule_{index}": index + 1 for index in range(10)}}),
+    resource_change('azurerm_resource_group.rg', ['no-op'], {"name": "rg"}, {"name": "rg"})]}
+
+
+def test_index_summarises_the_plan_as_terraform_does():
+    plan_index = PlanIndex(plan_json)
+
+    assert not plan_index.no_changes
+    assert plan_index.summary() == "Plan: 3 to add, 1 to change, 4 to destroy."
+    assert plan_index.addresses('replace') == ['azurerm_postgresql_server.db', 'azurerm_public_ip.ip']
+    assert plan_index.planned()['azurerm_managed_disk.data'] == 'will be destroyed'
+    assert 'azurerm_resource_group.rg' not in plan_index.planned()
+
+    assert PlanIndex({"resource_changes": [plan_json['resource_changes'][-1]]}).no_changes
+    assert PlanIndex({}).no_changes
+
+
+def test_only_protected_types_being_deleted_or_replaced_are_unexpected():
+    plan_index = PlanIndex(plan_json)
+
+    assert plan_index.unexpected_destroys() == [('azurerm_managed_disk.data', 'delete'), ('azurerm_postgresql_server.db', 'replace')]
+    assert plan_index.unexpected_destroys(['azurerm_virtual_machine']) == [('azurerm_virtual_machine.vm', 'delete')]
+
+
+def test_compact_diff_names_what_an_update_changes():
+    diff = PlanIndex(plan_json).compact_diff()
+
+    assert '+ azurerm_managed_disk.new' in diff
+    assert '-/+ azurerm_postgresql_server.db' in diff
+    assert '~ azurerm_network_security_group.nsg: rule_0, rule_1, rule_2, rule_3, rule_4, rule_5, rule_6, rule_7 and 3 more' in diff
+    assert not any('azurerm_resource_group.rg' in line for line in diff)
+
+
+def test_a_plan_terraform_cannot_show_is_none(tmp_path):
+    terraform_path = tmp_path / 'terraform'
+    terraform_path.write_text('#!/bin/sh\necho "Error: unsupported" >&2\nexit 1\n')
+    terraform_path.chmod(0o755)
+
+    assert load_plan(Terraform(working_dir=str(tmp_path), terraform_bin_path=str(terraform_path)), 'plan.out') is None
+
+
+def test_apply_refuses_a_plan_that_replaces_the_database(fake_terraform, working_dir, monkeypatch, capsys):
+    with open(os.path.join(working_dir, 'customer.tf'), 'a') as config_handle:
+        config_handle.write('\nresource "azurerm_postgresql_server" "db" {\n}\n\nresource "azurerm_managed_disk" "data" {\n}\n')
+    assert infra_service.run_workspace(infra_service.get_args(['--apply']), working_dir) == infra_service.exit_codes['SUCCESS']
+    capsys.readouterr()
+
+    def state_resources():
+        with open(os.path.join(working_dir, 'terraform.tfstate'), 'r') as state_handle:
+            return json.load(state_handle)['resources']
+
+    applied = state_resources()
+    # A config change that, as far as the fake terraform is concerned, forces both to be replaced.
+    with open(os.path.join(working_dir, 'customer.tf'), 'a') as config_handle:
+        config_handle.write('\n# db_version 10 -> 11\n')
+    monkeypatch.setenv('FAKE_TF_REPLACE', 'azurerm_postgresql_server.db,azurerm_virtual_network.vnet')
+
+    assert infra_service.run_workspace(infra_service.get_args(['--apply']), working_dir) == infra_service.exit_codes['UNEXPECTED_DESTROY']
+    output = capsys.readouterr().out
+    assert 'The plan deletes or replaces 1 resources holding data:' in output
+    assert 'azurerm_postgresql_server.db: replace' in output
+    assert 'Apply complete!' not in output
+    assert state_resources() == applied
+
+    assert infra_service.run_workspace(infra_service.get_args(['--apply', '--allow-destroy']), working_dir) == infra_service.exit_codes['SUCCESS']
+    assert 'Apply complete!' in capsys.readouterr().out
@@ -0,0 +1,85 @@
+'''
+render_config.py: deterministic renders of azuretf.jinja, skipped when nothing changed.
+'''
+
+import os
+import random
+import re
+import sys
+
+import pytest
+
+import render_config
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+from run_benchmarks import synthetic_vars  # pylint: disable=wrong-import-position
+
+storage_account_regexp = re.compile(r'resource "azurerm_storage_account" "\w+" \{\n\s*name\s*=\s*"([^"]+)"')
+
+
+@pytest.fixture
+def environment(tmp_path):
+    return render_config.build_environment(str(tmp_path / 'cache'))
+
+
+def tenant_context(index):
+    return render_config.with_pg_profile(synthetic_vars(random.Random(index), index), render_config.load_profiles())
+
+
+def read(path):
+    with open(path, 'r') as file_handle:
+        return file_handle.read()
+
+
+def test_same_inputs_render_the_same_config(environment, tmp_path):
+    first_path = str(tmp_path / 'first' / 'customer.tf')
+    second_path = str(tmp_path / 'second' / 'customer.tf')
+    other_path = str(tmp_path / 'other' / 'customer.tf')
+
+    render_config.render(environment, render_config.default_template, tenant_context(1), first_path)
+    # A fresh environment, as another run of the script would have.
+    render_config.render(render_config.build_environment(str(tmp_path / 'cache')), render_config.default_template,
+                         tenant_context(1), second_path)
+    render_config.render(environment, render_config.default_template, tenant_context(2), other_path)
+
+    assert read(first_path) == read(second_path)
+    storage_account = storage_account_regexp.search(read(first_path)).group(1)
+    assert storage_account == storage_account_regexp.search(read(second_path)).group(1)
+    assert storage_account != storage_account_regexp.search(read(other_path)).group(1)
+    # Azure storage account names: 3 to 24 lower case letters and digits.
+    assert re.fullmatch(r'[a-z0-9]{3,24}', storage_account)
+
+
+def test_unchanged_renders_are_skipped(environment, tmp_path):
+    output_path = str(tmp_path / 'out' / 'customer.tf')
+    context = tenant_context(1)
+
+    assert render_config.render(environment, render_config.default_template, context, output_path)
+    mtime = os.stat(output_path).st_mtime_ns
+    assert not render_config.render(environment, render_config.default_template, context, output_path)
+
+    # Forced, it renders again, but leaves a file that came out the same alone.
+    assert render_config.render(environment, render_config.default_template, context, output_path, force=True)
+    assert os.stat(output_path).st_mtime_ns == mtime
+
+    context['customer']['cluster']['number_of_instances'] += 1
+    assert render_config.render(environment, render_config.default_template, context, output_path)
+
+
+def test_hand_edits_to_the_output_are_rendered_over(environment, tmp_path):
+    output_path = str(tmp_path / 'out' / 'customer.tf')
+    context = tenant_context(1)
+    render_config.render(environment, render_config.default_template, context, output_path)
+    rendered = read(output_path)
+
+    with open(output_path, 'a') as output_handle:
+        output_handle.write('\n# hand edit\n')
+
+    assert render_config.render(environment, render_config.default_template, context, output_path)
+    assert read(output_path) == rendered
+
+
+def test_compiled_templates_are_cached_on_disk(environment, tmp_path):
+    render_config.render(environment, render_config.default_template, tenant_context(1), str(tmp_path / 'out' / 'customer.tf'))
+
+    assert os.listdir(str(tmp_path / 'cache'))
@@ -0,0 +1,74 @@
+'''
+Cutting a stack that ran as a single workspace over to layers, against the fake terraform.
+'''
+
+import json
+import os
+import subprocess
+
+import pytest
+
+import infra_service
+
+
+def write_state(path, resources):
+    with open(path, 'w') as state_handle:
+        json.dump({"version": 4, "lineage": "test", "serial": 1, "resources": resources}, state_handle)
+
+
+def state_resources(path):
+    with open(path, 'r') as state_handle:
+        return json.load(state_handle)['resources']
+
+
+@pytest.fixture
+def stack_dir(tmp_path):
+    ''' A stack rendered as network and compute layers, next to the state it had as a single workspace '''
+    stack_dir = tmp_path / 'modules'
+    for layer, resources in [('network', ['azurerm_resource_group.rg', 'azurerm_virtual_network.vnet']),
+                             ('compute', ['azurerm_virtual_machine.vm1'])]:
+        (stack_dir / layer).mkdir(parents=True)
+        (stack_dir / layer / 'customer.tf').write_text(
+            'provider "azurerm" {\n  subscription_id = "test"\n}\n\n' +
+            ''.join(f'resource "{address.split(".")[0]}" "{address.split(".")[1]}" {{\n}}\n\n' for address in resources))
+    write_state(str(stack_dir / 'terraform.tfstate'),
+                ['azurerm_resource_group.rg', 'azurerm_virtual_network.vnet', 'azurerm_virtual_machine.vm1',
+                 'data.azurerm_client_config.current'])
+    return str(stack_dir)
+
+
+def test_layers_refused_while_the_single_state_has_resources(fake_terraform, stack_dir):
+    results = infra_service.run_layers(infra_service.get_args(['--layers']), stack_dir)
+
+    assert results == {'network': infra_service.exit_codes['GENERIC_FAILURE'],
+                       'compute': infra_service.exit_codes['GENERIC_FAILURE']}
+    assert not os.path.exists(os.path.join(stack_dir, 'network', 'terraform.tfstate'))
+
+
+def test_migrate_state_moves_resources_into_their_layers(fake_terraform, stack_dir):
+    results = infra_service.run_layers(infra_service.get_args(['--layers', '--migrate-state']), stack_dir)
+
+    assert results == {'network': infra_service.exit_codes['APPLY_NOT_SPECIFIED'],
+                       'compute': infra_service.exit_codes['APPLY_NOT_SPECIFIED']}
+    assert sorted(state_resources(os.path.join(stack_dir, 'network', 'terraform.tfstate'))) == \
+        ['azurerm_resource_group.rg', 'azurerm_virtual_network.vnet']
+    assert state_resources(os.path.join(stack_dir, 'compute', 'terraform.tfstate')) == ['azurerm_virtual_machine.vm1']
+    assert state_resources(os.path.join(stack_dir, 'terraform.tfstate')) == ['data.azurerm_client_config.current']
+    assert len(state_resources(os.path.join(stack_dir, 'terraform.tfstate.pre-layers'))) == 4
+
+    # Nothing left to create: the layers took over what was there.
+    for layer in ['network', 'compute']:
+        plan = subprocess.run([fake_terraform, 'plan'], cwd=os.path.join(stack_dir, layer), stdout=subprocess.PIPE, check=False)
+        assert b'No changes' in plan.stdout
+
+    assert infra_service.run_layers(infra_service.get_args(['--layers']), stack_dir)['network'] == \
+        infra_service.exit_codes['APPLY_NOT_SPECIFIED']
+
+
+def test_migrate_state_moves_nothing_if_a_resource_has_no_layer(fake_terraform, stack_dir):
+    state_path = os.path.join(stack_dir, 'terraform.tfstate')
+    write_state(state_path, ['azurerm_resource_group.rg', 'azurerm_dns_zone.gone'])
+
+    assert not infra_service.migrate_to_layers(stack_dir)
+    assert state_resources(state_path) == ['azurerm_resource_group.rg', 'azurerm_dns_zone.gone']
+    assert not os.path.exists(os.path.join(stack_dir, 'network', 'terraform.tfstate'))
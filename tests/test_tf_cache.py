@@ -0,0 +1,134 @@
+'''
+tf_cache.py: the plan fingerprint and the plan cache built on it.
+'''
+
+import os
+import subprocess
+import types
+
+import pytest
+from python_terraform import Terraform
+
+import infra_service
+import tf_cache
+
+changed_plan = {"no_changes": False, "planned": {"azurerm_resource_group.rg": ["Creation"]},
+                "display": ["Plan: 1 to add, 0 to change, 0 to destroy."], "plan_file": "plan.out"}
+
+
+@pytest.fixture
+def terra(fake_terraform, working_dir):
+    return Terraform(working_dir=working_dir, terraform_bin_path=fake_terraform)
+
+
+def test_fingerprint_is_stable_until_config_state_or_direction_change(terra, fake_terraform, working_dir):
+    fingerprint = tf_cache.plan_fingerprint(terra, False)
+    assert tf_cache.plan_fingerprint(terra, False) == fingerprint
+    assert tf_cache.plan_fingerprint(terra, True) != fingerprint
+
+    subprocess.run([fake_terraform, 'apply', '-auto-approve'], cwd=working_dir, check=True, stdout=subprocess.DEVNULL)
+    applied = tf_cache.plan_fingerprint(terra, False)
+    assert applied != fingerprint
+
+    with open(os.path.join(working_dir, 'customer.tf'), 'a') as config_handle:
+        config_handle.write('\nresource "azurerm_public_ip" "ip" {\n}\n')
+    assert tf_cache.plan_fingerprint(terra, False) != applied
+
+
+def test_cached_plan_is_only_returned_for_its_fingerprint(working_dir):
+    open(os.path.join(working_dir, 'plan.out'), 'w').close()
+    tf_cache.save_cached_plan(working_dir, 'abc', dict(changed_plan, refresh='full'))
+
+    assert tf_cache.load_cached_plan(working_dir, 'abc')['planned'] == changed_plan['planned']
+    assert tf_cache.load_cached_plan(working_dir, 'def') is None
+
+    # Without its plan file a plan with changes can't be applied, so it doesn't count.
+    os.remove(os.path.join(working_dir, 'plan.out'))
+    assert tf_cache.load_cached_plan(working_dir, 'abc') is None
+
+    tf_cache.save_cached_plan(working_dir, 'abc', {"no_changes": True, "planned": {}, "display": [], "plan_file": "plan.out",
+                                                   "refresh": "full"})
+    assert tf_cache.load_cached_plan(working_dir, 'abc')['no_changes']
+
+    tf_cache.clear_cached_plan(working_dir)
+    assert tf_cache.load_cached_plan(working_dir, 'abc') is None
+
+
+@pytest.mark.parametrize('cached_mode, requested_mode, reused', [
+    ('full', 'full', True), ('full', 'none', True), ('ttl', 'ttl', True), ('ttl', 'full', False),
+    ('none', 'ttl', False), ('none', 'full', False), (None, 'none', False)])
+def test_cached_plan_is_not_reused_for_a_run_that_refreshes_more(working_dir, cached_mode, requested_mode, reused):
+    plan = {"no_changes": True, "planned": {}, "display": [], "plan_file": "plan.out"}
+    if cached_mode is not None:
+        plan['refresh'] = cached_mode
+    tf_cache.save_cached_plan(working_dir, 'abc', plan)
+
+    assert (tf_cache.load_cached_plan(working_dir, 'abc', requested_mode) is not None) == reused
+
+
+def test_unchanged_workspace_reuses_its_plan_until_a_full_refresh_is_asked_for(fake_terraform, working_dir, capsys):
+    def plan(*argv):
+        infra_service.run_workspace(infra_service.get_args(list(argv)), working_dir)
+        return capsys.readouterr().out
+
+    assert 'Reusing it' not in plan('--refresh', 'none')
+    assert 'Reusing it' in plan('--refresh', 'none')
+
+    # The cached plan never looked at what is really deployed.
+    assert 'Reusing it' not in plan()
+    assert 'Reusing it' in plan('--refresh', 'ttl')
+    assert 'Reusing it' in plan()
+
+    assert 'Reusing it' not in plan('--no-plan-cache')
+
+
+def test_init_requirements_follow_providers_and_terraform_blocks_only(working_dir):
+    config_path = os.path.join(working_dir, 'customer.tf')
+    requirements = tf_cache.init_requirements(working_dir, '/usr/bin/terraform')
+
+    with open(config_path, 'a') as config_handle:
+        config_handle.write('\nresource "azurerm_public_ip" "ip" {\n  name = "ip"\n}\n')
+    assert tf_cache.init_requirements(working_dir, '/usr/bin/terraform') == requirements
+    assert tf_cache.init_requirements(working_dir, '/opt/terraform') != requirements
+
+    # A resource of a provider not used before needs that provider installed.
+    with open(config_path, 'a') as config_handle:
+        config_handle.write('\nresource "random_password" "admin" {\n}\n')
+    with_random = tf_cache.init_requirements(working_dir, '/usr/bin/terraform')
+    assert with_random != requirements
+
+    with open(config_path, 'a') as config_handle:
+        config_handle.write('\nterraform {\n  required_providers {\n    azurerm = {\n      version = "~> 2.40"\n    }\n  }\n}\n')
+    assert tf_cache.init_requirements(working_dir, '/usr/bin/terraform') != with_random
+
+
+def test_init_marker_records_the_requirements_it_was_made_for(working_dir):
+    assert not tf_cache.init_is_current(working_dir, 'abc')
+
+    os.mkdir(os.path.join(working_dir, '.terraform'))
+    tf_cache.record_init(working_dir, 'abc', 2.5)
+
+    assert tf_cache.init_is_current(working_dir, 'abc')
+    assert not tf_cache.init_is_current(working_dir, 'def')
+    assert tf_cache.load_init_marker(working_dir)['init_seconds'] == 2.5
+
+
+def test_refresh_store_knows_what_was_refreshed_within_the_ttl(working_dir, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(tf_cache, 'time', types.SimpleNamespace(time=lambda: now[0]))
+    addresses = ['azurerm_resource_group.rg', 'azurerm_virtual_network.vnet', 'azurerm_public_ip.ip']
+
+    assert tf_cache.stale_resources(working_dir, addresses, 3600) == addresses
+
+    tf_cache.record_refresh(working_dir, addresses[:2])
+    now[0] += 1800
+    tf_cache.record_refresh(working_dir, addresses[2:])
+    assert tf_cache.stale_resources(working_dir, addresses, 3600) == []
+
+    now[0] += 1801
+    assert tf_cache.stale_resources(working_dir, addresses, 3600) == addresses[:2]
+    assert tf_cache.stale_resources(working_dir, addresses, 0) == addresses
+
+    # Resources gone from the state are forgotten.
+    tf_cache.record_refresh(working_dir, [], keep=addresses[1:])
+    assert sorted(tf_cache.load_refresh_times(working_dir)) == sorted(addresses[1:])
@@ -0,0 +1,106 @@
+'''
+vault_cache.py against the Vault stand-in in bench/fake_vault.py.
+'''
+
+import os
+import sys
+import time
+import types
+
+import pytest
+from cryptography.fernet import Fernet
+
+import vault_cache
+from vault_cache import VaultCache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+from fake_vault import FakeVault  # pylint: disable=wrong-import-position
+
+secrets = {f"secret/tenant{index}": {"admin": f"password{index}"} for index in range(8)}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    ''' vault_cache's idea of the time, moved on by hand '''
+    now = [time.time()]
+    monkeypatch.setattr(vault_cache, 'time', types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def test_a_secret_is_read_once_per_lease(clock):
+    with FakeVault(secrets, lease_duration=100) as vault, VaultCache(vault.url, 'test-token') as cache:
+        for _ in range(3):
+            assert cache.read('secret/tenant0')['data'] == {"admin": "password0"}
+        assert vault.reads['secret/tenant0'] == 1
+
+        # Read again once 90% of the lease is gone, not at its very end.
+        clock[0] += 89
+        cache.read('secret/tenant0')
+        assert vault.reads['secret/tenant0'] == 1
+        clock[0] += 2
+        cache.read('secret/tenant0')
+        assert vault.reads['secret/tenant0'] == 2
+        assert cache.reads == 2
+
+
+def test_long_leases_are_capped_and_secrets_without_one_get_the_default_ttl(clock):
+    with FakeVault(secrets, lease_duration=10 ** 6) as vault, VaultCache(vault.url, 'test-token', max_ttl_seconds=3600) as cache:
+        cache.read('secret/tenant0')
+        clock[0] += 3601
+        cache.read('secret/tenant0')
+        assert vault.reads['secret/tenant0'] == 2
+
+    with FakeVault(secrets, lease_duration=0) as vault, VaultCache(vault.url, 'test-token', ttl_seconds=300) as cache:
+        cache.read('secret/tenant0')
+        clock[0] += 299
+        cache.read('secret/tenant0')
+        assert vault.reads['secret/tenant0'] == 1
+        clock[0] += 2
+        cache.read('secret/tenant0')
+        assert vault.reads['secret/tenant0'] == 2
+
+
+def test_missing_secrets_are_none_and_not_cached():
+    with FakeVault(secrets) as vault, VaultCache(vault.url, 'test-token') as cache:
+        assert cache.read('secret/nobody') is None
+        assert cache.read('secret/nobody') is None
+        assert vault.reads['secret/nobody'] == 2
+
+
+def test_read_many_reads_each_uncached_secret_once_in_parallel():
+    with FakeVault(secrets, delay=0.2) as vault, VaultCache(vault.url, 'test-token') as cache:
+        cache.read('secret/tenant0')
+        paths = list(secrets) * 3 + ['secret/nobody']
+
+        start = time.time()
+        results = cache.read_many(paths)
+        elapsed = time.time() - start
+
+        assert set(results) == set(paths)
+        assert results['secret/nobody'] is None
+        assert all(results[path]['data'] == data for path, data in secrets.items())
+        assert all(vault.reads[path] == 1 for path in secrets)
+        assert cache.reads == len(secrets) + 1
+        # Eight reads of 0.2 seconds each, side by side rather than one after the other.
+        assert elapsed < 0.2 * len(secrets) / 2
+
+
+def test_disk_cache_outlives_the_process_and_is_encrypted(tmp_path):
+    cache_path = str(tmp_path / 'vault-cache')
+    key = Fernet.generate_key()
+
+    with FakeVault(secrets, lease_duration=100) as vault:
+        with VaultCache(vault.url, 'test-token', cache_path=cache_path, key=key) as cache:
+            cache.read('secret/tenant0')
+        with VaultCache(vault.url, 'test-token', cache_path=cache_path, key=key) as cache:
+            assert cache.read('secret/tenant0')['data'] == {"admin": "password0"}
+        assert vault.reads['secret/tenant0'] == 1
+
+        with open(cache_path, 'rb') as cache_handle:
+            assert b'password0' not in cache_handle.read()
+        assert os.stat(cache_path).st_mode & 0o777 == 0o600
+
+        # Another key can't read it, and just starts over.
+        with VaultCache(vault.url, 'test-token', cache_path=cache_path, key=Fernet.generate_key()) as cache:
+            cache.read('secret/tenant0')
+        assert vault.reads['secret/tenant0'] == 2
@@ -0,0 +1,276 @@
+'''
+Caches that let infra_service.py skip terraform work it has already done.
+'''
+
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+
+# Lives in the terraform working directory, next to the saved plan file it describes.
+plan_cache_file = '.infra_plan_cache.json'
+
+config_patterns = ['*.tf', '*.tf.json', '*.tfvars', '*.tfvars.json']
+
+# How much of the state a plan refreshed first (infra_service refresh modes). A cached plan only stands in for
+# a plan that would have refreshed as much or less.
+refresh_coverage = {"none": 0, "ttl": 1, "full": 2}
+
+# The state file of another layer that this config reads outputs from (see azuretf.jinja).
+remote_state_path_regexp = re.compile(r'^\s*path\s*=\s*"\$\{path\.module\}/([^"]+\.tfstate)"')
+
+
+def working_dir_of(terra):
+    ''' The directory a python_terraform object runs in '''
+    return terra.working_dir or os.getcwd()
+
+
+def state_serial(terra):
+    ''' The lineage and serial of the current terraform state, which change whenever the state does '''
+    state_path = os.path.join(working_dir_of(terra), 'terraform.tfstate')
+
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as state_handle:
+            state = json.load(state_handle)
+    else:
+        # Remote backend, or no state yet. state pull prints nothing in the latter case.
+        return_code, stdout, _ = terra.cmd('state pull')
+        if return_code != 0 or not stdout.strip():
+            return None, 0
+        state = json.loads(stdout)
+
+    return state.get('lineage'), state.get('serial', 0)
+
+
+def remote_state_serial(state_path):
+    ''' The lineage and serial of a local state file read through terraform_remote_state, as a string '''
+    if not os.path.exists(state_path):
+        return f"{state_path} missing"
+    with open(state_path, 'r') as state_handle:
+        try:
+            state = json.load(state_handle)
+        except ValueError:
+            return f"{state_path} unreadable"
+    return f"{state_path} lineage={state.get('lineage')} serial={state.get('serial', 0)}"
+
+
+def plan_fingerprint(terra, destroy):
+    ''' Hash of the rendered config, the plan direction and the state serial (this layer's and those of the
+    layers it reads from). If none of those have changed, neither has the plan. '''
+    working_dir = working_dir_of(terra)
+    digest = hashlib.sha256()
+
+    config_files = sorted(set(path for pattern in config_patterns for path in glob.glob(os.path.join(working_dir, pattern))))
+    for config_path in config_files:
+        digest.update(os.path.basename(config_path).encode('utf-8') + b'\0')
+        with open(config_path, 'rb') as config_handle:
+            config = config_handle.read()
+        digest.update(config + b'\0')
+
+        # Outputs read from another layer's state are as much an input to the plan as the config is.
+        for match in map(remote_state_path_regexp.match, config.decode('utf-8', errors='replace').splitlines()):
+            if match:
+                digest.update(remote_state_serial(os.path.join(working_dir, match.group(1))).encode('utf-8'))
+
+    lineage, serial = state_serial(terra)
+    digest.update(f"destroy={destroy} lineage={lineage} serial={serial}".encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def load_cached_plan(working_dir, fingerprint, refresh_mode='full'):
+    ''' The plan recorded for this fingerprint, or None. A plan with changes only counts if its plan file is still there,
+    and no plan counts for a run that asks for more refreshing than it had. '''
+    cache_path = os.path.join(working_dir, plan_cache_file)
+
+    if not os.path.exists(cache_path):
+        return None
+
+    with open(cache_path, 'r') as cache_handle:
+        try:
+            cached = json.load(cache_handle)
+        except ValueError:
+            return None
+
+    if cached.get('fingerprint') != fingerprint:
+        return None
+
+    if refresh_coverage.get(cached.get('refresh'), -1) < refresh_coverage[refresh_mode]:
+        return None
+
+    if not cached['no_changes'] and not os.path.exists(os.path.join(working_dir, cached['plan_file'])):
+        return None
+
+    return cached
+
+
+def save_cached_plan(working_dir, fingerprint, plan):
+    ''' Record the plan for this fingerprint, replacing whatever was there '''
+    cached = dict(plan, fingerprint=fingerprint, created=time.time())
+    cache_path = os.path.join(working_dir, plan_cache_file)
+
+    with open(cache_path + '.tmp', 'w') as cache_handle:
+        json.dump(cached, cache_handle, indent=2, sort_keys=True)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def clear_cached_plan(working_dir):
+    ''' Forget the recorded plan, e.g. after an apply that didn't finish '''
+    cache_path = os.path.join(working_dir, plan_cache_file)
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+
+# Which saved plan was last applied, so that it can be told apart from a plan that changes nothing.
+applied_plan_file = '.infra_plan_applied.json'
+
+
+def file_sha256(path):
+    ''' sha256 of a file '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file_handle:
+        for chunk in iter(lambda: file_handle.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def record_applied_plan(working_dir, plan_file, exit_code):
+    ''' Note that the saved plan was applied (whether or not the apply succeeded) '''
+    plan_path = os.path.join(working_dir, plan_file)
+    if not os.path.exists(plan_path):
+        return
+    applied = {"plan_file": plan_file, "sha256": file_sha256(plan_path), "exit_code": exit_code, "applied": time.time()}
+    applied_path = os.path.join(working_dir, applied_plan_file)
+
+    with open(applied_path + '.tmp', 'w') as applied_handle:
+        json.dump(applied, applied_handle, indent=2, sort_keys=True)
+    os.replace(applied_path + '.tmp', applied_path)
+
+
+def plan_was_applied(working_dir, plan_file):
+    ''' True if the saved plan, as it is now, is the one that was last applied '''
+    plan_path = os.path.join(working_dir, plan_file)
+    applied_path = os.path.join(working_dir, applied_plan_file)
+    if not os.path.exists(plan_path) or not os.path.exists(applied_path):
+        return False
+
+    with open(applied_path, 'r') as applied_handle:
+        try:
+            applied = json.load(applied_handle)
+        except ValueError:
+            return False
+    return applied.get('sha256') == file_sha256(plan_path)
+
+
+# Written inside .terraform so that it disappears together with whatever init put there.
+init_marker_file = os.path.join('.terraform', 'infra_service_init.json')
+
+block_start_regexp = re.compile(r'^\s*(provider|terraform|module)\b[^{]*\{')
+requirement_line_regexp = re.compile(r'^\s*(?:version|source)\s*=')
+implicit_provider_regexp = re.compile(r'^\s*(?:resource|data)\s+"([a-z0-9]+)_')
+
+
+def init_requirements(working_dir, terraform_bin_path):
+    ''' Hash of everything terraform init acts on: the terraform binary, the providers in use and their
+    versions, terraform blocks (backend, required_providers) and module sources. Everything else in the
+    config can change without needing another init. '''
+    digest = hashlib.sha256(terraform_bin_path.encode('utf-8') + b'\0')
+    providers = set()
+
+    for config_path in sorted(glob.glob(os.path.join(working_dir, '*.tf'))):
+        with open(config_path, 'r') as config_handle:
+            lines = config_handle.read().splitlines()
+
+        block_kind = None
+        depth = 0
+        for line in lines:
+            if block_kind is None:
+                match = block_start_regexp.match(line)
+                if match:
+                    block_kind = match.group(1)
+                    depth = 0
+                    digest.update(line.strip().encode('utf-8') + b'\n')
+                else:
+                    match = implicit_provider_regexp.match(line)
+                    if match:
+                        providers.add(match.group(1))
+                    continue
+            elif block_kind == 'terraform' or requirement_line_regexp.match(line):
+                digest.update(line.strip().encode('utf-8') + b'\n')
+
+            depth += line.count('{') - line.count('}')
+            if depth <= 0:
+                block_kind = None
+
+    digest.update(' '.join(sorted(providers)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def load_init_marker(working_dir):
+    ''' What the last real init in this directory recorded, or None '''
+    marker_path = os.path.join(working_dir, init_marker_file)
+    if not os.path.exists(marker_path):
+        return None
+    with open(marker_path, 'r') as marker_handle:
+        try:
+            return json.load(marker_handle)
+        except ValueError:
+            return None
+
+
+def init_is_current(working_dir, requirements):
+    ''' True if this directory was already initialised for exactly these requirements '''
+    marker = load_init_marker(working_dir)
+    return marker is not None and marker.get('requirements') == requirements
+
+
+def record_init(working_dir, requirements, init_seconds):
+    ''' Remember that this directory has been initialised for these requirements, and how long it took '''
+    marker_path = os.path.join(working_dir, init_marker_file)
+    with open(marker_path, 'w') as marker_handle:
+        json.dump({"requirements": requirements, "initialised": time.time(), "init_seconds": init_seconds},
+                  marker_handle, indent=2, sort_keys=True)
+
+
+# When each resource in state was last refreshed from Azure/AWS, next to the plan cache.
+refresh_store_file = '.infra_refresh.json'
+
+
+def load_refresh_times(working_dir):
+    ''' Map of resource address to when it was last refreshed '''
+    store_path = os.path.join(working_dir, refresh_store_file)
+    if not os.path.exists(store_path):
+        return {}
+    with open(store_path, 'r') as store_handle:
+        try:
+            return json.load(store_handle)
+        except ValueError:
+            return {}
+
+
+def record_refresh(working_dir, addresses, keep=None):
+    ''' Remember that these resources were refreshed just now. If keep is given (every address still in state),
+    anything not in it is forgotten. '''
+    refreshed_at = time.time()
+    refresh_times = load_refresh_times(working_dir)
+
+    if keep is not None:
+        keep = set(keep)
+        refresh_times = {address: last for address, last in refresh_times.items() if address in keep}
+
+    for address in addresses:
+        refresh_times[address] = refreshed_at
+
+    store_path = os.path.join(working_dir, refresh_store_file)
+    with open(store_path + '.tmp', 'w') as store_handle:
+        json.dump(refresh_times, store_handle, indent=2, sort_keys=True)
+    os.replace(store_path + '.tmp', store_path)
+
+
+def stale_resources(working_dir, addresses, ttl_seconds):
+    ''' The addresses that have not been refreshed in the last ttl_seconds, in the order given '''
+    refresh_times = load_refresh_times(working_dir)
+    oldest = time.time() - ttl_seconds
+    return [address for address in addresses if refresh_times.get(address, 0) < oldest]
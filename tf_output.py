@@ -0,0 +1,88 @@
+'''
+Helpers for pulling resource addresses out of terraform's human readable output.
+'''
+
+import re
+
+# "  # azurerm_network_security_rule.foo will be created" and friends, from plan output.
+planned_regexp = re.compile(r'^\s*# (\S+) (will be created|will be updated in-place|will be destroyed|must be replaced)')
+
+# "azurerm_network_security_rule.foo: Creation complete after 3s [id=...]", from apply/destroy output.
+completed_regexp = re.compile(r'^(\S+): (Creation|Modifications|Destruction) complete after')
+
+# '  on customer.tf line 420, in resource "azurerm_network_security_rule" "foo":', which follows every
+# error terraform raises against a specific resource.
+failed_regexp = re.compile(r'^\s*on \S+ line \d+, in resource "([^"]+)" "([^"]+)":')
+
+# The completion message that means a planned change has been carried out. A replacement is only
+# done once the new resource has been created.
+completion_for_plan = {
+    "will be created": "Creation",
+    "will be updated in-place": "Modifications",
+    "will be destroyed": "Destruction",
+    "must be replaced": "Creation"
+}
+
+
+def planned_resources(output):
+    ''' Map of address to planned change for every resource a plan intends to touch '''
+    planned = {}
+    for match in map(planned_regexp.match, output.splitlines()):
+        if match:
+            planned[match.group(1)] = match.group(2)
+    return planned
+
+
+def completed_resources(output, completed=None):
+    ''' Map of address to the completion messages seen for it in apply or destroy output. Pass the
+    map from an earlier attempt as completed to add to it. '''
+    if completed is None:
+        completed = {}
+    for match in map(completed_regexp.match, output.splitlines()):
+        if match:
+            completed.setdefault(match.group(1), set()).add(match.group(2))
+    return completed
+
+
+def unfinished_resources(planned, completed):
+    ''' Addresses from the plan whose change has not been carried out yet '''
+    return set(address for address, change in planned.items()
+               if completion_for_plan[change] not in completed.get(address, set()))
+
+
+def failed_resources(output):
+    ''' Addresses (without count index) of every resource terraform reported an error against '''
+    return set(f"{match.group(1)}.{match.group(2)}" for match in map(failed_regexp.match, output.splitlines()) if match)
+
+
+# "azurerm_resource_group.acme: Refreshing state... [id=...]", from plan and refresh output.
+refreshed_regexp = re.compile(r'^(\S+): Refreshing state\.\.\.')
+
+
+def refreshed_resources(output):
+    ''' Addresses of every resource (and data source) terraform refreshed '''
+    return set(match.group(1) for match in map(refreshed_regexp.match, output.splitlines()) if match)
+
+
+# "azurerm_virtual_machine.foo[0]: Creation complete after 4m12s [id=...]", from apply/destroy output.
+duration_regexp = re.compile(r'^(\S+): (Creation|Modifications|Destruction) complete after ((?:\d+h)?(?:\d+m)?(?:\d+s)?)')
+duration_part_regexp = re.compile(r'(\d+)([hms])')
+duration_unit_seconds = {"h": 3600, "m": 60, "s": 1}
+
+
+def resource_durations(output):
+    ''' (address, completion message, seconds) for every resource terraform reported finishing '''
+    durations = []
+    for match in map(duration_regexp.match, output.splitlines()):
+        if match:
+            seconds = sum(int(value) * duration_unit_seconds[unit] for value, unit in duration_part_regexp.findall(match.group(3)))
+            durations.append((match.group(1), match.group(2), seconds))
+    return durations
+
+
+def resource_type(address):
+    ''' The resource type in an address, e.g. azurerm_virtual_machine for module.x.azurerm_virtual_machine.vm[0] '''
+    parts = address.split('.')
+    while len(parts) > 2 and parts[0] in ['module', 'data']:
+        parts = parts[2:] if parts[0] == 'module' else parts[1:]
+    return parts[0]
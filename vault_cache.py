@@ -0,0 +1,157 @@
+'''
+Shared, caching access to Vault secrets for scripts that read the same secrets for many tenants.
+'''
+
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import requests
+import requests.adapters
+
+default_pool_size = 20
+
+# A secret is read again once this much of its lease is left, rather than right at the end of it.
+lease_margin = 0.1
+
+# Secrets without a lease (lease_duration 0) are kept this long. Secrets with one are kept no longer than
+# their lease, and never longer than max_ttl_seconds so that rotated secrets are picked up.
+default_ttl_seconds = 300
+default_max_ttl_seconds = 3600
+
+
+class VaultCache:
+    ''' Reads secrets over one pooled HTTP session, and keeps each one until its lease is nearly up. With
+    cache_path and key (a Fernet key) the cache is also kept on disk, encrypted, so that it outlives the
+    process. read() returns what hvac.Client.read() would. '''
+
+    def __init__(self, url=None, token=None, pool_size=default_pool_size, ttl_seconds=default_ttl_seconds,
+                 max_ttl_seconds=default_max_ttl_seconds, cache_path=None, key=None):
+        self.url = (url or os.environ['VAULT_ADDR']).rstrip('/')
+        self.token = token or os.environ['VAULT_TOKEN']
+        self.pool_size = pool_size
+        self.ttl_seconds = ttl_seconds
+        self.max_ttl_seconds = max_ttl_seconds
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['X-Vault-Token'] = self.token
+
+        # path -> (expires, secret)
+        self.secrets = {}
+        self.lock = threading.Lock()
+        self.reads = 0
+
+        self.cache_path = cache_path or os.environ.get('VAULT_CACHE_PATH')
+        key = key or os.environ.get('VAULT_CACHE_KEY')
+        self.fernet = None
+        if self.cache_path and key:
+            # Only needed for the on-disk cache.
+            from cryptography.fernet import Fernet  # pylint: disable=import-outside-toplevel
+            self.fernet = Fernet(key)
+            self._load()
+
+    def close(self):
+        ''' Close the HTTP session '''
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _expires(self, secret):
+        lease_duration = secret.get('lease_duration') or 0
+        if lease_duration <= 0:
+            return time.time() + self.ttl_seconds
+        return time.time() + min(lease_duration * (1 - lease_margin), self.max_ttl_seconds)
+
+    def _cached(self, path):
+        with self.lock:
+            cached = self.secrets.get(path)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+        return None
+
+    def _fetch(self, path):
+        response = self.session.get(f"{self.url}/v1/{path.lstrip('/')}")
+        # read_many fetches from several threads at once.
+        with self.lock:
+            self.reads += 1
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def read(self, path):
+        ''' A secret, from the cache if its lease allows, or None if there is no such secret '''
+        secret = self._cached(path)
+        if secret is not None:
+            return secret
+
+        secret = self._fetch(path)
+        if secret is not None:
+            with self.lock:
+                self.secrets[path] = (self._expires(secret), secret)
+            self._save()
+        return secret
+
+    def read_many(self, paths):
+        ''' Map of path to secret (or None) for every path, reading whatever isn't cached in parallel.
+        Each secret is read at most once however often it appears in paths. '''
+        results = {}
+        missing = []
+        for path in dict.fromkeys(paths):
+            secret = self._cached(path)
+            if secret is not None:
+                results[path] = secret
+            else:
+                missing.append(path)
+
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.pool_size, len(missing))) as pool:
+                fetched = dict(zip(missing, pool.map(self._fetch, missing)))
+            with self.lock:
+                for path, secret in fetched.items():
+                    if secret is not None:
+                        self.secrets[path] = (self._expires(secret), secret)
+            results.update(fetched)
+            self._save()
+
+        return results
+
+    def _load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        # Imported with Fernet above; an unreadable or stale cache file is just ignored.
+        from cryptography.fernet import InvalidToken  # pylint: disable=import-outside-toplevel
+        with open(self.cache_path, 'rb') as cache_handle:
+            try:
+                cached = json.loads(self.fernet.decrypt(cache_handle.read()))
+            except (InvalidToken, ValueError):
+                return
+        now = time.time()
+        with self.lock:
+            for path, (expires, secret) in cached.items():
+                if expires > now:
+                    self.secrets[path] = (expires, secret)
+
+    def _save(self):
+        if self.fernet is None:
+            return
+        now = time.time()
+        with self.lock:
+            cached = {path: [expires, secret] for path, (expires, secret) in self.secrets.items() if expires > now}
+        data = self.fernet.encrypt(json.dumps(cached).encode('utf-8'))
+
+        # Written readable by the owner only, then moved into place.
+        temp_path = self.cache_path + '.tmp'
+        cache_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(cache_fd, 'wb') as cache_handle:
+            cache_handle.write(data)
+        os.replace(temp_path, self.cache_path)
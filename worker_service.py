@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+'''
+Long running infra_service worker. Takes plan/apply/destroy jobs over a local HTTP API, runs them in a pool
+of processes that stay up between jobs, and keeps terraform working directories initialised ahead of time
+so that a job doesn't wait for terraform init.
+
+  POST /jobs                     {"tenant": ..., "working_dir": ..., "action": "apply", "arguments": [...]}
+  GET  /jobs                     every job this worker knows about
+  GET  /jobs/<id>                one job: state, exit code, timings
+  GET  /jobs/<id>/log?offset=N   job output from byte N; add follow=1 to keep streaming until the job is over
+  GET  /health                   running and queued jobs, warm workspaces
+'''
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import glob
+import http.server
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+import uuid
+
+from python_terraform import Terraform
+
+import infra_service
+from tf_cache import init_requirements, init_is_current, record_init
+
+# pylint: disable=line-too-long
+
+default_state_dir = os.environ.get('INFRA_WORKER_DIR', os.path.expanduser('~/.cache/infra_service/worker'))
+
+# What each job action runs infra_service with.
+job_actions = {
+    "plan": [],
+    "apply": ['--apply'],
+    "plan_destroy": ['--destroy'],
+    "destroy": ['--destroy', '--apply']
+}
+
+# infra_service options (by destination) that make no sense for a single job, or that only the action sets.
+# They are checked on the parsed arguments, so abbreviations argparse accepts (--appl, --batch) are caught too.
+rejected_destinations = ['batch_dir', 'customer_envs', 'max_parallel', 'max_per_subscription', 'layers',
+                         'migrate_state', 'action_apply', 'action_destroy']
+
+# A workspace template nobody has submitted a job for in this long stops being kept warm.
+template_max_age_seconds = 7 * 24 * 3600
+
+# How often the log of a followed job is checked for more output.
+follow_poll_seconds = 0.5
+
+
+def get_args():
+    ''' process commandline arguments '''
+    parser = argparse.ArgumentParser(
+        description='Run infra_service jobs from a local HTTP API, with pre-initialised terraform workspaces')
+    parser.add_argument('--listen', dest='listen', action='store', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', dest='port', action='store', type=int, default=8085,
+                        help='Port to listen on')
+    parser.add_argument('--max-parallel', dest='max_parallel', action='store', type=infra_service.positive_int, default=4,
+                        help='How many jobs run at once')
+    parser.add_argument('--max-per-subscription', dest='max_per_subscription', action='store', type=infra_service.positive_int, default=2,
+                        help='How many jobs in the same Azure subscription run at once')
+    parser.add_argument('--warm-workspaces', dest='warm_workspaces', action='store', type=infra_service.non_negative_int, default=2,
+                        help='Initialised workspaces kept ready for each distinct set of providers')
+    parser.add_argument('--state-dir', dest='state_dir', action='store', default=default_state_dir,
+                        help='Where job logs, job records and warm workspaces are kept')
+    parser.add_argument('--prewarm', dest='prewarm', action='store', nargs='*', default=[],
+                        help='Rendered config directories to prepare warm workspaces for at startup')
+    parser.add_argument('--terraform-bin', dest='terraform_bin', action='store', default=infra_service.terraform_bin_path,
+                        help='Terraform binary the jobs run')
+    return parser.parse_args()
+
+
+def job_arguments(action, arguments):
+    ''' infra_service arguments for a job, checked the way infra_service itself would. Raises ValueError. '''
+    if action not in job_actions:
+        raise ValueError(f"Unknown action {action}, expected one of {', '.join(job_actions)}")
+    if not isinstance(arguments, list) or not all(isinstance(argument, str) for argument in arguments):
+        raise ValueError("arguments must be a list of strings")
+
+    argv = job_actions[action] + arguments
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+            expected = vars(infra_service.get_args(job_actions[action]))
+            parsed = vars(infra_service.get_args(argv))
+    except SystemExit:
+        raise ValueError(f"Invalid infra_service arguments: {' '.join(arguments)}")
+
+    for destination in rejected_destinations:
+        if parsed[destination] != expected[destination]:
+            raise ValueError(f"{destination.replace('action_', '').replace('_', '-')} can't be set for a job "
+                             f"(arguments: {' '.join(arguments)})")
+    return argv
+
+
+def set_terraform_bin(terraform_bin):
+    ''' Job process initializer '''
+    infra_service.terraform_bin_path = terraform_bin
+
+
+def run_job(job_id, tenant, working_dir, argv, log_path):
+    ''' Job process: run infra_service for one working directory, with its output going to the job log '''
+    args = infra_service.get_args(argv)
+    with open(log_path, 'a', buffering=1) as log_handle, contextlib.redirect_stdout(log_handle):
+        print(f"Job {job_id}: {' '.join(['infra_service.py'] + argv)} for {tenant} in {working_dir}", flush=True)
+        tf_exit_code = infra_service.run_workspace(args, working_dir, logger_name=f"basic_logger.{tenant}", tenant=tenant)
+        print(f"Infra service returned {tf_exit_code}", flush=True)
+    return tf_exit_code
+
+
+class WarmWorkspaces:
+    ''' Terraform init results (.terraform directories) made ahead of time, one set per distinct init
+    requirement (see tf_cache.init_requirements). A job whose working directory isn't initialised yet is
+    handed one, which saves it the init.
+
+    <pool dir>/<requirements>/template/   the config files of the last job with these requirements
+    <pool dir>/<requirements>/ready/<id>/ an initialised workspace, ready to be handed out
+    <pool dir>/building/<id>/             a workspace being initialised '''
+
+    def __init__(self, pool_dir, size, terraform_bin):
+        self.pool_dir = pool_dir
+        self.size = size
+        self.terraform_bin = terraform_bin
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()
+        shutil.rmtree(os.path.join(pool_dir, 'building'), ignore_errors=True)
+        os.makedirs(os.path.join(pool_dir, 'building'), exist_ok=True)
+
+    def _requirements_dir(self, requirements):
+        return os.path.join(self.pool_dir, requirements[:24])
+
+    def remember(self, working_dir):
+        ''' Use a working directory's config as the template for workspaces with its requirements '''
+        requirements = init_requirements(working_dir, self.terraform_bin)
+        template_dir = os.path.join(self._requirements_dir(requirements), 'template')
+        with self.lock:
+            shutil.rmtree(template_dir, ignore_errors=True)
+            os.makedirs(template_dir)
+            for config_path in glob.glob(os.path.join(working_dir, '*.tf')):
+                shutil.copy2(config_path, template_dir)
+        self.wanted.set()
+        return requirements
+
+    def take(self, working_dir):
+        ''' Make sure a working directory is initialised if a warm workspace allows it. Returns 'current' if it
+        already was, 'warm' if it was given a warm workspace, and 'cold' if terraform init still has to run. '''
+        requirements = self.remember(working_dir)
+        if init_is_current(working_dir, requirements):
+            return 'current'
+
+        # Claiming a slot is a rename out of the ready directory; the file work happens after letting go of the lock.
+        ready_dir = os.path.join(self._requirements_dir(requirements), 'ready')
+        with self.lock:
+            slots = sorted(os.listdir(ready_dir)) if os.path.isdir(ready_dir) else []
+            if not slots:
+                return 'cold'
+            slot_dir = os.path.join(self.pool_dir, 'building', 'taken-' + slots[0])
+            os.rename(os.path.join(ready_dir, slots[0]), slot_dir)
+        self.wanted.set()
+
+        # The init marker lives inside .terraform, so moving it across is all the working directory needs.
+        shutil.rmtree(os.path.join(working_dir, '.terraform'), ignore_errors=True)
+        os.rename(os.path.join(slot_dir, '.terraform'), os.path.join(working_dir, '.terraform'))
+        shutil.rmtree(slot_dir)
+        return 'warm'
+
+    def counts(self):
+        ''' Ready workspaces per requirements '''
+        with self.lock:
+            return {name: len(os.listdir(os.path.join(self.pool_dir, name, 'ready')))
+                    for name in sorted(os.listdir(self.pool_dir))
+                    if os.path.isdir(os.path.join(self.pool_dir, name, 'ready'))}
+
+    def _shortfall(self):
+        ''' Template dirs that have fewer ready workspaces than they should, dropping templates nobody uses '''
+        short = []
+        with self.lock:
+            for name in sorted(os.listdir(self.pool_dir)):
+                template_dir = os.path.join(self.pool_dir, name, 'template')
+                if not os.path.isdir(template_dir):
+                    continue
+                if time.time() - os.path.getmtime(template_dir) > template_max_age_seconds:
+                    shutil.rmtree(os.path.join(self.pool_dir, name))
+                    continue
+                ready_dir = os.path.join(self.pool_dir, name, 'ready')
+                ready = len(os.listdir(ready_dir)) if os.path.isdir(ready_dir) else 0
+                short += [template_dir] * (self.size - ready)
+        return short
+
+    def _build(self, template_dir):
+        ''' Initialise one workspace from a template and put it with the ready ones '''
+        slot_id = uuid.uuid4().hex
+        build_dir = os.path.join(self.pool_dir, 'building', slot_id)
+        with self.lock:
+            shutil.copytree(template_dir, build_dir)
+        requirements = init_requirements(build_dir, self.terraform_bin)
+
+        # The same turn taking on the shared plugin cache as infra_service.tf_init.
+        init_start = time.time()
+        terra = Terraform(working_dir=build_dir, terraform_bin_path=self.terraform_bin)
+        with open(os.path.join(os.environ['TF_PLUGIN_CACHE_DIR'], '.infra_service.lock'), 'w') as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            init_code, _, init_error = terra.init()
+        if init_code != 0:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise RuntimeError(f"terraform init failed for {template_dir}: {init_error}")
+        record_init(build_dir, requirements, time.time() - init_start)
+
+        ready_dir = os.path.join(os.path.dirname(template_dir), 'ready')
+        with self.lock:
+            os.makedirs(ready_dir, exist_ok=True)
+            os.rename(build_dir, os.path.join(ready_dir, slot_id))
+
+    def keep_warm(self):
+        ''' Thread body: top the pool up whenever a workspace is taken or a new template turns up '''
+        failed = set()
+        while True:
+            self.wanted.wait(timeout=300)
+            self.wanted.clear()
+            for template_dir in self._shortfall():
+                template_key = None
+                try:
+                    # A template that didn't init won't init any better the second time; the next job replaces it.
+                    template_key = (template_dir, os.path.getmtime(template_dir))
+                    if template_key in failed:
+                        continue
+                    self._build(template_dir)
+                except (OSError, RuntimeError) as error:
+                    logging.error("Unable to prepare a warm workspace: %s", error)
+                    if template_key is not None:
+                        failed.add(template_key)
+
+
+class WorkerService:
+    ''' The job queue, and the process pool the jobs run in '''
+
+    def __init__(self, args):
+        self.args = args
+        self.jobs_dir = os.path.join(args.state_dir, 'jobs')
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self.workspaces = WarmWorkspaces(os.path.join(args.state_dir, 'workspaces'), args.warm_workspaces, args.terraform_bin)
+
+        self.jobs = collections.OrderedDict()
+        self.pending = collections.deque()
+        self.running = {}
+        self.subscription_load = collections.Counter()
+        self.condition = threading.Condition()
+
+        # Job processes live as long as the worker, so imports and the provider cache stay warm between jobs.
+        # They are spawned rather than forked, as this process has threads.
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.max_parallel,
+                                                           mp_context=multiprocessing.get_context('spawn'),
+                                                           initializer=set_terraform_bin, initargs=(args.terraform_bin,))
+
+    def _save(self, job):
+        record_path = os.path.join(self.jobs_dir, job['id'] + '.json')
+        with open(record_path + '.tmp', 'w') as record_handle:
+            json.dump(job, record_handle, indent=2, sort_keys=True)
+        os.replace(record_path + '.tmp', record_path)
+
+    def submit(self, request):
+        ''' Queue a job. Returns its record. Raises ValueError if the request is no good. '''
+        if not isinstance(request, dict):
+            raise ValueError("Expected a JSON object")
+        working_dir = request.get('working_dir')
+        if not isinstance(working_dir, str) or not glob.glob(os.path.join(working_dir, '*.tf')):
+            raise ValueError(f"working_dir {working_dir} has no terraform config")
+        working_dir = os.path.abspath(working_dir)
+        action = request.get('action', 'plan')
+        argv = job_arguments(action, request.get('arguments', []))
+
+        job_id = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+        job = {
+            "id": job_id,
+            "tenant": str(request.get('tenant') or os.path.basename(working_dir)),
+            "action": action,
+            "working_dir": working_dir,
+            "argv": argv,
+            "subscription": infra_service.tenant_subscription(working_dir),
+            "state": "queued",
+            "workspace": None,
+            "exit_code": None,
+            "result": None,
+            "submitted": time.time(),
+            "started": None,
+            "finished": None,
+            "log_path": os.path.join(self.jobs_dir, job_id + '.log')
+        }
+        with self.condition:
+            self.jobs[job_id] = job
+            self.pending.append(job_id)
+            self._save(job)
+            self.condition.notify_all()
+        return dict(job)
+
+    def job(self, job_id):
+        ''' A job's record, from memory or from an earlier run of the worker, or None '''
+        with self.condition:
+            if job_id in self.jobs:
+                return dict(self.jobs[job_id])
+        record_path = os.path.join(self.jobs_dir, os.path.basename(job_id) + '.json')
+        if not os.path.exists(record_path):
+            return None
+        with open(record_path, 'r') as record_handle:
+            job = json.load(record_handle)
+        # A worker that stopped while the job ran never saw it finish.
+        if job['state'] in ['queued', 'running']:
+            job['state'] = 'lost'
+        return job
+
+    def list_jobs(self):
+        with self.condition:
+            return [dict(job) for job in self.jobs.values()]
+
+    def health(self):
+        with self.condition:
+            return {"running": len(self.running), "queued": len(self.pending), "max_parallel": self.args.max_parallel,
+                    "warm_workspaces": self.workspaces.counts()}
+
+    def _can_start(self, job):
+        busy_dirs = set(self.jobs[job_id]['working_dir'] for job_id in self.running)
+        return (len(self.running) < self.args.max_parallel
+                and job['working_dir'] not in busy_dirs
+                and self.subscription_load[job['subscription']] < self.args.max_per_subscription)
+
+    def _claim(self, job):
+        ''' Count a job against the limits before it starts. Called with the lock held. '''
+        self.pending.remove(job['id'])
+        self.running[job['id']] = job
+        self.subscription_load[job['subscription']] += 1
+
+    def _start(self, job):
+        ''' Give a claimed job its workspace and hand it to the pool. Called without the lock, as that is file work. '''
+        try:
+            workspace = self.workspaces.take(job['working_dir'])
+        except OSError as error:
+            # Terraform init in the job will sort it out.
+            logging.warning("%s: no warm workspace: %s", job['id'], error)
+            workspace = 'cold'
+        with self.condition:
+            job['workspace'] = workspace
+            job['state'] = 'running'
+            job['started'] = time.time()
+            self._save(job)
+        future = self.pool.submit(run_job, job['id'], job['tenant'], job['working_dir'], job['argv'], job['log_path'])
+        future.add_done_callback(lambda future, job_id=job['id']: self._finish(job_id, future))
+        logging.info("%s: started %s for %s (%s workspace)", job['id'], job['action'], job['tenant'], job['workspace'])
+
+    def _finish(self, job_id, future):
+        with self.condition:
+            job = self.running.pop(job_id)
+            self.subscription_load[job['subscription']] -= 1
+            try:
+                job['exit_code'] = future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                logging.error("%s: job process failed: %s", job_id, error)
+                job['exit_code'] = infra_service.exit_codes['I_HAVE_NO_CLUE']
+            job['result'] = infra_service.exit_code_names.get(job['exit_code'])
+            job['state'] = 'finished'
+            job['finished'] = time.time()
+            self._save(job)
+            self.condition.notify_all()
+        logging.info("%s: finished with %s %s after %.1f seconds", job_id, job['result'], job['exit_code'],
+                     job['finished'] - job['started'])
+
+    def dispatch(self):
+        ''' Thread body: start queued jobs as the limits allow, in the order they came in otherwise '''
+        while True:
+            with self.condition:
+                starting = []
+                for job_id in list(self.pending):
+                    job = self.jobs[job_id]
+                    if self._can_start(job):
+                        self._claim(job)
+                        starting.append(job)
+                if not starting:
+                    self.condition.wait()
+            for job in starting:
+                self._start(job)
+
+    def wait_for_change(self, timeout):
+        ''' Block until a job starts or finishes, or timeout passes '''
+        with self.condition:
+            self.condition.wait(timeout)
+
+
+class JobRequestHandler(http.server.BaseHTTPRequestHandler):
+    ''' The HTTP side of WorkerService '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("%s %s", self.address_string(), format % args)
+
+    def send_json(self, status, body):
+        data = (json.dumps(body, indent=2, sort_keys=True) + '\n').encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {"error": f"No such endpoint {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+            job = self.server.service.submit(request)
+        except ValueError as error:
+            self.send_json(400, {"error": str(error)})
+            return
+        self.send_json(202, job)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urllib.parse.urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = urllib.parse.parse_qs(url.query)
+        service = self.server.service
+
+        if parts == ['health']:
+            self.send_json(200, service.health())
+        elif parts == ['jobs']:
+            self.send_json(200, service.list_jobs())
+        elif len(parts) in [2, 3] and parts[0] == 'jobs':
+            job = service.job(parts[1])
+            if job is None:
+                self.send_json(404, {"error": f"No such job {parts[1]}"})
+            elif len(parts) == 2:
+                self.send_json(200, job)
+            elif parts[2] == 'log':
+                try:
+                    offset = int(query.get('offset', ['0'])[0])
+                except ValueError:
+                    self.send_json(400, {"error": "offset must be a number"})
+                    return
+                self.send_log(job, offset, query.get('follow', ['0'])[0] in ['1', 'true'])
+            else:
+                self.send_json(404, {"error": f"No such endpoint {self.path}"})
+        else:
+            self.send_json(404, {"error": f"No such endpoint {self.path}"})
+
+    def send_log(self, job, offset, follow):
+        ''' Job output from offset on. Followed logs are sent chunked until the job is over. '''
+        def read_from(position):
+            if not os.path.exists(job['log_path']):
+                return b''
+            with open(job['log_path'], 'rb') as log_handle:
+                log_handle.seek(position)
+                return log_handle.read()
+
+        if not follow:
+            data = read_from(offset)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('X-Log-Offset', str(offset + len(data)))
+            self.send_header('X-Job-State', job['state'])
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        service = self.server.service
+        try:
+            while True:
+                # Read after checking the state, so that nothing written before the job finished is missed.
+                finished = service.job(job['id'])['state'] not in ['queued', 'running']
+                data = read_from(offset)
+                if data:
+                    offset += len(data)
+                    self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+                    self.wfile.flush()
+                if finished:
+                    break
+                service.wait_for_change(follow_poll_seconds)
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped listening; the job carries on regardless.
+            self.close_connection = True
+
+
+def main():
+    ''' main body of the script '''
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args = get_args()
+
+    infra_service.share_plugin_cache()
+    service = WorkerService(args)
+
+    for config_dir in args.prewarm:
+        service.workspaces.remember(os.path.abspath(config_dir))
+
+    threading.Thread(target=service.workspaces.keep_warm, name='keep_warm', daemon=True).start()
+    threading.Thread(target=service.dispatch, name='dispatch', daemon=True).start()
+
+    server = http.server.ThreadingHTTPServer((args.listen, args.port), JobRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    logging.info("Listening on %s:%d, running up to %d jobs at once", args.listen, args.port, args.max_parallel)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    main()